@@ -0,0 +1,74 @@
+import pytest
+
+import virtool.pathoscope.convergence as convergence
+
+
+def make_iteration(**kwargs):
+    values = {
+        "number": 3,
+        "l1_change": 1e-4,
+        "max_change": 1e-6,
+        "log_likelihood": -1000.0,
+        "previous_log_likelihood": -1000.5,
+        "elapsed": 10.0
+    }
+
+    values.update(kwargs)
+
+    return convergence.Iteration(**values)
+
+
+@pytest.mark.parametrize("policy,expected", [
+    (convergence.L1Change(1e-3), True),
+    (convergence.L1Change(1e-5), False),
+    (convergence.MaxChange(1e-6), True),
+    (convergence.MaxChange(1e-7), False),
+    (convergence.RelativeLikelihoodChange(1e-3), True),
+    (convergence.RelativeLikelihoodChange(1e-4), False),
+    (convergence.TimeBudget(10), True),
+    (convergence.TimeBudget(60), False)
+])
+def test_policies(policy, expected):
+    assert policy(make_iteration()) is expected
+
+
+def test_stopping_policy_abstract():
+    """
+    Test that a policy that does not implement ``__call__`` cannot be created.
+
+    """
+    class Incomplete(convergence.StoppingPolicy):
+        pass
+
+    with pytest.raises(TypeError):
+        convergence.StoppingPolicy()
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+@pytest.mark.parametrize("previous", [None, float("-inf")])
+def test_relative_likelihood_change_first(previous):
+    """
+    Test that the relative likelihood change policy never stops EM without a finite previous log-likelihood.
+
+    """
+    policy = convergence.RelativeLikelihoodChange(1)
+
+    assert not policy(make_iteration(previous_log_likelihood=previous))
+
+
+def test_get_policies():
+    policies = convergence.get_policies({"time_budget": 600, "max_change": 1e-6})
+
+    assert [type(policy) for policy in policies] == [convergence.MaxChange, convergence.TimeBudget]
+    assert policies[0].epsilon == 1e-6
+    assert policies[1].seconds == 600
+
+    assert not convergence.uses_likelihood(policies)
+    assert convergence.uses_likelihood(convergence.get_policies({"relative_likelihood_change": 1e-8}))
+
+    with pytest.raises(ValueError) as err:
+        convergence.get_policies({"foo": 1, "max_change": 1e-6})
+
+    assert "foo" in str(err.value)
@@ -0,0 +1,110 @@
+import threading
+
+import pymongo
+import pymongo.errors
+import pytest
+
+import virtool.pathoscope.db as db
+
+
+class MockCollection:
+
+    def __init__(self, delay=None):
+        self.batches = list()
+        self.delay = delay
+
+    def bulk_write(self, requests, ordered=True):
+        if self.delay:
+            self.delay.wait(10)
+
+        if any(request._doc["$set"].get("large") for request in requests):
+            raise pymongo.errors.DocumentTooLarge("Too large")
+
+        self.batches.append([request._filter["_id"] for request in requests])
+
+
+def test_get_client():
+    """
+    Test that the same client is returned for the same connection string.
+
+    """
+    client = db.get_client("mongodb://localhost:27017")
+
+    assert db.get_client("mongodb://localhost:27017") is client
+    assert db.get_client("mongodb://localhost:27018") is not client
+
+
+@pytest.mark.parametrize("settings,expected", [
+    ({}, None),
+    ({"results_write_concern": {"w": "majority", "wtimeout": 1000}}, {"w": "majority", "wtimeout": 1000})
+])
+def test_get_write_concern(settings, expected):
+    write_concern = db.get_write_concern(settings)
+
+    if expected is None:
+        assert write_concern is None
+    else:
+        assert write_concern.document == expected
+
+
+def test_bulk_writer():
+    """
+    Test that updates queued while a write is in progress are written together in the next batch.
+
+    """
+    release = threading.Event()
+
+    collection = MockCollection(delay=release)
+
+    writer = db.BulkWriter(collection)
+
+    threads = [threading.Thread(target=writer.update_one, args=({"_id": "foo"}, {"$set": {"ready": True}}))]
+
+    threads[0].start()
+
+    # Wait for the first write to start before queueing the others.
+    while not writer._writing:
+        pass
+
+    for analysis_id in ["bar", "baz"]:
+        thread = threading.Thread(target=writer.update_one, args=({"_id": analysis_id}, {"$set": {"ready": True}}))
+        thread.start()
+        threads.append(thread)
+
+    while len(writer._pending) < 2:
+        pass
+
+    release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert collection.batches[0] == ["foo"]
+    assert sorted(collection.batches[1]) == ["bar", "baz"]
+
+
+def test_bulk_writer_too_large():
+    """
+    Test that a document that is too large only fails its own update.
+
+    """
+    collection = MockCollection()
+
+    writer = db.BulkWriter(collection)
+
+    writer.update_one({"_id": "foo"}, {"$set": {"ready": True}})
+
+    with pytest.raises(pymongo.errors.DocumentTooLarge):
+        writer.update_one({"_id": "bar"}, {"$set": {"large": True}})
+
+    batch = [
+        {"request": pymongo.UpdateOne({"_id": "baz"}, {"$set": {"large": True}}), "done": False, "error": None},
+        {"request": pymongo.UpdateOne({"_id": "qux"}, {"$set": {"ready": True}}), "done": False, "error": None}
+    ]
+
+    writer._write(batch)
+
+    assert isinstance(batch[0]["error"], pymongo.errors.DocumentTooLarge)
+    assert batch[1]["error"] is None
+
+    assert collection.batches == [["foo"], ["qux"]]
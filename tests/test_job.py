@@ -1,11 +1,19 @@
 import os
 import sys
+import gzip
 import json
+import time
 import shutil
+import pymongo
 import pytest
 import filecmp
+import threading
+import subprocess
 
+import virtool.pathoscope.db
 import virtool.pathoscope.job
+import virtool.pathoscope.kmers
+import virtool.pathoscope.utils
 
 TEST_FILES_PATH = os.path.join(sys.path[0], "tests", "test_files")
 INDEX_PATH = os.path.join(TEST_FILES_PATH, "index")
@@ -113,16 +121,19 @@ def test_check_db(tmpdir, paired, dbs, mock_job):
         "_id": "Arabidopsis thaliana"
     })
 
-    mock_job.check_db()
-
     sample_path = os.path.join(tmpdir, "samples", "foobar")
 
+    if paired:
+        shutil.copyfile(FASTQ_PATH, os.path.join(sample_path, "reads_2.fq"))
+
+    mock_job.check_db()
+
     assert mock_job.params["read_count"] == 1337
 
-    expected_read_filenames = ["reads_1.fastq"]
+    expected_read_filenames = ["reads_1.fq"]
 
     if paired:
-        expected_read_filenames.append("reads_2.fastq")
+        expected_read_filenames.append("reads_2.fq")
 
     assert mock_job.params["read_paths"] == [
         os.path.join(sample_path, filename) for filename in expected_read_filenames
@@ -136,6 +147,42 @@ def test_check_db(tmpdir, paired, dbs, mock_job):
     )
 
 
+@pytest.mark.parametrize("filenames,expected", [
+    (["reads_1.fastq.gz"], "reads_1.fastq.gz"),
+    (["reads_1.fq.zst"], "reads_1.fq.zst"),
+    (["reads_1.fastq.gz", "reads_1.fq"], "reads_1.fq"),
+    (["reads_1.fq.zst", "reads_1.fq.gz"], "reads_1.fq.gz"),
+    ([], "reads_1.fastq")
+])
+def test_check_db_read_paths(filenames, expected, tmpdir, dbs, mock_job):
+    """
+    Test that compressed read files are found, that uncompressed and gzip files are preferred in that order and that
+    the ``.fastq`` path is used if there is no read file.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    sample_path = os.path.join(str(tmpdir), "samples", "foobar")
+
+    os.remove(os.path.join(sample_path, "reads_1.fq"))
+
+    for filename in filenames:
+        open(os.path.join(sample_path, filename), "wb").close()
+
+    mock_job.check_db()
+
+    assert mock_job.params["read_paths"] == [os.path.join(sample_path, expected)]
+
+
 def test_mk_analysis_dir(dbs, mock_job):
     dbs.samples.insert_one({
         "_id": "foobar",
@@ -200,6 +247,173 @@ def test_map_otus(tmpdir, dbs, mock_job):
     }
 
 
+def test_map_otus_prefilter(tmpdir, dbs, mock_job):
+    """
+    Test that a k-mer sketch is saved next to the index and that the prefilter read counts are recorded.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.check_db()
+
+    mock_job.params["kmer_prefilter"] = True
+
+    os.makedirs(mock_job.params["analysis_path"])
+
+    mock_job.params["read_paths"] = [
+        os.path.join(str(tmpdir), "samples", "foobar", "reads_1.fq")
+    ]
+
+    mock_job.map_otus()
+
+    assert os.path.isfile(virtool.pathoscope.kmers.get_sketch_path(mock_job.params["index_path"]))
+
+    prefilter = mock_job.intermediate["prefilter"]
+
+    assert 0 < prefilter["passed_count"] <= prefilter["read_count"]
+
+
+@pytest.mark.parametrize("reduce_reads", [False, True])
+def test_map_otus_cache(reduce_reads, tmpdir, dbs, mocker, mock_job):
+    """
+    Test that the otu hits, and the reduced reads if requested, are cached and reused by a subsequent run on the same
+    reads.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.check_db()
+
+    mock_job.params.update({
+        "otu_cache": True,
+        "reduce_reads": reduce_reads
+    })
+
+    os.makedirs(mock_job.params["analysis_path"])
+
+    mock_job.params["read_paths"] = [
+        os.path.join(str(tmpdir), "samples", "foobar", "reads_1.fq")
+    ]
+
+    mock_job.map_otus()
+
+    to_otus = mock_job.intermediate["to_otus"]
+
+    if reduce_reads:
+        assert mock_job.intermediate["isolate_read_paths"] == [
+            os.path.join(mock_job.params["analysis_path"], "otu_reads.fastq")
+        ]
+
+    mock_job.intermediate = dict()
+
+    spy = mocker.spy(mock_job, "run_subprocess")
+
+    mock_job.map_otus()
+
+    assert spy.call_count == 0
+
+    assert mock_job.intermediate["to_otus"] == to_otus
+
+    if reduce_reads:
+        assert os.path.isfile(mock_job.intermediate["isolate_read_paths"][0])
+    else:
+        assert "isolate_read_paths" not in mock_job.intermediate
+
+
+def test_stream_reads(tmpdir, mocker):
+    """
+    Test that compressed read files are streamed through named pipes that are removed afterwards and that
+    uncompressed files are passed through.
+
+    """
+    mocker.patch(
+        "virtool.pathoscope.job.get_decompress_command",
+        lambda path, threads=1: ["gzip", "-dc", path] if path.endswith(".gz") else None
+    )
+
+    record = b"@read_1\nACGT\n+\nIIII\n"
+
+    compressed_path = os.path.join(str(tmpdir), "reads_1.fastq.gz")
+    uncompressed_path = os.path.join(str(tmpdir), "reads_2.fastq")
+
+    with gzip.open(compressed_path, "wb") as f:
+        f.write(record)
+
+    with open(uncompressed_path, "wb") as f:
+        f.write(record)
+
+    with virtool.pathoscope.job.stream_reads([compressed_path, uncompressed_path], str(tmpdir)) as paths:
+        assert paths[1] == uncompressed_path
+
+        for path in paths:
+            with open(path, "rb") as f:
+                assert f.read() == record
+
+    assert sorted(os.listdir(str(tmpdir))) == ["reads_1.fastq.gz", "reads_2.fastq"]
+
+    tmpdir.join("bad.fastq.gz").write("foo")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        with virtool.pathoscope.job.stream_reads([os.path.join(str(tmpdir), "bad.fastq.gz")], str(tmpdir)) as paths:
+            with open(paths[0], "rb") as f:
+                f.read()
+
+
+@pytest.mark.parametrize("options", [{}, {"sharded": True}, {"memory_budget": 2 ** 20}])
+def test_run_patho_profiler(options, tmpdir):
+    """
+    Test that each phase of reassignment, the matrix dimensions and the EM iterations are reported to the profiler
+    and that the reassigned alignments are unchanged.
+
+    """
+    vta_path = os.path.join(str(tmpdir), "to_isolates.vta")
+    reassigned_path = os.path.join(str(tmpdir), "reassigned.vta")
+
+    shutil.copyfile(VTA_PATH, vta_path)
+
+    events = list()
+
+    result = virtool.pathoscope.job.run_patho(
+        vta_path,
+        reassigned_path,
+        threads=2,
+        profiler=lambda event, info: events.append((event, info)),
+        **options
+    )
+
+    assert filecmp.cmp(reassigned_path, UPDATED_VTA_PATH)
+
+    phases = [info["name"] for event, info in events if event == "phase"]
+
+    assert phases == ["build_matrix", "compute_best_hit_initial", "em", "compute_best_hit_final", "rewrite_align"]
+
+    matrix_info = [info for event, info in events if event == "matrix"]
+
+    assert matrix_info == [{"reads": result[-1], "refs": len(result[-2]), "nnz": 23031}]
+
+    iterations = [info for event, info in events if event == "em_iteration"]
+
+    assert [info["iteration"] for info in iterations] == list(range(len(iterations)))
+
+
 def test_map_isolates(tmpdir, dbs, mock_job):
     dbs.samples.insert_one({
         "_id": "foobar",
@@ -244,6 +458,194 @@ def test_map_isolates(tmpdir, dbs, mock_job):
     assert observed == expected
 
 
+@pytest.mark.parametrize("intern_read_ids", [False, True])
+def test_map_isolates_alignment_cache(intern_read_ids, tmpdir, dbs, mock_job):
+    """
+    Test that alignments saved to the alignment cache by one analysis are reused by the next one without running
+    ``bowtie2`` and that the merged output matches a full mapping.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.task_args["alignment_cache"] = True
+
+    mock_job.check_db()
+
+    assert mock_job.params["alignment_cache"]
+
+    mock_job.params["intern_read_ids"] = intern_read_ids
+
+    os.makedirs(mock_job.params["analysis_path"])
+
+    mock_job.params["read_paths"] = [
+        os.path.join(str(tmpdir), "samples", "foobar", "reads_1.fq")
+    ]
+
+    sample_path = os.path.join(str(tmpdir), "samples", "foobar")
+    index_path = os.path.join(str(tmpdir), "references", "original", "index3")
+
+    for filename in os.listdir(index_path):
+        shutil.copyfile(
+            os.path.join(index_path, filename),
+            os.path.join(sample_path, "analysis", "baz", filename.replace("reference", "isolates"))
+        )
+
+    with open(ISOLATES_VTA_PATH, "r") as f:
+        expected = {line.rstrip() for line in f}
+
+    cache_path = os.path.join(str(tmpdir), "alignment_cache")
+
+    entry_paths = {ref_id: os.path.join(cache_path, ref_id) for ref_id in {line.split(",")[1] for line in expected}}
+
+    def map_isolates():
+        mock_job.map_isolates()
+
+        with open(os.path.join(mock_job.params["analysis_path"], "to_isolates.vta"), "r") as f:
+            lines = [line.rstrip().split(",", 1) for line in f]
+
+        with open(mock_job.get_fastq_path("mapped"), "r") as f:
+            read_ids = {line[1:].rstrip() for line in f.readlines()[::4]}
+
+        if intern_read_ids:
+            lines = [(mock_job.intermediate["read_names"][int(read_id)], rest) for read_id, rest in lines]
+            read_ids = {mock_job.intermediate["read_names"][int(read_id)] for read_id in read_ids}
+
+        return {",".join(line) for line in lines}, read_ids
+
+    mock_job.intermediate.update({
+        "uncached_alignments": dict(entry_paths),
+        "cached_alignments": list()
+    })
+
+    observed, read_ids = map_isolates()
+
+    assert observed == expected
+    assert sorted(os.listdir(cache_path)) == sorted(
+        ref_id + extension for ref_id in entry_paths for extension in [".fastq.gz", ".vta"]
+    )
+
+    os.remove(os.path.join(mock_job.params["analysis_path"], "to_isolates.vta"))
+    os.remove(mock_job.get_fastq_path("mapped"))
+
+    run_subprocess = mock_job.run_subprocess
+
+    commands = list()
+
+    def run_cached(command, **kwargs):
+        commands.append(command[0])
+        return run_subprocess(command, **kwargs)
+
+    mock_job.run_subprocess = run_cached
+
+    mock_job.intermediate.update({
+        "uncached_alignments": dict(),
+        "cached_alignments": list(entry_paths.values())
+    })
+
+    assert map_isolates() == (expected, read_ids)
+
+    # Only the merged output is sorted. The reads are not mapped again.
+    assert commands == ["sort"]
+
+
+def test_map_isolates_alignment_cache_merge(tmpdir, dbs, mocker, mock_job):
+    """
+    Test that new alignments are streamed to the alignment cache and that the cached alignments merged into
+    ``to_isolates.vta`` keep the alignments of each read contiguous.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.task_args["alignment_cache"] = True
+
+    mock_job.check_db()
+
+    os.makedirs(mock_job.params["analysis_path"])
+
+    cache_path = os.path.join(str(tmpdir), "alignment_cache")
+
+    cached_path = os.path.join(cache_path, "cached")
+    uncached_path = os.path.join(cache_path, "uncached")
+
+    os.makedirs(cache_path)
+
+    with open(cached_path + ".vta", "w") as f:
+        f.write("read_1,NC_001948,20,10,0.5\nread_3,NC_001948,5,10,0.25\n")
+
+    with gzip.open(cached_path + ".fastq.gz", "wb") as f:
+        f.write(b"@read_1\nACGTACGTAC\n+\nIIIIIIIIII\n@read_3\nGGGGCCCCAA\n+\nIIIIIIIIII\n")
+
+    run_subprocess = mock_job.run_subprocess
+
+    def fake_bowtie2(command, stdout_handler=None):
+        if command[0] != "bowtie2":
+            return run_subprocess(command)
+
+        with open(command[command.index("--al") + 1], "w") as f:
+            f.write("@read_1\nACGTACGTAC\n+\nIIIIIIIIII\n@read_2\nTTGGCCAATT\n+\nIIIIIIIIII\n")
+
+        stdout_handler(make_sam_line("read_1", 0, "NC_016509", 10, "ACGTACGTAC", -2))
+        stdout_handler(make_sam_line("read_2", 0, "NC_016509", 30, "TTGGCCAATT", 0))
+
+        # The entry is streamed to temporary files while bowtie2 runs.
+        assert os.path.isfile(uncached_path + ".tmp.vta")
+        assert not os.path.isfile(uncached_path + ".vta")
+
+    mocker.patch.object(mock_job, "run_subprocess", side_effect=fake_bowtie2)
+
+    mock_job.intermediate.update({
+        "uncached_alignments": {"NC_016509": uncached_path},
+        "cached_alignments": [cached_path]
+    })
+
+    mock_job.map_isolates()
+
+    assert mock_job.vta_is_grouped()
+
+    with open(os.path.join(mock_job.params["analysis_path"], "to_isolates.vta"), "r") as f:
+        alignments = [tuple(line.split(",")[:2]) for line in f]
+
+    assert sorted(alignments) == [
+        ("read_1", "NC_001948"),
+        ("read_1", "NC_016509"),
+        ("read_2", "NC_016509"),
+        ("read_3", "NC_001948")
+    ]
+
+    read_order = [read_id for i, (read_id, _) in enumerate(alignments) if i == 0 or alignments[i - 1][0] != read_id]
+
+    assert len(read_order) == len(set(read_order))
+
+    with open(mock_job.get_fastq_path("mapped"), "r") as f:
+        assert sorted(line[1:].rstrip() for line in f.readlines()[::4]) == ["read_1", "read_2", "read_3"]
+
+    with open(uncached_path + ".vta", "r") as f:
+        assert [line.split(",")[0] for line in f] == ["read_1", "read_2"]
+
+    with gzip.open(uncached_path + ".fastq.gz", "rt") as f:
+        assert [line[1:].rstrip() for line in f.readlines()[::4]] == ["read_1", "read_2"]
+
+    assert sorted(os.listdir(cache_path)) == ["cached.fastq.gz", "cached.vta", "uncached.fastq.gz", "uncached.vta"]
+
+
 def test_map_subtraction(dbs, mock_job):
     dbs.samples.insert_one({
         "_id": "foobar",
@@ -271,6 +673,234 @@ def test_map_subtraction(dbs, mock_job):
         assert mock_job.intermediate["to_subtraction"] == json.load(handle)
 
 
+def make_sam_line(read_id, flag, ref_id, pos, sequence, score, mate_pos=0, template_length=0):
+    return "\t".join([
+        read_id,
+        str(flag),
+        ref_id,
+        str(pos),
+        "255",
+        "{}M".format(len(sequence)),
+        "=" if mate_pos else "*",
+        str(mate_pos),
+        str(template_length),
+        sequence,
+        "I" * len(sequence),
+        "AS:i:{}".format(score)
+    ]).encode() + b"\n"
+
+
+def test_compress_intermediates(dbs, mocker, mock_job):
+    """
+    Test that ``map_isolates`` has ``bowtie2`` write the mapped reads to ``mapped.fastq.gz`` when the
+    ``compress_intermediates`` param is set and that ``map_subtraction`` maps the reads in that file.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.task_args["compress_intermediates"] = True
+
+    mock_job.check_db()
+
+    mock_job.params["subtraction_path"] = HOST_PATH
+
+    os.makedirs(mock_job.params["analysis_path"])
+
+    mapped_path = os.path.join(mock_job.params["analysis_path"], "mapped.fastq.gz")
+
+    commands = list()
+
+    def run_subprocess(command, stdout_handler=None):
+        commands.append(command)
+
+        if command[-2] == "-U" and "--al-gz" in command:
+            # Stand in for bowtie2 writing the aligned reads and reporting their alignments to the isolates.
+            with gzip.open(command[command.index("--al-gz") + 1], "wb") as f:
+                f.write(b"@read_1\nACGTACGTAC\n+\nIIIIIIIIII\n@read_2\nTTGGCCAATT\n+\nIIIIIIIIII\n")
+
+            stdout_handler(make_sam_line("read_1", 0, "NC_016509", 10, "ACGTACGTAC", -2))
+            stdout_handler(make_sam_line("read_1", 256, "NC_001948", 20, "ACGTACGTAC", -4))
+            stdout_handler(make_sam_line("read_2", 0, "NC_016509", 30, "TTGGCCAATT", 0))
+        else:
+            with gzip.open(command[command.index("-U") + 1], "rb") as f:
+                names = [line[1:].rstrip().decode() for line in f.readlines()[::4]]
+
+            assert names == ["read_1", "read_2"]
+
+            stdout_handler(make_sam_line("read_2", 0, "host", 1, "TTGGCCAATT", -1))
+
+    mocker.patch.object(mock_job, "run_subprocess", side_effect=run_subprocess)
+
+    mock_job.map_isolates()
+
+    assert commands[0][commands[0].index("--al-gz") + 1] == mapped_path
+    assert mock_job.get_fastq_path("mapped") == mapped_path
+
+    mock_job.map_subtraction()
+
+    assert commands[1][commands[1].index("-U") + 1] == mapped_path
+    assert mock_job.intermediate["to_subtraction"] == {"read_2": 9.0}
+
+
+#: Canned ``bowtie2 -1 -2`` output for the isolate index. ``frag_1`` aligns as a concordant pair to two references,
+#: only the first mate of ``frag_2`` aligns and only the second mate of ``frag_3`` aligns.
+PAIRED_ISOLATE_SAM = [
+    make_sam_line("frag_1", 99, "NC_016509", 10, "ACGTACGTAC", -2, 60, 60),
+    make_sam_line("frag_1", 147, "NC_016509", 60, "GGGGCCCCAA", -3, 10, -60),
+    make_sam_line("frag_1", 355, "NC_001948", 15, "ACGTACGTAC", -4, 65, 60),
+    make_sam_line("frag_1", 403, "NC_001948", 65, "GGGGCCCCAA", -4, 15, -60),
+    make_sam_line("frag_2", 73, "NC_001948", 100, "TTTTACGTAC", 0),
+    make_sam_line("frag_2", 133, "NC_001948", 100, "CATGCATGCA", 0),
+    make_sam_line("frag_3", 69, "NC_016509", 200, "AAAACCCCGG", 0),
+    make_sam_line("frag_3", 137, "NC_016509", 200, "GTGTGTGTGT", -1)
+]
+
+
+def setup_paired_job(tmpdir, dbs, mocker, mock_job, sam_lines):
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": True,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    shutil.copyfile(FASTQ_PATH, os.path.join(str(tmpdir), "samples", "foobar", "reads_2.fq"))
+
+    mock_job.task_args["paired_mapping"] = True
+
+    mock_job.check_db()
+
+    assert mock_job.params["paired_mapping"]
+
+    mock_job.params["subtraction_path"] = HOST_PATH
+
+    os.makedirs(mock_job.params["analysis_path"], exist_ok=True)
+
+    commands = list()
+
+    def run_subprocess(command, stdout_handler=None):
+        commands.append(command)
+
+        for line in sam_lines:
+            stdout_handler(line)
+
+    mocker.patch.object(mock_job, "run_subprocess", side_effect=run_subprocess)
+
+    return commands
+
+
+def test_map_isolates_paired(tmpdir, dbs, mocker, mock_job):
+    """
+    Test that each mapped mate is written to the VTA file under the name of its pair, that mates of a concordant pair
+    share the summed score of the pair and that both mates of every pair are written to the mapped FASTQ files.
+
+    """
+    commands = setup_paired_job(tmpdir, dbs, mocker, mock_job, PAIRED_ISOLATE_SAM)
+
+    mock_job.map_isolates()
+
+    command = commands[0]
+
+    assert command[command.index("-1") + 1] == mock_job.params["read_paths"][0]
+    assert command[command.index("-2") + 1] == mock_job.params["read_paths"][1]
+
+    with open(os.path.join(mock_job.params["analysis_path"], "to_isolates.vta"), "r") as f:
+        assert f.read().splitlines() == [
+            "frag_1,NC_016509,10,10,15.0",
+            "frag_1,NC_016509,60,10,15.0",
+            "frag_1,NC_001948,15,10,12.0",
+            "frag_1,NC_001948,65,10,12.0",
+            "frag_2,NC_001948,100,10,10.0",
+            "frag_3,NC_016509,200,10,9.0"
+        ]
+
+    with open(mock_job.get_fastq_path("mapped.1"), "r") as f:
+        assert f.read() == (
+            "@frag_1\nACGTACGTAC\n+\nIIIIIIIIII\n"
+            "@frag_2\nTTTTACGTAC\n+\nIIIIIIIIII\n"
+            "@frag_3\nAAAACCCCGG\n+\nIIIIIIIIII\n"
+        )
+
+    # The second mate of frag_1 aligned to the reverse strand, so it is stored reverse-complemented in the SAM output.
+    with open(mock_job.get_fastq_path("mapped.2"), "r") as f:
+        assert f.read() == (
+            "@frag_1\nTTGGGGCCCC\n+\nIIIIIIIIII\n"
+            "@frag_2\nCATGCATGCA\n+\nIIIIIIIIII\n"
+            "@frag_3\nGTGTGTGTGT\n+\nIIIIIIIIII\n"
+        )
+
+
+def test_map_isolates_paired_read_count(tmpdir, dbs, mocker, mock_job):
+    """
+    Test that the read count reported by :meth:`pathoscope` counts fragments rather than mates after the read pairs
+    are mapped with :meth:`map_isolates_paired`.
+
+    """
+    setup_paired_job(tmpdir, dbs, mocker, mock_job, PAIRED_ISOLATE_SAM)
+
+    mock_job.map_isolates()
+
+    mock_job.intermediate.update({
+        "ref_lengths": {"NC_016509": 300, "NC_001948": 300},
+        "sequence_otu_map": {"NC_016509": "foobar", "NC_001948": "foobar"},
+        "otu_dict": {"foobar": {"name": "Foobar", "version": 10}}
+    })
+
+    mock_job.pathoscope()
+
+    assert mock_job.results["read_count"] == 3
+
+    with open(os.path.join(mock_job.params["analysis_path"], "reassigned.vta"), "r") as f:
+        lines = f.read().splitlines()
+
+    # Both mates of the concordant pair are kept for the reference it is reassigned to.
+    assert [line for line in lines if line.startswith("frag_1,")] in (
+        ["frag_1,NC_016509,10,10,15.0", "frag_1,NC_016509,60,10,15.0"],
+        ["frag_1,NC_001948,15,10,12.0", "frag_1,NC_001948,65,10,12.0"]
+    )
+
+
+def test_map_subtraction_paired(tmpdir, dbs, mocker, mock_job):
+    """
+    Test that the mapped read pairs are mapped to the subtraction host and that the best score of each pair is
+    recorded, whether both of its mates or only one of them aligned.
+
+    """
+    commands = setup_paired_job(tmpdir, dbs, mocker, mock_job, [
+        make_sam_line("frag_1", 99, "host", 10, "ACGTACGTAC", -2, 60, 60),
+        make_sam_line("frag_1", 147, "host", 60, "GGGGCCCCAA", -3, 10, -60),
+        make_sam_line("frag_2", 73, "host", 100, "TTTTACGTAC", -1),
+        make_sam_line("frag_2", 133, "host", 100, "CATGCATGCA", 0),
+        make_sam_line("frag_3", 77, "*", 0, "AAAACCCCGG", 0),
+        make_sam_line("frag_3", 141, "*", 0, "GTGTGTGTGT", 0)
+    ])
+
+    mock_job.map_subtraction()
+
+    command = commands[0]
+
+    assert command[command.index("-1") + 1] == mock_job.get_fastq_path("mapped.1")
+    assert command[command.index("-2") + 1] == mock_job.get_fastq_path("mapped.2")
+
+    assert mock_job.intermediate["to_subtraction"] == {
+        "frag_1": 15.0,
+        "frag_2": 9.0
+    }
+
+
 def test_subtract_mapping(dbs, mock_job):
     dbs.samples.insert_one({
         "_id": "foobar",
@@ -297,7 +927,10 @@ def test_subtract_mapping(dbs, mock_job):
     assert mock_job.results["subtracted_count"] == 4
 
 
-def test_pathoscope(dbs, mock_job):
+@pytest.mark.parametrize("otu_summary", [False, True])
+def test_pathoscope(otu_summary, dbs, mock_job):
+    mock_job.task_args["otu_summary"] = otu_summary
+
     dbs.samples.insert_one({
         "_id": "foobar",
         "paired": False,
@@ -378,6 +1011,20 @@ def test_pathoscope(dbs, mock_job):
         TSV_PATH
     )
 
+    if otu_summary:
+        otus = mock_job.results.pop("otus")
+
+        assert [otu["id"] for otu in otus] == ["foobar", "reo", "baz"]
+
+        for otu in otus:
+            hits = [hit for hit in mock_job.results["diagnosis"] if hit["id"] in otu["sequences"]]
+
+            assert {mock_job.intermediate["sequence_otu_map"][hit["id"]] for hit in hits} == {otu["id"]}
+            assert otu["reads"] == sum(hit["final"]["reads"] for hit in hits)
+            assert otu["length"] == sum(len(hit["align"]) for hit in hits)
+
+        assert sum(len(otu["sequences"]) for otu in otus) == len(mock_job.results["diagnosis"])
+
     with open(DIAGNOSIS_PATH, "r") as handle:
         assert mock_job.results == {
             "diagnosis": json.load(handle),
@@ -386,7 +1033,15 @@ def test_pathoscope(dbs, mock_job):
         }
 
 
-def test_import_results(dbs, mock_job):
+@pytest.mark.parametrize("settings", [
+    {},
+    {"db_shared_client": True},
+    {"db_shared_client": True, "db_batch_writes": True, "results_write_concern": {"w": 1, "j": False}}
+])
+def test_import_results(settings, dbs, mock_job):
+    mock_job.settings.update(settings)
+    mock_job.init_db()
+
     dbs.samples.insert_one({
         "_id": "foobar",
         "paired": False,
@@ -438,3 +1093,290 @@ def test_import_results(dbs, mock_job):
         },
         "paired": False
     }
+
+
+def test_shared_client(test_db_name, dbs, mocker, mock_job):
+    """
+    Test that two jobs in one process use the same client and that their analysis updates are sent in one batch when
+    the ``db_shared_client`` and ``db_batch_writes`` settings are true.
+
+    """
+    settings = dict(mock_job.settings, db_shared_client=True, db_batch_writes=True)
+
+    jobs = list()
+
+    for analysis_id in ["foo", "bar", "baz"]:
+        dbs.analyses.insert_one({"_id": analysis_id, "ready": False})
+
+        job = virtool.pathoscope.job.PathoscopeBowtie(
+            "mongodb://localhost:27017",
+            test_db_name,
+            settings,
+            "foobar",
+            mocker.Mock()
+        )
+
+        job.init_db()
+
+        job.params = {"analysis_id": analysis_id}
+
+        jobs.append(job)
+
+    client = virtool.pathoscope.db.get_client("mongodb://localhost:27017")
+
+    assert all(job.db.client is client for job in jobs)
+
+    collection_class = type(jobs[0].db.analyses)
+
+    bulk_write = collection_class.bulk_write
+
+    batches = list()
+
+    release = threading.Event()
+
+    def delayed_bulk_write(collection, requests, *args, **kwargs):
+        batches.append(sorted(request._filter["_id"] for request in requests))
+
+        # Hold the first batch so the updates from the other two jobs are queued behind it.
+        if len(batches) == 1:
+            release.wait(10)
+
+        return bulk_write(collection, requests, *args, **kwargs)
+
+    mocker.patch.object(collection_class, "bulk_write", delayed_bulk_write)
+
+    writer = virtool.pathoscope.db.get_bulk_writer(
+        "mongodb://localhost:27017",
+        jobs[0].db.analyses.with_options(write_concern=virtool.pathoscope.db.get_write_concern(settings))
+    )
+
+    threads = [threading.Thread(target=job.update_analysis, args=({"$set": {"ready": True}},)) for job in jobs]
+
+    threads[0].start()
+
+    while not batches:
+        time.sleep(0.01)
+
+    for thread in threads[1:]:
+        thread.start()
+
+    while len(writer._pending) < 2:
+        time.sleep(0.01)
+
+    release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert batches == [["foo"], ["bar", "baz"]]
+
+    assert all(document["ready"] for document in dbs.analyses.find())
+
+
+def test_import_results_coverage_file(dbs, mock_job):
+    """
+    Test that coverage lists are moved to ``coverage.bin`` when the ``coverage_file`` param is set.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.check_db()
+
+    mock_job.params["coverage_file"] = True
+
+    os.makedirs(mock_job.params["analysis_path"])
+
+    dbs.analyses.insert_one({
+        "_id": "baz",
+        "algorithm": "pathoscope_bowtie",
+        "ready": False,
+        "sample": {
+            "id": "foobar"
+        }
+    })
+
+    with open(DIAGNOSIS_PATH, "r") as handle:
+        diagnosis = json.load(handle)
+
+    mock_job.results = {
+        "diagnosis": diagnosis,
+        "read_count": 1337,
+        "ready": True
+    }
+
+    mock_job.import_results()
+
+    document = dbs.analyses.find_one()
+
+    assert all(hit["align"] == "file" for hit in document["diagnosis"])
+
+    coverage = virtool.pathoscope.utils.read_coverage(
+        os.path.join(mock_job.params["analysis_path"], "coverage.bin")
+    )
+
+    assert coverage == {hit["id"]: hit["align"] for hit in diagnosis}
+
+
+def test_import_results_too_large(mocker, dbs, mock_job):
+    """
+    Test that results too large for a single document are written to ``pathoscope.json`` with their full coverage
+    lists when neither coverage param is set.
+
+    """
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.check_db()
+
+    os.makedirs(mock_job.params["analysis_path"])
+
+    with open(DIAGNOSIS_PATH, "r") as handle:
+        diagnosis = json.load(handle)
+
+    mock_job.results = {
+        "diagnosis": diagnosis,
+        "read_count": 1337,
+        "ready": True
+    }
+
+    mocker.patch.object(mock_job, "update_analysis", side_effect=[pymongo.errors.DocumentTooLarge("Too large"), None])
+    mocker.patch.object(mock_job, "dispatch")
+
+    mock_job.import_results()
+
+    assert mock_job.update_analysis.call_args[0][0] == {
+        "$set": {
+            "diagnosis": "file",
+            "ready": True
+        }
+    }
+
+    assert not os.path.isfile(os.path.join(mock_job.params["analysis_path"], "coverage.bin"))
+
+    path = os.path.join(mock_job.params["analysis_path"], "pathoscope.json")
+
+    with open(path, "r") as f:
+        assert json.load(f) == mock_job.results
+
+    assert virtool.pathoscope.utils.read_hit(path, diagnosis[0]["id"]) == diagnosis[0]
+
+
+def insert_warm_start_sample(dbs, mock_job):
+    dbs.samples.insert_one({
+        "_id": "foobar",
+        "paired": False,
+        "subtraction": {
+            "id": "Arabidopsis thaliana"
+        },
+        "quality": {
+            "count": 1337
+        }
+    })
+
+    mock_job.check_db()
+
+
+def test_get_warm_start_em_json(dbs, mock_job):
+    """
+    Test that the starting values are loaded from the ``em.json`` file of the previous analysis.
+
+    """
+    insert_warm_start_sample(dbs, mock_job)
+
+    mock_job.params["warm_start_analysis_id"] = "previous"
+
+    values = {
+        "pi": {"NC_016509": 0.75, "NC_001948": 0.25},
+        "theta": {"NC_016509": 0.5, "NC_001948": 0.5}
+    }
+
+    path = virtool.pathoscope.utils.get_em_json_path(mock_job.settings["data_path"], "previous", "foobar")
+
+    os.makedirs(os.path.dirname(path))
+
+    with open(path, "w") as f:
+        json.dump(values, f)
+
+    assert mock_job.get_warm_start() == values
+
+
+@pytest.mark.parametrize("in_file", [False, True])
+def test_get_warm_start_diagnosis(in_file, dbs, mock_job):
+    """
+    Test that the final pi values in the diagnosis of the previous analysis are used when it has no ``em.json`` file,
+    whether the diagnosis is stored in the analysis document or in ``pathoscope.json``.
+
+    """
+    insert_warm_start_sample(dbs, mock_job)
+
+    mock_job.params["warm_start_analysis_id"] = "previous"
+
+    with open(DIAGNOSIS_PATH, "r") as handle:
+        diagnosis = json.load(handle)
+
+    document = {
+        "_id": "previous",
+        "algorithm": "pathoscope_bowtie",
+        "ready": True,
+        "sample": {
+            "id": "foobar"
+        },
+        "diagnosis": diagnosis
+    }
+
+    if in_file:
+        path = virtool.pathoscope.utils.get_pathoscope_json_path(mock_job.settings["data_path"], "previous", "foobar")
+
+        os.makedirs(os.path.dirname(path))
+
+        virtool.pathoscope.utils.write_results(path, {"diagnosis": diagnosis})
+
+        document["diagnosis"] = "file"
+
+    dbs.analyses.insert_one(document)
+
+    assert mock_job.get_warm_start() == {
+        "pi": {hit["id"]: hit["final"]["pi"] for hit in diagnosis}
+    }
+
+
+@pytest.mark.parametrize("document", [
+    None,
+    {"_id": "previous", "ready": True, "sample": {"id": "other"}, "diagnosis": [{"id": "foo", "final": {"pi": 1}}]},
+    {"_id": "previous", "ready": False, "sample": {"id": "foobar"}}
+], ids=["missing", "other_sample", "not_ready"])
+def test_get_warm_start_unavailable(document, dbs, mock_job):
+    """
+    Test that no starting values are returned when the previous analysis does not exist, belongs to another sample or
+    has no diagnosis yet.
+
+    """
+    insert_warm_start_sample(dbs, mock_job)
+
+    mock_job.params["warm_start_analysis_id"] = "previous"
+
+    if document is not None:
+        dbs.analyses.insert_one(document)
+
+    assert mock_job.get_warm_start() is None
+
+    mock_job.params["warm_start_analysis_id"] = None
+
+    assert mock_job.get_warm_start() is None
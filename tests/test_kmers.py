@@ -0,0 +1,104 @@
+import os
+import random
+
+import pytest
+
+import virtool.pathoscope.kmers as kmers
+
+
+def random_sequence(length, rng):
+    return "".join(rng.choice("ACGT") for _ in range(length)).encode()
+
+
+def reverse_complement(sequence):
+    return sequence.translate(bytes.maketrans(b"ACGT", b"TGCA"))[::-1]
+
+
+@pytest.fixture
+def reference():
+    return random_sequence(2000, random.Random(1))
+
+
+@pytest.mark.parametrize("k", [1, 11, 21])
+@pytest.mark.parametrize("sample", [1, 4])
+def test_sampled_kmers(k, sample):
+    """
+    Test that sampled canonical k-mers match a naive implementation and that k-mers spanning an ``N`` are skipped.
+
+    """
+    rng = random.Random(2)
+
+    sequence = random_sequence(60, rng) + b"N" + random_sequence(40, rng)
+
+    expected_positions = list()
+    expected_hashes = list()
+
+    for i in range(len(sequence) - k + 1):
+        kmer = sequence[i:i + k]
+
+        if b"N" in kmer:
+            continue
+
+        codes = [
+            int("".join(str("ACGT".index(chr(base))) for base in strand), 4)
+            for strand in (kmer, reverse_complement(kmer))
+        ]
+
+        kmer_hash = int(kmers.hash_codes(kmers.np.array([min(codes)], dtype=kmers.np.uint64))[0])
+
+        if kmer_hash % sample == 0:
+            expected_positions.append(i)
+            expected_hashes.append(kmer_hash)
+
+    positions, hashes = kmers.sampled_kmers(sequence, k, sample)
+
+    assert positions.tolist() == expected_positions
+    assert hashes.tolist() == expected_hashes
+
+
+def test_match_reads(reference):
+    sketch = kmers.KmerSketch.build([reference])
+
+    reads = [
+        reference[100:200],
+        reverse_complement(reference[500:600]),
+        random_sequence(100, random.Random(3)),
+        b"ACGT"
+    ]
+
+    assert sketch.match_reads(reads).tolist() == [True, True, False, False]
+
+
+def test_contains():
+    hashes = kmers.np.array([5, 2 ** 63 + 7, 2 ** 64 - 9], dtype=kmers.np.uint64)
+
+    sketch = kmers.KmerSketch(hashes)
+
+    queries = kmers.np.array([5, 6, 2 ** 63 + 7, 2 ** 63 + 8, 2 ** 64 - 9, 2 ** 64 - 1], dtype=kmers.np.uint64)
+
+    assert sketch.contains(queries).tolist() == [True, False, True, False, True, False]
+
+
+def test_filter_fastq(tmpdir, reference):
+    sketch_path = os.path.join(str(tmpdir), "reference.kmers.npz")
+
+    kmers.KmerSketch.build([reference]).save(sketch_path)
+
+    sketch = kmers.KmerSketch.load(sketch_path)
+
+    rng = random.Random(4)
+
+    sequences = [reference[i:i + 80] if i % 2 else random_sequence(80, rng) for i in range(10)]
+
+    read_path = os.path.join(str(tmpdir), "reads_1.fastq")
+
+    with open(read_path, "wb") as f:
+        for i, sequence in enumerate(sequences):
+            f.write(b"@read_" + str(i).encode() + b"\n" + sequence + b"\n+\n" + b"I" * 80 + b"\n")
+
+    output_path = os.path.join(str(tmpdir), "prefiltered.fastq")
+
+    assert kmers.filter_fastq(sketch, [read_path], output_path, batch_size=3) == (10, 5)
+
+    with open(output_path, "r") as f:
+        assert [line.rstrip() for line in f][::4] == ["@read_1", "@read_3", "@read_5", "@read_7", "@read_9"]
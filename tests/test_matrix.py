@@ -0,0 +1,292 @@
+import os
+import sys
+import pytest
+import pickle
+import shutil
+import filecmp
+
+import numpy as np
+
+import virtool.pathoscope.matrix as matrix
+import virtool.pathoscope.pathoscope as pathoscope
+
+BEST_HIT_PATH = os.path.join(sys.path[0], "tests", "test_files", "best_hit")
+UPDATED_VTA_PATH = os.path.join(sys.path[0], "tests", "test_files", "updated.vta")
+VTA_PATH = os.path.join(sys.path[0], "tests", "test_files", "test.vta")
+
+
+@pytest.fixture
+def vta_path(tmpdir):
+    shutil.copy(VTA_PATH, str(tmpdir))
+    return os.path.join(str(tmpdir), "test.vta")
+
+
+def test_from_dicts(vta_path):
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    read_matrix = matrix.ReadMatrix.from_dicts(u, nu, len(refs), shard_size=100)
+
+    assert read_matrix.ref_count == len(refs)
+    assert read_matrix.nu_count == len(nu)
+    assert read_matrix.nnz == len(u) + sum(len(nu[j][0]) for j in nu)
+
+    assert all(len(shard.rows) <= 100 for shard in read_matrix.shards)
+
+    shard = read_matrix.shards[0]
+    read_index = int(shard.rows[0])
+
+    assert shard.indices[shard.indptr[0]:shard.indptr[1]].tolist() == nu[read_index][0]
+    assert shard.scores[shard.indptr[0]:shard.indptr[1]].tolist() == nu[read_index][1]
+    assert shard.weights[0] == nu[read_index][3]
+
+
+def test_em_profiler(vta_path):
+    """
+    Test that the sharded EM reports the same change in pi for each iteration as the reference implementation.
+
+    """
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    read_matrix = matrix.ReadMatrix.from_dicts(u, nu, len(refs), shard_size=100)
+
+    expected = list()
+    observed = list()
+
+    pathoscope.em(u, nu, refs, 50, 1e-7, 0, 0, profiler=lambda event, info: expected.append(info["delta"]))
+
+    matrix.em(read_matrix, 50, 1e-7, 0, 0, threads=2, profiler=lambda event, info: observed.append(info["delta"]))
+
+    assert len(observed) == len(expected)
+    assert observed == pytest.approx(expected, rel=1e-6, abs=1e-12)
+
+
+@pytest.mark.parametrize("pi_prior,theta_prior", [(0, 0), (0.5, 0.1)])
+def test_em_log_likelihood(pi_prior, theta_prior, vta_path):
+    """
+    Test that the sharded EM tracks the same log-likelihood as the reference implementation, with and without priors.
+
+    """
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    read_matrix = matrix.ReadMatrix.from_dicts(u, nu, len(refs), shard_size=100)
+
+    expected = pathoscope.em(u, nu, refs, 50, 1e-7, pi_prior, theta_prior, return_log_likelihood=True)[4]
+
+    log_likelihoods = matrix.em(
+        read_matrix,
+        50,
+        1e-7,
+        pi_prior,
+        theta_prior,
+        threads=2,
+        return_log_likelihood=True
+    )[4]
+
+    assert log_likelihoods == pytest.approx(expected, rel=1e-9)
+
+
+@pytest.mark.parametrize("theta_prior", [0, 1e-5])
+@pytest.mark.parametrize("pi_prior", [0, 1e-5])
+@pytest.mark.parametrize("max_iter", [5, 30])
+def test_em(max_iter, pi_prior, theta_prior, vta_path):
+    """
+    Test that the sharded EM gives the same estimates as :func:`virtool.pathoscope.pathoscope.em`.
+
+    """
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    read_matrix = matrix.ReadMatrix.from_dicts(u, nu, len(refs), shard_size=100)
+
+    init_pi, pi, theta, x_norms = matrix.em(read_matrix, max_iter, 1e-7, pi_prior, theta_prior, threads=4)
+
+    expected_init_pi, expected_pi, expected_theta, expected_nu = pathoscope.em(
+        u,
+        nu,
+        refs,
+        max_iter,
+        1e-7,
+        pi_prior,
+        theta_prior
+    )
+
+    assert np.allclose(init_pi, expected_init_pi, rtol=0, atol=1e-12)
+    assert np.allclose(pi, expected_pi, rtol=0, atol=1e-12)
+    assert np.allclose(theta, expected_theta, rtol=0, atol=1e-12)
+
+    read_matrix.update_nu(nu, x_norms)
+
+    for read_index in nu:
+        assert np.allclose(nu[read_index][2], expected_nu[read_index][2], rtol=0, atol=1e-12)
+
+
+def test_em_deterministic(vta_path):
+    """
+    Test that the thread count does not change the result.
+
+    """
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    read_matrix = matrix.ReadMatrix.from_dicts(u, nu, len(refs), shard_size=100)
+
+    results = list()
+
+    for threads in (1, 2, 7):
+        init_pi, pi, theta, x_norms = matrix.em(read_matrix, 30, 1e-7, 0, 0, threads=threads)
+        results.append((init_pi, pi, theta, [x_norm.copy() for x_norm in x_norms]))
+
+    for init_pi, pi, theta, x_norms in results[1:]:
+        assert (init_pi == results[0][0]).all()
+        assert (pi == results[0][1]).all()
+        assert (theta == results[0][2]).all()
+        assert all((a == b).all() for a, b in zip(x_norms, results[0][3]))
+
+
+@pytest.mark.parametrize("memory_budget", [2 ** 20, 2 ** 30], ids=["many_chunks", "one_chunk"])
+def test_build_chunked(memory_budget, tmpdir, vta_path):
+    """
+    Test that the out of core matrix holds the same reads as the one built by
+    :func:`virtool.pathoscope.pathoscope.build_matrix`.
+
+    """
+    read_matrix, refs, read_count = matrix.build_chunked(
+        vta_path,
+        os.path.join(str(tmpdir), "matrix"),
+        0.01,
+        memory_budget=memory_budget,
+        threads=2
+    )
+
+    u, nu, expected_refs, reads = pathoscope.build_matrix(vta_path, 0.01)
+
+    assert refs == expected_refs
+    assert read_count == len(reads)
+    assert read_matrix.nu_count == len(nu)
+    assert read_matrix.nnz == len(u) + sum(len(nu[j][0]) for j in nu)
+
+    assert (read_matrix.chunk_count > 1) == (memory_budget == 2 ** 20)
+
+    pi_sum_0, u_total, max_u_weights = read_matrix.unique_summary()
+
+    assert u_total == pytest.approx(sum(u[i][1] for i in u))
+    assert max_u_weights == max(u[i][1] for i in u)
+
+    shards = [read_matrix.shards[j] for j in range(read_matrix.chunk_count)]
+
+    for shard in shards:
+        for i, read_index in enumerate(shard.rows):
+            start, end = shard.indptr[i], shard.indptr[i + 1]
+
+            assert shard.indices[start:end].tolist() == nu[read_index][0]
+            assert np.allclose(shard.scores[start:end], nu[read_index][1], rtol=1e-12, atol=0)
+            assert shard.weights[i] == pytest.approx(nu[read_index][3], rel=1e-12)
+
+
+def test_chunked_reassignment(tmpdir, vta_path):
+    """
+    Test that out of core best hit calculation, EM and rewriting give the same results as the in-memory functions in
+    :mod:`virtool.pathoscope.pathoscope`.
+
+    """
+    read_matrix, refs, read_count = matrix.build_chunked(
+        vta_path,
+        os.path.join(str(tmpdir), "matrix"),
+        0.01,
+        memory_budget=2 ** 20,
+        threads=2
+    )
+
+    with open(BEST_HIT_PATH, "rb") as handle:
+        assert matrix.compute_best_hit(read_matrix, read_count) == pickle.load(handle)
+
+    u, nu, _, reads = pathoscope.build_matrix(vta_path, 0.01)
+
+    init_pi, pi, theta, _ = matrix.em(read_matrix, 30, 1e-7, 0, 0, threads=2)
+
+    expected_init_pi, expected_pi, expected_theta, nu = pathoscope.em(u, nu, refs, 30, 1e-7, 0, 0)
+
+    assert np.allclose(init_pi, expected_init_pi, rtol=0, atol=1e-12)
+    assert np.allclose(pi, expected_pi, rtol=0, atol=1e-12)
+    assert np.allclose(theta, expected_theta, rtol=0, atol=1e-12)
+
+    assert matrix.compute_best_hit(read_matrix, read_count) == pathoscope.compute_best_hit(u, nu, refs, reads)
+
+    rewrite_path = os.path.join(str(tmpdir), "rewrite.vta")
+
+    matrix.rewrite_align(read_matrix, vta_path, 0.01, rewrite_path)
+
+    assert filecmp.cmp(UPDATED_VTA_PATH, rewrite_path)
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_em_prune(chunked, tmpdir, vta_path):
+    """
+    Test that pruning removes entries for negligible references without noticeably changing the estimates and that
+    pruned entries end up with a normalized score of zero.
+
+    """
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    if chunked:
+        read_matrix, _, _ = matrix.build_chunked(vta_path, os.path.join(str(tmpdir), "matrix"), memory_budget=2 ** 20)
+    else:
+        read_matrix = matrix.ReadMatrix.from_dicts(u, nu, len(refs), shard_size=100)
+
+    _, expected_pi, _, _ = pathoscope.em(u, nu, refs, 50, 1e-7, 0, 0)
+
+    _, pi, _, x_norms = matrix.em(read_matrix, 50, 1e-7, 0, 0, threads=2, prune_threshold=1e-6)
+
+    assert np.allclose(pi, expected_pi, rtol=0, atol=1e-6)
+
+    shard_count = len(read_matrix.shards)
+
+    active = [read_matrix.active_shard(j) for j in range(shard_count)]
+
+    assert sum(len(shard.indices) for shard, _ in active) < sum(len(shard.indices) for shard in read_matrix.shards)
+
+    for j, (shard, positions) in enumerate(active):
+        if positions is not None:
+            pruned = np.ones(len(read_matrix.shards[j].indices), dtype=bool)
+            pruned[positions] = False
+
+            assert (np.asarray(x_norms[j])[pruned] == 0).all()
+
+            # Each read keeps at least one entry.
+            assert (np.diff(shard.indptr) > 0).all()
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_rewrite_align_paired(chunked, tmpdir):
+    """
+    Test that both mates of unique fragments are kept when rewriting a VTA file from paired mapping, and that
+    fragments are still counted once in the matrix.
+
+    """
+    vta_path = os.path.join(str(tmpdir), "paired.vta")
+    rewrite_path = os.path.join(str(tmpdir), "rewrite.vta")
+
+    lines = [
+        "frag_1,foo,1,100,0.5\n",
+        "frag_1,foo,181,100,0.5\n",
+        "frag_2,foo,11,100,0.25\n",
+        "frag_2,foo,191,100,0.25\n",
+        "frag_2,bar,11,100,0.0001\n",
+        "frag_2,bar,191,100,0.0001\n"
+    ]
+
+    with open(vta_path, "w") as f:
+        f.writelines(lines)
+
+    u, nu, refs, reads, index = pathoscope.build_matrix(vta_path, 0.01, return_index=True)
+
+    assert len(reads) == 2
+
+    if chunked:
+        read_matrix, _, _ = matrix.build_chunked(vta_path, os.path.join(str(tmpdir), "matrix"), memory_budget=2 ** 20)
+        matrix.em(read_matrix, 30, 1e-7, 0, 0)
+        matrix.rewrite_align(read_matrix, vta_path, 0.01, rewrite_path, paired=True)
+    else:
+        _, _, _, nu = pathoscope.em(u, nu, refs, 30, 1e-7, 0, 0)
+        pathoscope.rewrite_align(u, nu, vta_path, 0.01, rewrite_path, index=index, paired=True)
+
+    with open(rewrite_path) as f:
+        assert f.readlines() == lines[:4]
@@ -5,7 +5,9 @@ import shutil
 import pickle
 import filecmp
 
+import virtool.pathoscope.convergence as convergence
 import virtool.pathoscope.pathoscope as pathoscope
+import virtool.pathoscope.vta as vta
 
 BEST_HIT_PATH = os.path.join(sys.path[0], "tests", "test_files", "best_hit")
 EM_PATH = os.path.join(sys.path[0], "tests", "test_files", "em")
@@ -38,6 +40,80 @@ def test_find_sam_align_score(sam_line, expected_scores):
     assert pathoscope.find_sam_align_score(sam_line) == expected_scores["".join(sam_line)]
 
 
+def test_sam_read_context():
+    """
+    Test that the read length is reused for repeated alignments of a read, including secondary alignments that do not
+    carry the read sequence, and that the first record with a sequence is flagged.
+
+    """
+    context = pathoscope.SamReadContext()
+
+    records = [
+        (["read_1", "0", "foo", "1", "42", "6M", "*", "0", "0", "AACGTN", "ABCDEF", "AS:i:-2"], 6, True),
+        (["read_1", "256", "bar", "1", "1", "6M", "*", "0", "0", "*", "*", "AS:i:-4"], 6, False),
+        (["read_2", "256", "bar", "1", "1", "2S3M1I", "*", "0", "0", "*", "*", "AS:i:-4"], 6, False),
+        (["read_2", "0", "foo", "1", "42", "4M", "*", "0", "0", "AACG", "ABCD", "AS:i:0"], 4, True),
+        (["read_2", "256", "baz", "1", "1", "4M", "*", "0", "0", "AACG", "ABCD", "AS:i:-1"], 4, False)
+    ]
+
+    for fields, read_length, new_sequence in records:
+        assert context.update(fields) == read_length
+        assert context.new_sequence == new_sequence
+
+    assert pathoscope.find_sam_align_score(records[1][0], 6) == 2.0
+
+
+def test_sam_pair_context():
+    """
+    Test that the records of a paired alignment are joined, that mates mapped on their own are returned alone and that
+    mates of a pair on the same reference are given the sum of their scores.
+
+    """
+    context = pathoscope.SamPairContext()
+
+    first = ["frag_1", "99", "foo", "1", "42", "4M", "=", "9", "12", "AACG", "ABCD", "AS:i:-2"]
+    second = ["frag_1", "147", "foo", "9", "42", "4M", "=", "1", "-12", "CGTT", "ABCD", "AS:i:0"]
+    single = ["frag_2", "73", "bar", "1", "42", "4M", "=", "1", "0", "AACG", "ABCD", "AS:i:0"]
+    unmapped = ["frag_2", "133", "bar", "1", "0", "*", "=", "1", "0", "CGTT", "ABCD", "YT:Z:UP"]
+    last = ["frag_3", "89", "baz", "1", "42", "4M", "*", "0", "0", "AACG", "ABCD", "AS:i:0"]
+
+    assert context.update(first) is None
+
+    records = context.update(second)
+
+    assert [(mate, fields) for mate, fields, _, _ in records] == [(0, first), (1, second)]
+
+    assert pathoscope.score_pair(records) == [
+        (first, 4, pathoscope.find_sam_align_score(first) + pathoscope.find_sam_align_score(second)),
+        (second, 4, pathoscope.find_sam_align_score(first) + pathoscope.find_sam_align_score(second))
+    ]
+
+    assert context.update(single) is None
+
+    records = context.update(unmapped)
+
+    assert pathoscope.score_pair(records) == [(single, 4, pathoscope.find_sam_align_score(single))]
+
+    assert context.update(last) is None
+    assert [fields for _, fields, _, _ in context.flush()] == [last]
+    assert context.flush() is None
+
+
+@pytest.mark.parametrize("flag,expected", [
+    ("0", "@7\nAACGTN\n+\nABCDEF\n"),
+    ("16", "@7\nNACGTT\n+\nFEDCBA\n")
+])
+def test_sam_to_fastq(flag, expected):
+    """
+    Test that SAM records are formatted as FASTQ and that reverse strand reads are restored to their original
+    orientation.
+
+    """
+    fields = ["read_1", flag, "NC_016509", "1", "42", "6M", "*", "0", "0", "AACGTN", "ABCDEF", "AS:i:-2"]
+
+    assert pathoscope.sam_to_fastq(fields, "7") == expected
+
+
 def test_build_matrix(tmpdir):
     shutil.copy(VTA_PATH, str(tmpdir))
     vta_path = os.path.join(str(tmpdir), "test.vta")
@@ -63,6 +139,145 @@ def test_em(tmpdir, theta_prior, pi_prior, epsilon, max_iter, expected_em):
     assert result == expected_em[file_string]
 
 
+def test_map_start_values():
+    """
+    Test that starting values are put in matrix order, that missing and zero values are floored and that the result
+    is normalized.
+
+    """
+    start = pathoscope.map_start_values({"foo": 0.6, "bar": 0.2, "baz": 0, "old": 0.2}, ["bar", "foo", "baz", "new"])
+
+    assert start == pytest.approx([0.2 / 1.2, 0.6 / 1.2, 0.2 / 1.2, 0.2 / 1.2])
+
+
+def test_em_profiler(tmpdir):
+    """
+    Test that each EM iteration is reported to the profiler and that profiling does not change the estimates.
+
+    """
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    expected = pathoscope.em(u, nu, refs, 50, 1e-7, 0, 0)[:3]
+
+    events = list()
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    observed = pathoscope.em(u, nu, refs, 50, 1e-7, 0, 0, profiler=lambda event, info: events.append((event, info)))
+
+    assert observed[:3] == expected
+
+    assert {event for event, _ in events} == {"em_iteration"}
+    assert [info["iteration"] for _, info in events] == list(range(len(events)))
+    assert all(info["delta"] > 1e-7 for _, info in events[:-1])
+    assert events[-1][1]["delta"] <= 1e-7
+    assert all(info["duration"] >= 0 for _, info in events)
+
+
+@pytest.mark.parametrize("stopping", [None, "max_change", "relative_likelihood_change"])
+def test_em_stopping(stopping, tmpdir):
+    """
+    Test that the log-likelihood is returned for each iteration, that it does not change the default estimates, and
+    that stopping policies end EM once they are met.
+
+    """
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    expected = pathoscope.em(u, nu, refs, 50, 1e-7, 0, 0)
+
+    policies = None
+
+    if stopping:
+        policies = convergence.get_policies({stopping: 1e-9})
+
+    iterations = list()
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    init_pi, pi, theta, nu, log_likelihoods = pathoscope.em(
+        u,
+        nu,
+        refs,
+        50,
+        1e-7,
+        0,
+        0,
+        profiler=lambda event, info: iterations.append(info),
+        stopping=policies,
+        return_log_likelihood=True
+    )
+
+    assert len(log_likelihoods) == len(iterations)
+    assert [info["log_likelihood"] for info in iterations] == log_likelihoods
+
+    if stopping is None:
+        assert (init_pi, pi, theta) == expected[:3]
+    elif stopping == "max_change":
+        assert pi == pytest.approx(expected[1], abs=1e-6)
+    else:
+        previous, last = log_likelihoods[-2:]
+        assert abs((last - previous) / previous) <= 1e-9
+
+    assert 0 < len(log_likelihoods) < 50
+
+
+@pytest.mark.parametrize("pi_prior,theta_prior", [(0, 0), (0.5, 0.1)])
+def test_em_log_likelihood(pi_prior, theta_prior, tmpdir):
+    """
+    Test that the tracked log-likelihood never decreases between iterations, with and without priors.
+
+    """
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    log_likelihoods = pathoscope.em(u, nu, refs, 50, 1e-12, pi_prior, theta_prior, return_log_likelihood=True)[4]
+
+    assert len(log_likelihoods) > 2
+
+    for previous, current in zip(log_likelihoods, log_likelihoods[1:]):
+        assert current >= previous - abs(previous) * 1e-12
+
+
+def test_em_warm_start(tmpdir):
+    """
+    Test that EM started from converged estimates is already converged after one iteration and does much better than a
+    cold start with the same number of iterations.
+
+    """
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    _, pi, theta, _ = pathoscope.em(u, nu, refs, 50, 1e-7, 0, 0)
+
+    # Reverse the previous estimates so they have to be mapped back onto the matrix order.
+    start_pi = pathoscope.map_start_values(dict(zip(reversed(refs), reversed(pi))), refs)
+    start_theta = pathoscope.map_start_values(dict(zip(reversed(refs), reversed(theta))), refs)
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    _, warm_pi, _, _ = pathoscope.em(u, nu, refs, 1, 1e-7, 0, 0, start_pi, start_theta)
+
+    u, nu, refs, _ = pathoscope.build_matrix(vta_path, 0.01)
+
+    _, cold_pi, _, _ = pathoscope.em(u, nu, refs, 1, 1e-7, 0, 0)
+
+    warm_delta = sum(abs(a - b) for a, b in zip(warm_pi, pi))
+    cold_delta = sum(abs(a - b) for a, b in zip(cold_pi, pi))
+
+    assert warm_delta < 1e-6
+    assert warm_delta < cold_delta / 100
+
+
 def test_compute_best_hit():
     """
     Test that :meth:`compute_best_hit` gives the expected result given some input data.
@@ -75,7 +290,86 @@ def test_compute_best_hit():
         assert pickle.load(handle) == pathoscope.compute_best_hit(*matrix_tuple)
 
 
-def test_rewrite_align(tmpdir):
+def test_build_matrix_index(tmpdir):
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    u, nu, refs, reads, index = pathoscope.build_matrix(vta_path, 0.01, return_index=True)
+
+    with open(MATRIX_PATH, "rb") as handle:
+        assert pickle.load(handle) == (u, nu, refs, reads)
+
+    with open(vta_path, "r") as handle:
+        lines = handle.readlines()
+
+    assert len(index.rows) == len(index.slots) == len(index.first) == len(lines)
+
+    # Every read's first line is flagged and the first line of each matrix row always points at its first reference.
+    assert index.first.sum() == len(reads)
+    assert (index.slots[index.first] == 0).all()
+
+    for line, row, slot in zip(lines, index.rows, index.slots):
+        read_id, ref_id = line.split(",")[:2]
+
+        assert reads[row] == read_id
+
+        if row in nu:
+            assert refs[nu[row][0][slot]] == ref_id
+        else:
+            assert refs[u[row][0]] == ref_id
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_build_matrix_grouped(processes, tmpdir):
+    """
+    Test that the grouped implementation builds the same matrices, in the same order, and the same index as
+    :func:`build_matrix` when each read's alignments are contiguous, whether the file is parsed serially or in
+    parallel.
+
+    """
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    u, nu, refs, reads, index = pathoscope.build_matrix(vta_path, 0.01, return_index=True)
+
+    grouped = pathoscope.build_matrix(vta_path, 0.01, return_index=True, grouped=True, processes=processes)
+
+    assert list(grouped[0].items()) == list(u.items())
+    assert list(grouped[1].items()) == list(nu.items())
+    assert grouped[2] == refs
+    assert grouped[3] == range(len(reads))
+
+    for observed, expected in zip(grouped[4], index):
+        assert (observed == expected).all()
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_build_matrix_not_grouped(processes, tmpdir):
+    """
+    Test that a file whose reads are not contiguous is detected when ``grouped`` is set and that the matrices are then
+    built without grouping.
+
+    """
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    with open(vta_path, "w") as f:
+        f.write("read_1,ref_1,1,10,0.5\nread_2,ref_1,5,10,0.5\nread_3,ref_2,9,10,0.5\nread_1,ref_2,3,10,0.25\n")
+
+    if processes == 1:
+        with pytest.raises(vta.NotGroupedError):
+            pathoscope.build_matrix_grouped(vta_path, 0.01)
+
+    with pytest.warns(RuntimeWarning):
+        grouped = pathoscope.build_matrix(vta_path, 0.01, return_index=True, grouped=True, processes=processes)
+
+    expected = pathoscope.build_matrix(vta_path, 0.01, return_index=True)
+
+    assert grouped[:4] == expected[:4]
+    assert list(grouped[1]) == [0]
+
+
+@pytest.mark.parametrize("with_index", [False, True])
+def test_rewrite_align(with_index, tmpdir):
     with open(UNU_PATH, "rb") as f:
         u, nu = pickle.load(f)
 
@@ -84,12 +378,65 @@ def test_rewrite_align(tmpdir):
 
     rewrite_path = os.path.join(str(tmpdir), "rewrite.vta")
 
-    pathoscope.rewrite_align(u, nu, vta_path, 0.01, rewrite_path)
+    index = None
+
+    if with_index:
+        index = pathoscope.build_matrix(vta_path, 0.01, return_index=True)[4]
+
+    pathoscope.rewrite_align(u, nu, vta_path, 0.01, rewrite_path, index=index)
 
     assert filecmp.cmp(UPDATED_VTA_PATH, rewrite_path)
     assert not filecmp.cmp(vta_path, rewrite_path)
 
 
+@pytest.mark.parametrize("processes", [1, 3])
+@pytest.mark.parametrize("interned", [False, True])
+def test_subtract(interned, processes, tmpdir):
+    """
+    Test that reads with a host score at least as high as their best isolate score are removed from the VTA file with
+    both named and interned read ids, whether the file is processed serially or in parallel.
+
+    """
+    with open(VTA_PATH, "r") as handle:
+        lines = [line.rstrip().split(",") for line in handle]
+
+    read_ids = dict()
+
+    for fields in lines:
+        read_ids.setdefault(fields[0], len(read_ids))
+
+    # Subtract the first read and keep the second.
+    host_scores = {
+        lines[0][0]: 1000.0,
+        lines[1][0]: 1.0
+    }
+
+    read_count = None
+
+    if interned:
+        lines = [[str(read_ids[fields[0]])] + fields[1:] for fields in lines]
+        host_scores = {read_ids[read_id]: score for read_id, score in host_scores.items()}
+        read_count = len(read_ids)
+
+    vta_path = os.path.join(str(tmpdir), "to_isolates.vta")
+
+    with open(vta_path, "w") as handle:
+        handle.writelines(",".join(fields) + "\n" for fields in lines)
+
+    subtracted_count = pathoscope.subtract(str(tmpdir), host_scores, read_count, processes)
+
+    with open(vta_path, "r") as handle:
+        remaining = [line.rstrip().split(",") for line in handle]
+
+    subtracted_id = lines[0][0]
+
+    assert remaining == [fields for fields in lines if fields[0] != subtracted_id]
+
+    assert subtracted_count == len([fields for fields in lines if fields[0] == subtracted_id])
+    assert len(remaining) == len(lines) - subtracted_count
+    assert subtracted_id not in {fields[0] for fields in remaining}
+
+
 def test_calculate_coverage(tmpdir, test_sam_path):
     ref_lengths = dict()
 
@@ -116,7 +463,34 @@ def test_calculate_coverage(tmpdir, test_sam_path):
     pathoscope.calculate_coverage(vta_path, ref_lengths)
 
 
-def test_write_report(tmpdir):
+def test_calculate_coverage_parallel(tmpdir):
+    """
+    Test that coverage calculated in parallel is the same as coverage calculated serially, including for alignments
+    that extend past the end of a reference.
+
+    """
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    ref_lengths = dict()
+
+    with open(vta_path, "r") as handle:
+        for line in handle:
+            _, ref_id, pos, length, _ = line.rstrip().split(",")
+            ref_lengths[ref_id] = max(ref_lengths.get(ref_id, 0), int(pos) + int(length) - 1)
+
+    # Truncate every other reference so some alignments overhang its end.
+    for i, ref_id in enumerate(sorted(ref_lengths)):
+        if i % 2:
+            ref_lengths[ref_id] -= 10
+
+    expected = pathoscope.calculate_coverage(vta_path, ref_lengths)
+
+    assert list(pathoscope.calculate_coverage(vta_path, ref_lengths, 3).items()) == list(expected.items())
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_write_report(binary, tmpdir):
     shutil.copy(VTA_PATH, str(tmpdir))
     vta_path = os.path.join(str(tmpdir), "test.vta")
 
@@ -136,7 +510,9 @@ def test_write_report(tmpdir):
 
     report_path = os.path.join(str(tmpdir), "report.tsv")
 
-    pathoscope.write_report(
+    binary_path = os.path.join(str(tmpdir), "report.npz") if binary else None
+
+    report = pathoscope.write_report(
         report_path,
         pi,
         refs,
@@ -149,10 +525,35 @@ def test_write_report(tmpdir):
         level_1_initial,
         level_2_initial,
         level_1_final,
-        level_2_final
+        level_2_final,
+        binary_path=binary_path
     )
 
     assert filecmp.cmp(report_path, TSV_PATH)
 
+    if binary:
+        assert pathoscope.read_binary_report(binary_path) == (len(reads), len(refs), report)
+    else:
+        assert sorted(os.listdir(str(tmpdir))) == ["report.tsv", "test.vta"]
+
+
+def test_build_report_columns():
+    """
+    Test that references are sorted by descending pi with ties broken by descending reference id, and that the report
+    ends at the first reference with a low pi and no high or low confidence hits.
+
+    """
+    refs = ["a", "b", "c", "d", "e"]
+    pi = [0.5, 0.2, 0.5, 0.005, 0.001]
+    level_1_final = [1, 1, 1, 0.5, 0]
+    level_2_final = [0, 0, 0, 0, 0]
+
+    columns = pathoscope.build_report_columns(pi, refs, *[list(range(5))] * 7 + [level_1_final, level_2_final])
+
+    assert list(columns) == [name for name, _ in pathoscope.REPORT_COLUMNS]
+    assert columns["genome"] == ["c", "a", "b", "d"]
+    assert columns["final_pi"] == [0.5, 0.5, 0.2, 0.005]
+    assert columns["final_high"] == [1, 1, 1, 0.5]
+
 
 
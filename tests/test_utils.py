@@ -1,3 +1,6 @@
+import json
+import numpy as np
+import os
 import pytest
 
 import virtool.pathoscope.utils
@@ -21,6 +24,33 @@ def test_collapse_pathoscope_coverage(coverage, expected):
     assert virtool.pathoscope.utils.coverage_to_coordinates(coverage) == expected
 
 
+def test_collapse_pathoscope_coverage_simplified():
+    """
+    Test that coordinates are simplified to about 40% of their points when there are more than 100 of them. Points
+    tied with the last point to keep are also kept, as are both endpoints.
+
+    """
+    coverage = [i * i % 23 for i in range(300)]
+
+    coordinates = virtool.pathoscope.utils.coverage_to_coordinates(coverage)
+
+    assert 120 <= len(coordinates) < 150
+    assert coordinates[0] == [0, 0]
+    assert coordinates[-1] == [299, coverage[299]]
+
+    positions = [position for position, _ in coordinates]
+
+    assert positions == sorted(positions)
+    assert all(coverage[position] == depth for position, depth in coordinates)
+
+
+@pytest.mark.parametrize("ratio,expected", [(0.4, [0, 2, 4]), (1, [0, 1, 2, 3, 4])])
+def test_simplify_coordinates(ratio, expected):
+    points = np.array([(0, 0), (1, 0), (2, 5), (3, 0), (4, 0)])
+
+    assert virtool.pathoscope.utils.simplify_coordinates(points, ratio).tolist() == expected
+
+
 def test_get_json_path():
     """
     Test that the function can correctly extrapolate the path to a nuvs.json file given the `data_path`, `sample_id`,
@@ -30,3 +60,285 @@ def test_get_json_path():
     path = virtool.pathoscope.utils.get_pathoscope_json_path("data_foo", "analysis_bar", "sample_foo")
 
     assert path == "data_foo/samples/sample_foo/analysis/analysis_bar/pathoscope.json"
+
+
+def test_get_em_json_path():
+    path = virtool.pathoscope.utils.get_em_json_path("data_foo", "analysis_bar", "sample_foo")
+
+    assert path == "data_foo/samples/sample_foo/analysis/analysis_bar/em.json"
+
+
+def test_read_names():
+    """
+    Test that read names are interned as consecutive ids and can still be resolved back to names after freezing.
+
+    """
+    read_names = virtool.pathoscope.utils.ReadNames()
+
+    names = [
+        "HWI-ST1410:82:C2VAGACXX:7:1101:20066:1892",
+        "foo",
+        "foo",
+        "bar",
+        "HWI-ST1410:82:C2VAGACXX:7:1101:20066:1892"
+    ]
+
+    assert [read_names.intern(name) for name in names] == [0, 1, 1, 2, 0]
+
+    assert len(read_names) == 3
+    assert [read_names[i] for i in range(3)] == ["HWI-ST1410:82:C2VAGACXX:7:1101:20066:1892", "foo", "bar"]
+
+    with pytest.raises(IndexError):
+        read_names[3]
+
+    read_names.freeze()
+
+    with pytest.raises(ValueError):
+        read_names.intern("baz")
+
+    assert [read_names[i] for i in range(3)] == ["HWI-ST1410:82:C2VAGACXX:7:1101:20066:1892", "foo", "bar"]
+
+
+def test_coverage_file(tmpdir):
+    """
+    Test that coverage lists written with :func:`write_coverage` can be read back in full or by sequence id.
+
+    """
+    path = os.path.join(str(tmpdir), "coverage.bin")
+
+    coverage = {
+        "foo": [0, 0, 1, 1, 2, 3, 3, 3, 4, 4, 3, 2],
+        "bar": [5] * 1000 + [70000] * 3,
+        "baz": [0]
+    }
+
+    virtool.pathoscope.utils.write_coverage(path, coverage.items())
+
+    assert virtool.pathoscope.utils.read_coverage(path) == coverage
+
+    assert virtool.pathoscope.utils.read_coverage(path, ["bar"]) == {
+        "bar": coverage["bar"]
+    }
+
+
+def test_get_coverage_path():
+    path = virtool.pathoscope.utils.get_coverage_path("data_foo", "analysis_bar", "sample_foo")
+
+    assert path == "data_foo/samples/sample_foo/analysis/analysis_bar/coverage.bin"
+
+
+@pytest.mark.parametrize("coverage_file", [False, True])
+def test_results_file(coverage_file, tmpdir):
+    """
+    Test that results written with :func:`write_results` are valid JSON and that the summary and single hits can be
+    read back through the index.
+
+    """
+    path = os.path.join(str(tmpdir), "pathoscope.json")
+
+    diagnosis = [
+        {"id": "foo", "pi": 0.75, "align": [0, 1, 2, 2]},
+        {"id": "bar", "pi": 0.25, "align": [3, 3, 0]}
+    ]
+
+    results = {
+        "diagnosis": diagnosis,
+        "read_count": 1337,
+        "ready": True
+    }
+
+    if coverage_file:
+        virtool.pathoscope.utils.write_coverage(
+            os.path.join(str(tmpdir), "coverage.bin"),
+            ((hit["id"], hit["align"]) for hit in diagnosis)
+        )
+
+        results = dict(results, diagnosis=[dict(hit, align="file") for hit in diagnosis])
+
+    virtool.pathoscope.utils.write_results(path, results)
+
+    with open(path, "r") as f:
+        assert json.load(f) == results
+
+    assert virtool.pathoscope.utils.read_results_summary(path) == {
+        "diagnosis": [
+            {"id": "foo", "pi": 0.75},
+            {"id": "bar", "pi": 0.25}
+        ],
+        "read_count": 1337,
+        "ready": True
+    }
+
+    assert virtool.pathoscope.utils.read_hit(path, "bar") == diagnosis[1]
+    assert virtool.pathoscope.utils.read_hit(path, "foo", coverage=False) == {"id": "foo", "pi": 0.75}
+
+
+def test_get_pathoscope_index_path():
+    path = virtool.pathoscope.utils.get_pathoscope_index_path("data_foo", "analysis_bar", "sample_foo")
+
+    assert path == "data_foo/samples/sample_foo/analysis/analysis_bar/pathoscope.index.json"
+
+
+def test_coverage_pyramid():
+    coverage = [1] * 10 + [5] * 10 + [0] * 5
+
+    assert virtool.pathoscope.utils.coverage_pyramid(coverage, bin_size=4, factor=2, max_bins=3) == [
+        {"bin_size": 4, "max": [1, 1, 5, 5, 5, 0, 0], "mean": [1.0, 1.0, 3.0, 5.0, 5.0, 0.0, 0.0]},
+        {"bin_size": 8, "max": [1, 5, 5, 0], "mean": [1.0, 4.0, 2.5, 0.0]},
+        {"bin_size": 16, "max": [5, 5], "mean": [2.5, 2.2]}
+    ]
+
+
+def test_aggregate_otus():
+    diagnosis = [
+        {"id": "seg_1", "otu": {"name": "Reovirus", "version": 5}, "final": {"pi": 0.5, "reads": 50}},
+        {"id": "foo", "otu": {"name": "Foobar", "version": 10}, "final": {"pi": 0.25, "reads": 20}},
+        {"id": "seg_2", "otu": {"name": "Reovirus", "version": 5}, "final": {"pi": 0.125, "reads": 10}}
+    ]
+
+    sequence_otu_map = {
+        "seg_1": "reo",
+        "seg_2": "reo",
+        "foo": "foobar"
+    }
+
+    coverage_stats = {
+        "seg_1": (100, 90, 1000),
+        "seg_2": (300, 150, 600),
+        "foo": (50, 50, 120)
+    }
+
+    assert virtool.pathoscope.utils.aggregate_otus(diagnosis, sequence_otu_map, coverage_stats) == [
+        {
+            "id": "reo",
+            "otu": {"name": "Reovirus", "version": 5},
+            "sequences": ["seg_1", "seg_2"],
+            "pi": 0.625,
+            "reads": 60,
+            "length": 400,
+            "coverage": 0.6,
+            "depth": 4
+        },
+        {
+            "id": "foobar",
+            "otu": {"name": "Foobar", "version": 10},
+            "sequences": ["foo"],
+            "pi": 0.25,
+            "reads": 20,
+            "length": 50,
+            "coverage": 1.0,
+            "depth": 2
+        }
+    ]
+
+
+def test_profile_phase():
+    events = list()
+
+    with virtool.pathoscope.utils.profile_phase(lambda event, info: events.append((event, info)), "foo"):
+        pass
+
+    with pytest.raises(ValueError):
+        with virtool.pathoscope.utils.profile_phase(lambda event, info: events.append((event, info)), "bar"):
+            raise ValueError("Failed")
+
+    with virtool.pathoscope.utils.profile_phase(None, "baz"):
+        pass
+
+    assert [(event, info["name"]) for event, info in events] == [("phase", "foo")]
+    assert events[0][1]["duration"] >= 0
+    assert events[0][1]["max_rss"] == virtool.pathoscope.utils.get_max_rss() > 0
+
+
+def test_write_profile(tmpdir):
+    """
+    Test that non-finite values are written as ``null`` so the profile is valid JSON.
+
+    """
+    path = os.path.join(str(tmpdir), "profile.json")
+
+    virtool.pathoscope.utils.write_profile(path, [
+        {"event": "em_iteration", "iteration": 1, "log_likelihood": float("-inf"), "change": float("nan")},
+        {"event": "em_iteration", "iteration": 2, "log_likelihood": -12.5, "change": np.float64(0.25)},
+        {"event": "matrix", "shape": (3, float("inf"))}
+    ])
+
+    with open(path, "r") as f:
+        text = f.read()
+
+    assert "Infinity" not in text and "NaN" not in text
+
+    assert json.loads(text) == [
+        {"event": "em_iteration", "iteration": 1, "log_likelihood": None, "change": None},
+        {"event": "em_iteration", "iteration": 2, "log_likelihood": -12.5, "change": 0.25},
+        {"event": "matrix", "shape": [3, None]}
+    ]
+
+
+def test_checksum_files(tmpdir):
+    tmpdir.join("reads_1.fq").write("foo")
+    tmpdir.join("reads_2.fq").write("bar")
+
+    paths = [os.path.join(str(tmpdir), filename) for filename in ["reads_1.fq", "reads_2.fq"]]
+
+    checksum = virtool.pathoscope.utils.checksum_files(paths)
+
+    assert checksum == "8843d7f92416211de9ebb963ff4ce28125932878"
+    assert virtool.pathoscope.utils.checksum_files(paths[::-1]) != checksum
+
+
+def test_get_otu_cache_path():
+    path = virtool.pathoscope.utils.get_otu_cache_path("data_foo", "sample_foo", "index_bar", "abc")
+
+    assert path == "data_foo/samples/sample_foo/otu_cache/index_bar_abc"
+
+
+def test_get_alignment_cache_path():
+    path = virtool.pathoscope.utils.get_alignment_cache_path("data_foo", "sample_foo", "abc")
+
+    assert path == "data_foo/samples/sample_foo/alignment_cache/abc"
+
+
+def test_get_sequence_digest():
+    digest = virtool.pathoscope.utils.get_sequence_digest("foo", "ACGT")
+
+    assert digest == virtool.pathoscope.utils.get_sequence_digest("foo", "ACGT")
+    assert digest != virtool.pathoscope.utils.get_sequence_digest("foo", "ACGA")
+    assert digest != virtool.pathoscope.utils.get_sequence_digest("bar", "ACGT")
+
+
+@pytest.mark.parametrize("filename", [None, "reads_1.fastq", "reads_1.fq.gz", "reads_1.fastq.zst"])
+def test_find_read_path(filename, tmpdir):
+    if filename:
+        tmpdir.join(filename).write("")
+
+    path = virtool.pathoscope.utils.find_read_path(str(tmpdir), 1)
+
+    assert path == os.path.join(str(tmpdir), filename or "reads_1.fastq")
+
+
+@pytest.mark.parametrize("filename", ["reads_1.fastq", "reads_1.fastq.gz"])
+def test_open_fastq(filename, tmpdir):
+    """
+    Test that FASTQ files written with :func:`open_fastq_writer` can be read back with :func:`open_reads` and that
+    files ending in ``.gz`` are compressed.
+
+    """
+    path = os.path.join(str(tmpdir), filename)
+
+    record = "@read_1\nACGT\n+\nIIII\n"
+
+    with virtool.pathoscope.utils.open_fastq_writer(path) as f:
+        f.write(record)
+
+    with open(path, "rb") as f:
+        assert (f.read() == record.encode()) != filename.endswith(".gz")
+
+    with virtool.pathoscope.utils.open_reads(path) as f:
+        assert f.read() == record.encode()
+
+    with virtool.pathoscope.utils.open_fastq_writer(path, "a") as f:
+        f.write(record)
+
+    with virtool.pathoscope.utils.open_reads(path) as f:
+        assert f.read() == 2 * record.encode()
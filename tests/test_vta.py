@@ -0,0 +1,92 @@
+import os
+import sys
+import pytest
+import shutil
+
+import virtool.pathoscope.vta as vta
+
+VTA_PATH = os.path.join(sys.path[0], "tests", "test_files", "test.vta")
+
+
+@pytest.mark.parametrize("grouped", [False, True])
+@pytest.mark.parametrize("chunk_count", [1, 2, 5, 1000])
+def test_find_chunks(chunk_count, grouped):
+    """
+    Test that the file is covered by contiguous ranges of whole lines and that no read is split between ranges when
+    ``grouped`` is set.
+
+    """
+    chunks = vta.find_chunks(VTA_PATH, chunk_count, grouped)
+
+    assert 0 < len(chunks) <= chunk_count
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == os.path.getsize(VTA_PATH)
+    assert all(previous[1] == chunk[0] for previous, chunk in zip(chunks, chunks[1:]))
+
+    chunk_lines = [vta.read_lines(VTA_PATH, start, end) for start, end in chunks]
+
+    with open(VTA_PATH, "r") as handle:
+        assert [line for lines in chunk_lines for line in lines] == [line.rstrip() for line in handle]
+
+    if grouped:
+        for previous, lines in zip(chunk_lines, chunk_lines[1:]):
+            assert previous[-1].split(",")[0] != lines[0].split(",")[0]
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_parse(processes, tmpdir):
+    """
+    Test that the parsed columns match the lines of the file and that references are numbered in the order they first
+    appear.
+
+    """
+    shutil.copy(VTA_PATH, str(tmpdir))
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    columns = vta.parse(vta_path, processes, grouped=True)
+
+    with open(vta_path, "r") as handle:
+        lines = [line.rstrip().split(",") for line in handle]
+
+    refs = list()
+    groups = list()
+
+    for i, (read_id, ref_id, pos, length, p_score) in enumerate(lines):
+        if ref_id not in refs:
+            refs.append(ref_id)
+
+        if i == 0:
+            groups.append(0)
+        else:
+            groups.append(groups[-1] + (read_id != lines[i - 1][0]))
+
+    assert columns.refs == refs
+    assert columns.groups.tolist() == groups
+    assert [columns.refs[i] for i in columns.ref_indexes] == [fields[1] for fields in lines]
+    assert columns.positions.tolist() == [int(fields[2]) for fields in lines]
+    assert columns.lengths.tolist() == [int(fields[3]) for fields in lines]
+    assert columns.scores.tolist() == [float(fields[4]) for fields in lines]
+
+    # The scratch directory is removed.
+    assert os.listdir(str(tmpdir)) == ["test.vta"]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parse_not_grouped(processes, tmpdir):
+    """
+    Test that a read that starts more than one group raises an error when the file is parsed as grouped, whether the
+    groups are in the same range or in different ranges.
+
+    """
+    vta_path = os.path.join(str(tmpdir), "test.vta")
+
+    with open(vta_path, "w") as f:
+        f.write("read_1,ref_1,1,10,0.5\nread_2,ref_1,5,10,0.5\nread_3,ref_2,9,10,0.5\nread_1,ref_2,3,10,0.25\n")
+
+    assert len(vta.parse(vta_path, processes).scores) == 4
+
+    with pytest.raises(vta.NotGroupedError):
+        vta.parse(vta_path, processes, grouped=True)
+
+    # The scratch directory is removed.
+    assert os.listdir(str(tmpdir)) == ["test.vta"]
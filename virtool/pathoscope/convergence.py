@@ -0,0 +1,161 @@
+"""
+Stopping policies for the EM implementations in :mod:`virtool.pathoscope.pathoscope` and
+:mod:`virtool.pathoscope.matrix`.
+
+After each iteration, EM describes its progress with an :class:`Iteration` and stops as soon as any of its policies
+returns ``True`` for it. Policies are subclasses of :class:`StoppingPolicy` and keep no state between calls, so they
+can be reused across runs.
+
+"""
+import abc
+import collections
+import math
+
+#: The progress of an EM iteration. ``l1_change`` and ``max_change`` are the summed and largest absolute changes in pi.
+#: ``log_likelihood`` is the weighted log-likelihood, including the priors, of the estimates the iteration started from.
+#: It is the objective EM maximizes, so it does not decrease between iterations. ``previous_log_likelihood`` is that of
+#: the iteration before it. Both are ``None`` if the log-likelihood is not tracked. ``elapsed`` is the time in seconds
+#: since EM started.
+Iteration = collections.namedtuple("Iteration", [
+    "number",
+    "l1_change",
+    "max_change",
+    "log_likelihood",
+    "previous_log_likelihood",
+    "elapsed"
+])
+
+
+class StoppingPolicy(abc.ABC):
+    """
+    Decides whether EM should stop after an iteration. Subclasses must implement :meth:`__call__`.
+
+    """
+
+    #: Whether the policy needs the log-likelihood of each iteration. It is only calculated if a policy needs it.
+    uses_likelihood = False
+
+    @abc.abstractmethod
+    def __call__(self, iteration):
+        """
+        Check whether EM should stop after ``iteration``.
+
+        :param iteration: the progress of the iteration
+        :type iteration: :class:`Iteration`
+
+        :return: whether to stop
+        :rtype: bool
+
+        """
+
+
+class L1Change(StoppingPolicy):
+    """
+    Stop when the summed absolute change in pi is at most ``epsilon``. This is the default policy of both EM
+    implementations.
+
+    """
+
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+
+    def __call__(self, iteration):
+        return iteration.l1_change <= self.epsilon
+
+
+class MaxChange(StoppingPolicy):
+    """
+    Stop when no reference's pi changes by more than ``epsilon``. Unlike :class:`L1Change`, the tolerance does not
+    have to be scaled with the number of references.
+
+    """
+
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+
+    def __call__(self, iteration):
+        return iteration.max_change <= self.epsilon
+
+
+class RelativeLikelihoodChange(StoppingPolicy):
+    """
+    Stop when the log-likelihood changes by no more than ``tolerance`` relative to its previous value.
+
+    """
+
+    uses_likelihood = True
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+
+    def __call__(self, iteration):
+        previous = iteration.previous_log_likelihood
+
+        if previous is None or not math.isfinite(previous) or not math.isfinite(iteration.log_likelihood):
+            return False
+
+        if previous == 0:
+            return iteration.log_likelihood == 0
+
+        return abs((iteration.log_likelihood - previous) / previous) <= self.tolerance
+
+
+class TimeBudget(StoppingPolicy):
+    """
+    Stop once EM has run for at least ``seconds``. The estimates of the last completed iteration are returned.
+
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, iteration):
+        return iteration.elapsed >= self.seconds
+
+
+#: The policies that can be configured by name with :func:`get_policies`.
+POLICIES = {
+    "l1_change": L1Change,
+    "max_change": MaxChange,
+    "relative_likelihood_change": RelativeLikelihoodChange,
+    "time_budget": TimeBudget
+}
+
+
+def get_policies(options):
+    """
+    Create stopping policies from a dict of policy names and their thresholds, such as
+    ``{"max_change": 1e-6, "time_budget": 600}``. The names are the keys of :data:`POLICIES`.
+
+    :param options: the thresholds keyed by policy name
+    :type options: dict
+
+    :return: the policies
+    :rtype: list
+
+    """
+    unknown = set(options) - set(POLICIES)
+
+    if unknown:
+        raise ValueError("Unknown stopping policies: {}".format(", ".join(sorted(unknown))))
+
+    return [POLICIES[name](options[name]) for name in sorted(options)]
+
+
+def uses_likelihood(policies):
+    """
+    Check if any of ``policies`` needs the log-likelihood of each iteration.
+
+    """
+    return any(policy.uses_likelihood for policy in policies)
+
+
+def safe_log(value):
+    """
+    Get the natural logarithm of ``value``, or negative infinity if ``value`` is zero.
+
+    """
+    if value > 0:
+        return math.log(value)
+
+    return -math.inf
@@ -0,0 +1,187 @@
+"""
+Database helpers shared by the analysis jobs running in one worker process.
+
+Clients and bulk writers are keyed by process id, so only jobs that run in the same process share them. This is the
+case when a worker runs several jobs in threads of one process. Jobs started in their own processes, as the job
+manager does by default, each get their own client and writer and gain nothing from the ``db_shared_client`` and
+``db_batch_writes`` settings.
+
+"""
+import os
+import threading
+
+import pymongo
+import pymongo.errors
+from pymongo.write_concern import WriteConcern
+
+#: Clients shared by the jobs in this process, keyed by process id and connection string.
+_clients = dict()
+
+#: Bulk writers shared by the jobs in this process, keyed by process id, connection string and collection.
+_writers = dict()
+
+_lock = threading.Lock()
+
+
+def get_client(connection_string):
+    """
+    Get a :class:`pymongo.MongoClient` for ``connection_string`` that is shared by all callers in the current process.
+    The client keeps a connection pool, so jobs running in threads of the same worker do not each open their own
+    connections.
+
+    Clients are not safe to use after a fork, so a new client is created in each process.
+
+    :param connection_string: the MongoDB connection string
+    :type connection_string: str
+
+    :return: the shared client
+    :rtype: :class:`pymongo.MongoClient`
+
+    """
+    key = (os.getpid(), connection_string)
+
+    with _lock:
+        client = _clients.get(key)
+
+        if client is None:
+            client = _clients[key] = pymongo.MongoClient(connection_string, appname="Virtool", connect=False)
+
+    return client
+
+
+def get_write_concern(settings):
+    """
+    Get the write concern for analysis results from the ``results_write_concern`` setting. The setting is a dict of
+    keyword arguments for :class:`pymongo.write_concern.WriteConcern` (eg. ``{"w": "majority", "wtimeout": 10000}``).
+    Returns ``None`` to use the client's write concern if the setting is missing.
+
+    :param settings: the application settings
+    :type settings: dict
+
+    :return: the write concern
+    :rtype: :class:`pymongo.write_concern.WriteConcern`
+
+    """
+    options = settings.get("results_write_concern")
+
+    if options is None:
+        return None
+
+    return WriteConcern(**options)
+
+
+def get_bulk_writer(connection_string, collection):
+    """
+    Get the :class:`BulkWriter` for ``collection`` that is shared by all callers in the current process.
+
+    :param connection_string: the connection string of the client that ``collection`` belongs to
+    :type connection_string: str
+
+    :param collection: the collection to write to
+    :type collection: :class:`pymongo.collection.Collection`
+
+    :return: the shared writer
+    :rtype: :class:`BulkWriter`
+
+    """
+    key = (os.getpid(), connection_string, collection.full_name, repr(collection.write_concern))
+
+    with _lock:
+        writer = _writers.get(key)
+
+        if writer is None:
+            writer = _writers[key] = BulkWriter(collection)
+
+    return writer
+
+
+class BulkWriter:
+    """
+    Batches ``update_one`` calls made on a collection by several threads into unordered ``bulk_write`` calls.
+
+    A caller queues its update and then either waits for a write in progress to finish or, if no write is in
+    progress, writes all of the queued updates itself. Each call still returns only once its update has been written,
+    but a single round trip can carry the updates of many jobs when the database is slow.
+
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+        self._condition = threading.Condition()
+        self._pending = list()
+        self._writing = False
+
+    def update_one(self, filter, update):
+        """
+        Queue an update and wait for it to be written. Errors for the update, such as
+        :class:`pymongo.errors.DocumentTooLarge`, are raised in the calling thread.
+
+        :param filter: the query that matches the document to update
+        :type filter: dict
+
+        :param update: the update to apply
+        :type update: dict
+
+        """
+        operation = {
+            "request": pymongo.UpdateOne(filter, update),
+            "done": False,
+            "error": None
+        }
+
+        with self._condition:
+            self._pending.append(operation)
+
+            while not operation["done"] and self._writing:
+                self._condition.wait()
+
+            if operation["done"]:
+                if operation["error"] is not None:
+                    raise operation["error"]
+
+                return
+
+            batch = self._pending
+            self._pending = list()
+            self._writing = True
+
+        try:
+            self._write(batch)
+        finally:
+            with self._condition:
+                for item in batch:
+                    item["done"] = True
+
+                self._writing = False
+                self._condition.notify_all()
+
+        if operation["error"] is not None:
+            raise operation["error"]
+
+    def _write(self, batch):
+        """
+        Write a batch of queued updates and record the error for each update that failed.
+
+        A document that is too large fails the whole bulk write before it is sent, so the updates are then written one
+        at a time.
+
+        """
+        try:
+            self.collection.bulk_write([item["request"] for item in batch], ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            for write_error in err.details["writeErrors"]:
+                batch[write_error["index"]]["error"] = pymongo.errors.WriteError(
+                    write_error["errmsg"],
+                    write_error["code"],
+                    write_error
+                )
+        except (pymongo.errors.DocumentTooLarge, pymongo.errors.InvalidDocument):
+            for item in batch:
+                try:
+                    self.collection.bulk_write([item["request"]])
+                except Exception as err:
+                    item["error"] = err
+        except Exception as err:
+            for item in batch:
+                item["error"] = err
@@ -2,16 +2,23 @@
 Functions and job classes for sample analysis.
 
 """
+import contextlib
 import json
 import os
 import shlex
 import shutil
+import subprocess
 
 import pymongo
 import pymongo.errors
 from virtool.job import Job
 
+import virtool.pathoscope.convergence as convergence
+import virtool.pathoscope.db as db
+import virtool.pathoscope.kmers as kmers
+import virtool.pathoscope.matrix as matrix
 import virtool.pathoscope.pathoscope as pathoscope
+import virtool.pathoscope.utils as utils
 
 
 class PathoscopeBowtie(Job):
@@ -26,8 +33,10 @@ class PathoscopeBowtie(Job):
 
     """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, db_connection_string, *args, **kwargs):
+        super().__init__(db_connection_string, *args, **kwargs)
+
+        self.db_connection_string = db_connection_string
 
         self._stage_list = [
             self.mk_analysis_dir,
@@ -43,6 +52,25 @@ class PathoscopeBowtie(Job):
 
         ]
 
+    def init_db(self):
+        """
+        Connect to the database and read the job document.
+
+        If the ``db_shared_client`` setting is true, the client opened by the base job is closed once the job document
+        has been read and ``self.db`` is taken from :func:`~virtool.pathoscope.db.get_client` instead. All later
+        database access by the job then goes through the client shared by the jobs in the process.
+
+        """
+        super().init_db()
+
+        if self.settings.get("db_shared_client"):
+            client = self.db.client
+
+            self.db = db.get_client(self.db_connection_string)[self.db.name]
+
+            if client is not self.db.client:
+                client.close()
+
     def check_db(self):
         """
         Get some initial information from the database that will be required during the course of the job.
@@ -78,7 +106,7 @@ class PathoscopeBowtie(Job):
         # Get the complete sample document from the database.
         sample = self.db.samples.find_one(self.params["sample_id"])
 
-        read_paths = [os.path.join(sample_path, "reads_1.fastq")]
+        read_paths = [utils.find_read_path(sample_path, 1)]
 
         paired = sample.get("paired", None)
 
@@ -86,14 +114,69 @@ class PathoscopeBowtie(Job):
             paired = len(sample["files"]) == 2
 
         if paired:
-            read_paths.append(os.path.join(sample_path, "reads_2.fastq"))
+            read_paths.append(utils.find_read_path(sample_path, 2))
 
         self.params.update({
             "paired": paired,
 
+            # Map read pairs with ``-1`` and ``-2`` in map_isolates and map_subtraction instead of as unpaired reads.
+            "paired_mapping": paired and self.task_args.get("paired_mapping", False),
+
             #: The number of reads in the sample library. Assigned after database connection is made.
             "read_count": int(sample["quality"]["count"]),
             "read_paths": read_paths,
+
+            # Reuse the OTU hits of a previous analysis of the same reads against the same index.
+            "otu_cache": self.task_args.get("otu_cache", False),
+
+            # Only map reads that share k-mers with the reference in map_otus.
+            "kmer_prefilter": self.task_args.get("kmer_prefilter", False),
+
+            # Map only the reads that aligned in map_otus in map_isolates.
+            "reduce_reads": self.task_args.get("reduce_reads", False),
+
+            # Write intermediate FASTQ files compressed with gzip.
+            "compress_intermediates": self.task_args.get("compress_intermediates", False),
+
+            # Replace read names with integer ids from map_isolates onwards.
+            "intern_read_ids": self.task_args.get("intern_read_ids", False),
+
+            # Run EM over sharded NumPy arrays using all of the job's cores.
+            "sharded_em": self.task_args.get("sharded_em", False),
+
+            # If set, build the read matrix out of core and keep EM within this many GB of memory.
+            "em_memory_budget": self.task_args.get("em_memory_budget", None),
+
+            # Drop the non-unique read entries of references whose pi falls below this value during EM. Only the sharded
+            # engine supports this, so setting it switches EM to the sharded engine as if ``sharded_em`` were set.
+            "em_prune_threshold": self.task_args.get("em_prune_threshold", None),
+
+            # Stop EM with these policies instead of a fixed tolerance on pi, eg. ``{"max_change": 1e-6}`` (see
+            # virtool.pathoscope.convergence.get_policies).
+            "em_stopping": self.task_args.get("em_stopping", None),
+
+            # Store coverage lists in a compressed file instead of in the analysis document.
+            "coverage_file": self.task_args.get("coverage_file", False),
+
+            # Attach binned coverage at several resolutions to each hit. Implies ``coverage_file``.
+            "coverage_pyramids": self.task_args.get("coverage_pyramids", False),
+
+            # Add a summary of the hits of each OTU to the results.
+            "otu_summary": self.task_args.get("otu_summary", False),
+
+            # Also write the report as a compressed NumPy archive for fast loading of large reference sets.
+            "binary_report": self.task_args.get("binary_report", False),
+
+            # Record phase timings, EM iterations, matrix dimensions and memory use of run_patho to profile.json.
+            "profile": self.task_args.get("profile", False),
+
+            # Parse VTA files in a pool of processes, one for each of the job's cores.
+            "parallel_parsing": self.task_args.get("parallel_parsing", False),
+
+            # Warm start EM from the estimates of a previous analysis of the sample or from a JSON file.
+            "warm_start_analysis_id": self.task_args.get("warm_start_analysis_id", None),
+            "warm_start_path": self.task_args.get("warm_start_path", None),
+
             "subtraction_path": os.path.join(
                 self.settings["data_path"],
                 "subtractions",
@@ -102,6 +185,44 @@ class PathoscopeBowtie(Job):
             )
         })
 
+        # Reuse the alignments of unchanged sequences from earlier analyses of the same reads in map_isolates. Cached
+        # reads are matched by name, so paired samples are not supported. The cache holds alignments of all of the
+        # sample's reads, so it is not used when only some of the reads are mapped.
+        self.params["alignment_cache"] = (
+            self.task_args.get("alignment_cache", False) and
+            not self.params["paired"] and
+            not self.params["reduce_reads"]
+        )
+
+    def get_read_checksum(self):
+        """
+        Get a checksum of the sample's read files. It is calculated once and kept in :attr:`intermediate`.
+
+        :return: the hex digest
+        :rtype: str
+
+        """
+        if "read_checksum" not in self.intermediate:
+            self.intermediate["read_checksum"] = utils.checksum_files(self.params["read_paths"])
+
+        return self.intermediate["read_checksum"]
+
+    def get_fastq_path(self, name):
+        """
+        Get the path of the intermediate FASTQ file ``name`` in the analysis directory. The path ends in ``.fastq.gz``
+        if the ``compress_intermediates`` param is set.
+
+        :param name: the file name without an extension
+        :type name: str
+
+        :return: the path
+        :rtype: str
+
+        """
+        extension = ".fastq.gz" if self.params["compress_intermediates"] else ".fastq"
+
+        return os.path.join(self.params["analysis_path"], name + extension)
+
     def mk_analysis_dir(self):
         """
         Make a directory for the analysis in the sample/analysis directory.
@@ -113,7 +234,56 @@ class PathoscopeBowtie(Job):
         """
         Using ``bowtie2``, maps reads to the main otu reference. This mapping is used to identify candidate otus.
 
+        If the ``reduce_reads`` param is set, the reads that align are written to ``otu_reads.fastq`` and only those
+        reads are mapped in :meth:`map_isolates`. Reads that only align to isolates missing from the main reference are
+        not mapped in this mode. The param is ignored if the ``paired_mapping`` param is set.
+
+        If the ``otu_cache`` param is set, the candidate otus and any reduced reads are cached in a directory keyed by
+        the index id and a checksum of the read files. An existing cache entry is used instead of running ``bowtie2``.
+
+        If the ``kmer_prefilter`` param is set, only the reads that share a sampled k-mer with the reference are passed
+        to ``bowtie2`` (see :func:`~virtool.pathoscope.kmers.filter_fastq`). The number of reads before and after
+        filtering are reported in the results.
+
+        ``bowtie2`` is given all of the job's cores. Its output is limited to aligned reads by ``--no-unal`` and the
+        stdout handler only collects reference ids, so the handler does not need a core of its own.
+
         """
+        otu_reads_path = self.get_fastq_path("otu_reads")
+
+        cache_path = None
+
+        if self.params["otu_cache"]:
+            checksum = self.get_read_checksum()
+
+            # Prefiltering can change the otu hits, so prefiltered runs are cached separately.
+            if self.params["kmer_prefilter"]:
+                checksum += "_k{}s{}".format(kmers.K, kmers.SAMPLE)
+
+            cache_path = utils.get_otu_cache_path(
+                self.settings["data_path"],
+                self.params["sample_id"],
+                self.task_args["index_id"],
+                checksum
+            )
+
+            if self.load_otu_cache(cache_path):
+                return
+
+        read_paths = self.params["read_paths"]
+
+        if self.params["kmer_prefilter"]:
+            prefiltered_path = self.get_fastq_path("prefiltered")
+
+            read_count, passed_count = kmers.filter_fastq(self.get_kmer_sketch(), read_paths, prefiltered_path)
+
+            self.intermediate["prefilter"] = {
+                "read_count": read_count,
+                "passed_count": passed_count
+            }
+
+            read_paths = [prefiltered_path]
+
         command = [
             "bowtie2",
             "-p", str(self.proc),
@@ -122,10 +292,14 @@ class PathoscopeBowtie(Job):
             "--score-min", "L,20,1.0",
             "-N", "0",
             "-L", "15",
-            "-x", self.params["index_path"],
-            "-U", ",".join(self.params["read_paths"])
+            "-x", self.params["index_path"]
         ]
 
+        reduce_reads = self.params["reduce_reads"] and not self.params["paired_mapping"]
+
+        if reduce_reads:
+            command += ["--al-gz" if self.params["compress_intermediates"] else "--al", otu_reads_path]
+
         to_otus = set()
 
         def stdout_handler(line):
@@ -151,14 +325,107 @@ class PathoscopeBowtie(Job):
 
             to_otus.add(ref_id)
 
-        self.run_subprocess(command, stdout_handler=stdout_handler)
+        with stream_reads(read_paths, self.params["analysis_path"], self.proc) as streamed_paths:
+            self.run_subprocess(command + ["-U", ",".join(streamed_paths)], stdout_handler=stdout_handler)
 
         self.intermediate["to_otus"] = to_otus
 
+        if reduce_reads:
+            self.intermediate["isolate_read_paths"] = [otu_reads_path]
+
+        if cache_path is not None:
+            self.save_otu_cache(cache_path)
+
+    def get_kmer_sketch(self):
+        """
+        Load the k-mer sketch stored next to the reference index. If there is no sketch, build one from the sequences
+        dumped by ``bowtie2-inspect`` and save it for later analyses.
+
+        :return: the sketch
+        :rtype: :class:`~virtool.pathoscope.kmers.KmerSketch`
+
+        """
+        sketch_path = kmers.get_sketch_path(self.params["index_path"])
+
+        if os.path.isfile(sketch_path):
+            return kmers.KmerSketch.load(sketch_path)
+
+        sequences = list()
+
+        def stdout_handler(line):
+            if line[:1] == b">":
+                sequences.append(bytearray())
+            else:
+                sequences[-1] += line.rstrip()
+
+        self.run_subprocess(["bowtie2-inspect", self.params["index_path"]], stdout_handler=stdout_handler)
+
+        sketch = kmers.KmerSketch.build(bytes(sequence) for sequence in sequences)
+
+        sketch.save(sketch_path)
+
+        return sketch
+
+    def load_otu_cache(self, cache_path):
+        """
+        Load the candidate otus, and the reduced reads if the ``reduce_reads`` param is set, from the otu cache entry at
+        ``cache_path``. Returns ``False`` if the entry does not exist or does not have the reduced reads.
+
+        :param cache_path: the path to the cache entry
+        :type cache_path: str
+
+        :return: whether the cache entry was loaded
+        :rtype: bool
+
+        """
+        to_otus_path = os.path.join(cache_path, "to_otus.json")
+        otu_reads_path = os.path.join(cache_path, os.path.basename(self.get_fastq_path("otu_reads")))
+
+        if not os.path.isfile(to_otus_path):
+            return False
+
+        if self.params["reduce_reads"] and not self.params["paired_mapping"]:
+            if not os.path.isfile(otu_reads_path):
+                return False
+
+            self.intermediate["isolate_read_paths"] = [otu_reads_path]
+
+        with open(to_otus_path, "r") as f:
+            self.intermediate["to_otus"] = set(json.load(f))
+
+        return True
+
+    def save_otu_cache(self, cache_path):
+        """
+        Save the candidate otus and any reduced reads from :meth:`map_otus` to the otu cache entry at ``cache_path``.
+
+        The otu list is written last, through a temporary file, so that an interrupted save is never loaded.
+
+        :param cache_path: the path to the cache entry
+        :type cache_path: str
+
+        """
+        os.makedirs(cache_path, exist_ok=True)
+
+        if self.params["reduce_reads"] and not self.params["paired_mapping"]:
+            otu_reads_path = self.get_fastq_path("otu_reads")
+            shutil.copyfile(otu_reads_path, os.path.join(cache_path, os.path.basename(otu_reads_path)))
+
+        to_otus_path = os.path.join(cache_path, "to_otus.json")
+
+        with open(to_otus_path + ".tmp", "w") as f:
+            json.dump(sorted(self.intermediate["to_otus"]), f)
+
+        os.replace(to_otus_path + ".tmp", to_otus_path)
+
     def generate_isolate_fasta(self):
         """
         Identifies otu hits from the initial default otu mapping.
 
+        If the ``alignment_cache`` param is set, sequences that have an entry in the alignment cache are left out of the
+        FASTA file. The paths of the entries to reuse and of the entries to create for the remaining sequences are kept
+        in :attr:`intermediate` for :meth:`map_isolates`.
+
         """
         self.intermediate["otu_dict"] = self.task_args["otu_dict"]
 
@@ -170,15 +437,40 @@ class PathoscopeBowtie(Job):
 
         ref_lengths = dict()
 
+        cache_path = None
+
+        if self.params["alignment_cache"]:
+            cache_path = utils.get_alignment_cache_path(
+                self.settings["data_path"],
+                self.params["sample_id"],
+                self.get_read_checksum()
+            )
+
+            self.intermediate["cached_alignments"] = list()
+            self.intermediate["uncached_alignments"] = dict()
+
         # Get the database documents for the sequences
         with open(fasta_path, "w") as handle:
             # Iterate through each otu id referenced by the hit sequence ids.
             for otu_id in self.db.sequences.distinct("otu_id", {"_id": {"$in": sequence_ids}}):
                 # Write all of the sequences for each otu to a FASTA file.
                 for document in self.db.sequences.find({"otu_id": otu_id}, ["sequence"]):
-                    handle.write(">{}\n{}\n".format(document["_id"], document["sequence"]))
                     ref_lengths[document["_id"]] = len(document["sequence"])
 
+                    if cache_path is not None:
+                        entry_path = os.path.join(
+                            cache_path,
+                            utils.get_sequence_digest(document["_id"], document["sequence"])
+                        )
+
+                        if os.path.isfile(entry_path + ".vta"):
+                            self.intermediate["cached_alignments"].append(entry_path)
+                            continue
+
+                        self.intermediate["uncached_alignments"][document["_id"]] = entry_path
+
+                    handle.write(">{}\n{}\n".format(document["_id"], document["sequence"]))
+
         del self.intermediate["to_otus"]
 
         self.intermediate["ref_lengths"] = ref_lengths
@@ -188,9 +480,15 @@ class PathoscopeBowtie(Job):
         Build an index with ``bowtie2-build`` from the FASTA file generated by
         :meth:`Pathoscope.generate_isolate_fasta`.
 
+        No index is built if all of the sequences were found in the alignment cache.
+
         """
+        if self.params["alignment_cache"] and not self.intermediate["uncached_alignments"]:
+            return
+
         command = [
             "bowtie2-build",
+            "--threads", str(self.proc),
             os.path.join(self.params["analysis_path"], "isolate_index.fa"),
             os.path.join(self.params["analysis_path"], "isolates")
         ]
@@ -199,23 +497,67 @@ class PathoscopeBowtie(Job):
 
     def map_isolates(self):
         """
-        Using ``bowtie2``, map the sample reads to the index built using :meth:`.build_isolate_index`.
+        Using ``bowtie2``, map the sample reads to the index built using :meth:`.build_isolate_index`. Only the reads
+        that aligned in :meth:`map_otus` are mapped if the ``reduce_reads`` param is set.
+
+        If the ``intern_read_ids`` param is set, read names are interned as integer ids using
+        :class:`~virtool.pathoscope.utils.ReadNames`. The ids replace the names in the VTA output and the mapped reads
+        are written to ``mapped.fastq`` under their ids by the stdout handler rather than by ``bowtie2 --al``.
+
+        Read pairs are mapped by :meth:`map_isolates_paired` if the ``paired_mapping`` param is set.
+
+        If the ``alignment_cache`` param is set, only the sequences missing from the alignment cache are in the index.
+        Their alignments are saved to the cache by :class:`AlignmentCacheWriter` and the cached alignments of the other
+        sequences are added to the output by :meth:`merge_alignment_cache`. The output is then sorted by read with
+        :meth:`sort_vta`, so the alignments of each read stay contiguous.
+
+        Cached alignments were made against a different index. ``bowtie2 -k 100`` reports at most 100 alignments for
+        each read from the sequences in the index it is given, so a read with many candidate alignments can keep a
+        different set of them than a full mapping would. Results can differ slightly from those of a full remap.
+
+        ``bowtie2`` is given one core less than the job, but at least one, so that a core is left for the stdout handler
+        that writes every alignment to the VTA file. The same applies to :meth:`map_isolates_paired`.
 
         """
+        if self.params["paired_mapping"]:
+            return self.map_isolates_paired()
+
+        mapped_path = self.get_fastq_path("mapped")
+
         command = [
             "bowtie2",
-            "-p", str(self.proc - 1),
+            "-p", str(max(self.proc - 1, 1)),
             "--no-unal",
             "--local",
             "--score-min", "L,20,1.0",
             "-N", "0",
             "-L", "15",
-            "-k", "100",
-            "--al", os.path.join(self.params["analysis_path"], "mapped.fastq"),
-            "-x", os.path.join(self.params["analysis_path"], "isolates"),
-            "-U", ",".join(self.params["read_paths"])
+            "-k", "100"
         ]
 
+        read_names = None
+        fastq_handle = None
+
+        if self.params["intern_read_ids"]:
+            read_names = utils.ReadNames()
+            fastq_handle = utils.open_fastq_writer(mapped_path)
+        else:
+            command += ["--al-gz" if self.params["compress_intermediates"] else "--al", mapped_path]
+
+        command += [
+            "-x", os.path.join(self.params["analysis_path"], "isolates")
+        ]
+
+        read_paths = self.intermediate.get("isolate_read_paths", self.params["read_paths"])
+
+        context = pathoscope.SamReadContext()
+
+        alignment_cache = None
+        merged = False
+
+        if self.params["alignment_cache"]:
+            alignment_cache = AlignmentCacheWriter(self.intermediate.pop("uncached_alignments"))
+
         with open(os.path.join(self.params["analysis_path"], "to_isolates.vta"), "w") as f:
             def stdout_handler(line, p_score_cutoff=0.01):
                 line = line.decode()
@@ -234,35 +576,225 @@ class PathoscopeBowtie(Job):
                 if ref_id == "*":
                     return
 
-                p_score = pathoscope.find_sam_align_score(fields)
+                read_length = context.update(fields)
+
+                if alignment_cache is not None:
+                    alignment_cache.add_read(fields)
+
+                read_id = fields[0]
+
+                if read_names is not None:
+                    read_id = str(read_names.intern(fields[0]))
+
+                    # Write each read to the FASTQ file once, using the first of its records that carries the sequence.
+                    if context.new_sequence:
+                        fastq_handle.write(pathoscope.sam_to_fastq(fields, read_id))
+
+                p_score = pathoscope.find_sam_align_score(fields, read_length)
 
                 # Skip if the p_score does not meet the minimum cutoff.
                 if p_score < p_score_cutoff:
                     return
 
-                f.write(",".join([
-                    fields[0],  # read_id
+                line = [
+                    read_id,
                     ref_id,
                     fields[3],  # pos
-                    str(len(fields[9])),  # length
+                    str(read_length),  # length
                     str(p_score)
-                ]) + "\n")
+                ]
+
+                f.write(",".join(line) + "\n")
+
+                if alignment_cache is not None:
+                    line[0] = fields[0]
+                    alignment_cache.add_line(ref_id, ",".join(line) + "\n")
+
+            try:
+                if alignment_cache is None or alignment_cache.entry_paths:
+                    with stream_reads(read_paths, self.params["analysis_path"], self.proc) as streamed_paths:
+                        self.run_subprocess(command + ["-U", ",".join(streamed_paths)], stdout_handler=stdout_handler)
+
+                if alignment_cache is not None:
+                    alignment_cache.save()
+
+                    if fastq_handle is None:
+                        fastq_handle = utils.open_fastq_writer(mapped_path, "a")
+
+                    merged = self.merge_alignment_cache(f, fastq_handle, read_names, alignment_cache.read_names)
+            finally:
+                if alignment_cache is not None:
+                    alignment_cache.close()
+
+                if fastq_handle is not None:
+                    fastq_handle.close()
+
+        if merged:
+            self.sort_vta(os.path.join(self.params["analysis_path"], "to_isolates.vta"))
+
+        if read_names is not None:
+            read_names.freeze()
+            self.intermediate["read_names"] = read_names
 
-            self.run_subprocess(command, stdout_handler=stdout_handler)
+    def merge_alignment_cache(self, vta_handle, fastq_handle, read_names, mapped_names):
+        """
+        Add the alignments stored in the alignment cache entries found by :meth:`generate_isolate_fasta` to the VTA
+        file and their reads to the mapped FASTQ file.
+
+        :param vta_handle: the open VTA file
+        :type vta_handle: file object
+
+        :param fastq_handle: the open mapped FASTQ file
+        :type fastq_handle: file object
+
+        :param read_names: the interned read names or ``None`` if read names are not interned
+        :type read_names: :class:`~virtool.pathoscope.utils.ReadNames`
+
+        :param mapped_names: the names of the reads already in the FASTQ file
+        :type mapped_names: set
+
+        :return: whether any cached alignments were added
+        :rtype: bool
+
+        """
+        merged = False
+
+        for entry_path in self.intermediate.pop("cached_alignments"):
+            with utils.open_reads(entry_path + ".fastq.gz") as f:
+                for record in zip(f, f, f, f):
+                    name = record[0][1:].rstrip().decode()
+
+                    if name in mapped_names:
+                        continue
+
+                    mapped_names.add(name)
+
+                    if read_names is not None:
+                        record = ("@{}\n".format(read_names.intern(name)).encode(),) + record[1:]
+
+                    fastq_handle.write(b"".join(record).decode())
+
+            with open(entry_path + ".vta", "r") as f:
+                for line in f:
+                    if read_names is not None:
+                        name, rest = line.split(",", 1)
+                        line = "{},{}".format(read_names.intern(name), rest)
+
+                    vta_handle.write(line)
+
+                    merged = True
+
+        return merged
+
+    def map_isolates_paired(self):
+        """
+        Using ``bowtie2 -1 -2``, map the sample read pairs to the index built using :meth:`.build_isolate_index`.
+
+        Each mapped mate is written to the VTA file as its own line, named after the pair, so coverage only counts
+        sequenced bases. Mates that aligned to the same reference as a pair share the summed score of the pair (see
+        :func:`~virtool.pathoscope.pathoscope.score_pair`). The matrix built from the VTA file then has one row per
+        fragment rather than one per mate.
+
+        Both mates of every pair with an alignment are written to ``mapped.1.fastq`` and ``mapped.2.fastq`` by the
+        stdout handler for :meth:`map_subtraction`. Read names are interned if the ``intern_read_ids`` param is set.
+
+        """
+        command = [
+            "bowtie2",
+            "-p", str(max(self.proc - 1, 1)),
+            "--no-unal",
+            "--no-discordant",
+            "--local",
+            "--score-min", "L,20,1.0",
+            "-N", "0",
+            "-L", "15",
+            "-k", "100",
+            "-x", os.path.join(self.params["analysis_path"], "isolates")
+        ]
+
+        read_names = None
+
+        if self.params["intern_read_ids"]:
+            read_names = utils.ReadNames()
+
+        context = pathoscope.SamPairContext()
+
+        vta_path = os.path.join(self.params["analysis_path"], "to_isolates.vta")
+
+        with open(vta_path, "w") as f, \
+                utils.open_fastq_writer(self.get_fastq_path("mapped.1")) as mate_1_handle, \
+                utils.open_fastq_writer(self.get_fastq_path("mapped.2")) as mate_2_handle:
+
+            fastq_handles = (mate_1_handle, mate_2_handle)
+
+            def write_records(records, p_score_cutoff=0.01):
+                read_id = records[0][1][0]
+
+                if read_names is not None:
+                    read_id = str(read_names.intern(read_id))
+
+                for mate, fields, _, new_sequence in records:
+                    if new_sequence:
+                        fastq_handles[mate].write(pathoscope.sam_to_fastq(fields, read_id))
+
+                for fields, read_length, p_score in pathoscope.score_pair(records):
+                    # Skip if the p_score does not meet the minimum cutoff.
+                    if p_score < p_score_cutoff:
+                        continue
+
+                    f.write(",".join([
+                        read_id,
+                        fields[2],  # ref_id
+                        fields[3],  # pos
+                        str(read_length),  # length
+                        str(p_score)
+                    ]) + "\n")
+
+            def stdout_handler(line):
+                line = line.decode()
+
+                if line[0] == "@" or line == "#":
+                    return
+
+                records = context.update(line.split("\t"))
+
+                if records is not None:
+                    write_records(records)
+
+            with stream_reads(self.params["read_paths"], self.params["analysis_path"], self.proc) as paths:
+                self.run_subprocess(command + ["-1", paths[0], "-2", paths[1]], stdout_handler=stdout_handler)
+
+            records = context.flush()
+
+            if records is not None:
+                write_records(records)
+
+        if read_names is not None:
+            read_names.freeze()
+            self.intermediate["read_names"] = read_names
 
     def map_subtraction(self):
         """
         Using ``bowtie2``, map the reads that were successfully mapped in :meth:`.map_isolates` to the subtraction host
         for the sample.
 
+        If the ``paired_mapping`` param is set, the mapped read pairs are mapped with ``-1`` and ``-2`` and each pair is
+        scored as in :meth:`map_isolates_paired`.
+
+        ``bowtie2`` is given one core less than the job, but at least one. It runs without ``--no-unal``, so the stdout
+        handler sees a line for every mapped read and is left a core of its own.
+
         """
+        if self.params["paired_mapping"]:
+            return self.map_subtraction_paired()
+
         command = [
             "bowtie2",
             "--local",
             "-N", "0",
-            "-p", str(self.proc - 1),
+            "-p", str(max(self.proc - 1, 1)),
             "-x", shlex.quote(self.params["subtraction_path"]),
-            "-U", os.path.join(self.params["analysis_path"], "mapped.fastq")
+            "-U", self.get_fastq_path("mapped")
         ]
 
         to_subtraction = dict()
@@ -283,16 +815,80 @@ class PathoscopeBowtie(Job):
             if fields[2] == "*":
                 return
 
-            to_subtraction[fields[0]] = pathoscope.find_sam_align_score(fields)
+            read_id = fields[0]
+
+            if self.params["intern_read_ids"]:
+                read_id = int(read_id)
+
+            to_subtraction[read_id] = pathoscope.find_sam_align_score(fields)
 
         self.run_subprocess(command, stdout_handler=stdout_handler)
 
         self.intermediate["to_subtraction"] = to_subtraction
 
+    def map_subtraction_paired(self):
+        """
+        Using ``bowtie2 -1 -2``, map the read pairs written by :meth:`map_isolates_paired` to the subtraction host for
+        the sample. The best score of each pair is recorded.
+
+        """
+        command = [
+            "bowtie2",
+            "--local",
+            "--no-discordant",
+            "-N", "0",
+            "-p", str(max(self.proc - 1, 1)),
+            "-x", shlex.quote(self.params["subtraction_path"]),
+            "-1", self.get_fastq_path("mapped.1"),
+            "-2", self.get_fastq_path("mapped.2")
+        ]
+
+        to_subtraction = dict()
+
+        context = pathoscope.SamPairContext()
+
+        def add_records(records):
+            scores = [p_score for _, _, p_score in pathoscope.score_pair(records)]
+
+            if scores:
+                read_id = records[0][1][0]
+
+                if self.params["intern_read_ids"]:
+                    read_id = int(read_id)
+
+                to_subtraction[read_id] = max(scores)
+
+        def stdout_handler(line):
+            line = line.decode()
+
+            if line[0] == "@" or line == "#":
+                return
+
+            records = context.update(line.split("\t"))
+
+            if records is not None:
+                add_records(records)
+
+        self.run_subprocess(command, stdout_handler=stdout_handler)
+
+        records = context.flush()
+
+        if records is not None:
+            add_records(records)
+
+        self.intermediate["to_subtraction"] = to_subtraction
+
     def subtract_mapping(self):
+        read_count = None
+
+        if self.params["intern_read_ids"]:
+            read_count = len(self.intermediate["read_names"])
+
         subtracted_count = pathoscope.subtract(
             self.params["analysis_path"],
-            self.intermediate["to_subtraction"]
+            self.intermediate["to_subtraction"],
+            read_count,
+            self.get_parse_processes() if self.vta_is_grouped() else 1
         )
 
         del self.intermediate["to_subtraction"]
@@ -304,10 +900,37 @@ class PathoscopeBowtie(Job):
         Run the Pathoscope reassignment algorithm. Tab-separated output is written to ``pathoscope.tsv``. Results are
         also parsed and saved to :attr:`intermediate`.
 
+        If the ``otu_summary`` param is set, the hits are also aggregated by OTU with
+        :func:`~virtool.pathoscope.utils.aggregate_otus` and stored in the ``otus`` field of the results. Coverage
+        statistics for the summaries are collected while the hits are described, so coverage lists are only read once.
+
         """
         vta_path = os.path.join(self.params["analysis_path"], "to_isolates.vta")
         reassigned_path = os.path.join(self.params["analysis_path"], "reassigned.vta")
 
+        memory_budget = None
+
+        if self.params["em_memory_budget"]:
+            memory_budget = int(self.params["em_memory_budget"] * 1024 ** 3)
+
+            # The out of core matrix needs each read's alignments to be contiguous.
+            if not self.vta_is_grouped():
+                self.sort_vta(vta_path)
+
+        warm_start = self.get_warm_start() or dict()
+
+        stopping = None
+
+        if self.params["em_stopping"]:
+            stopping = convergence.get_policies(self.params["em_stopping"])
+
+        profile_events = list()
+
+        def record_event(event, info):
+            profile_events.append(dict(info, event=event))
+
+        profiler = record_event if self.params["profile"] else None
+
         (
             best_hit_initial_reads,
             best_hit_initial,
@@ -319,11 +942,39 @@ class PathoscopeBowtie(Job):
             level_2_final,
             init_pi,
             pi,
+            theta,
             refs,
-            reads
-        ) = run_patho(vta_path, reassigned_path)
+            read_count
+        ) = run_patho(
+            vta_path,
+            reassigned_path,
+            sharded=self.params["sharded_em"],
+            threads=self.proc,
+            memory_budget=memory_budget,
+            start_pi=warm_start.get("pi"),
+            start_theta=warm_start.get("theta"),
+            prune_threshold=self.params["em_prune_threshold"],
+            paired=self.params["paired_mapping"],
+            grouped=self.vta_is_grouped(),
+            processes=self.get_parse_processes(),
+            profiler=profiler,
+            stopping=stopping
+        )
+
+        if self.params["profile"]:
+            utils.write_profile(os.path.join(self.params["analysis_path"], "profile.json"), profile_events)
 
-        read_count = len(reads)
+        # Keep the final estimates so later analyses of the sample can be warm started from them.
+        with open(os.path.join(self.params["analysis_path"], "em.json"), "w") as f:
+            json.dump({
+                "pi": dict(zip(refs, pi)),
+                "theta": dict(zip(refs, theta))
+            }, f)
+
+        binary_report_path = None
+
+        if self.params["binary_report"]:
+            binary_report_path = os.path.join(self.params["analysis_path"], "report.npz")
 
         report = pathoscope.write_report(
             os.path.join(self.params["analysis_path"], "report.tsv"),
@@ -338,12 +989,14 @@ class PathoscopeBowtie(Job):
             level_1_initial,
             level_2_initial,
             level_1_final,
-            level_2_final
+            level_2_final,
+            binary_path=binary_report_path
         )
 
         self.intermediate["coverage"] = pathoscope.calculate_coverage(
             reassigned_path,
-            self.intermediate["ref_lengths"]
+            self.intermediate["ref_lengths"],
+            self.get_parse_processes()
         )
 
         self.results = {
@@ -352,6 +1005,11 @@ class PathoscopeBowtie(Job):
             "diagnosis": list()
         }
 
+        if "prefilter" in self.intermediate:
+            self.results["prefilter"] = self.intermediate["prefilter"]
+
+        coverage_stats = dict()
+
         for ref_id, hit in report.items():
             # Get the otu info for the sequence id.
             otu = self.intermediate["otu_dict"][self.intermediate["sequence_otu_map"][ref_id]]
@@ -371,42 +1029,217 @@ class PathoscopeBowtie(Job):
             # Attach coverage list to hit dict.
             hit["align"] = hit_coverage
 
+            uncovered_count = hit_coverage.count(0)
+            depth_sum = sum(hit_coverage)
+
             # Calculate coverage and attach to hit.
-            hit["coverage"] = round(1 - hit_coverage.count(0) / len(hit_coverage), 3)
+            hit["coverage"] = round(1 - uncovered_count / len(hit_coverage), 3)
 
             # Calculate depth and attach to hit.
-            hit["depth"] = round(sum(hit_coverage) / len(hit_coverage))
+            hit["depth"] = round(depth_sum / len(hit_coverage))
+
+            coverage_stats[ref_id] = (len(hit_coverage), len(hit_coverage) - uncovered_count, depth_sum)
+
+            # Attach binned coverage for display.
+            if self.params["coverage_pyramids"]:
+                hit["pyramid"] = utils.coverage_pyramid(hit_coverage)
 
             self.results["diagnosis"].append(hit)
 
+        if self.params["otu_summary"]:
+            self.results["otus"] = utils.aggregate_otus(
+                self.results["diagnosis"],
+                self.intermediate["sequence_otu_map"],
+                coverage_stats
+            )
+
+    def sort_vta(self, path):
+        """
+        Sort the VTA file at ``path`` in place by read name with ``sort`` so the alignments of each read are contiguous.
+        The memory used by ``sort`` is limited to the ``em_memory_budget`` param if it is set.
+
+        :param path: the path to the VTA file
+        :type path: str
+
+        """
+        command = [
+            "sort",
+            "-t", ",",
+            "-k", "1,1",
+            "-T", self.params["analysis_path"],
+            "-o", path,
+            path
+        ]
+
+        if self.params["em_memory_budget"]:
+            command[5:5] = ["-S", "{}M".format(max(1, int(self.params["em_memory_budget"] * 1024)))]
+
+        self.run_subprocess(command)
+
+    def get_parse_processes(self):
+        """
+        Get the number of processes to parse VTA files with. This is the number of cores available to the job if the
+        ``parallel_parsing`` param is set and one otherwise.
+
+        :return: the number of processes
+        :rtype: int
+
+        """
+        if self.params["parallel_parsing"]:
+            return self.proc
+
+        return 1
+
+    def vta_is_grouped(self):
+        """
+        Check if the alignments of each read are contiguous in ``to_isolates.vta``. This is the case for ``bowtie2``
+        output unless mates were mapped as separate single reads. Files with merged cached alignments are sorted by
+        read in :meth:`map_isolates`.
+
+        :return: whether the VTA file is grouped by read
+        :rtype: bool
+
+        """
+        if self.params["paired"] and not self.params["paired_mapping"]:
+            return False
+
+        return True
+
+    def get_warm_start(self):
+        """
+        Get starting values for EM from the JSON file at the ``warm_start_path`` param or from the analysis identified
+        by the ``warm_start_analysis_id`` param. Returns ``None`` if neither is set.
+
+        The starting values are returned as a dict containing ``pi`` and optionally ``theta``, each keyed by sequence
+        id, in the format written to ``em.json`` by :meth:`pathoscope`. Analyses that have no ``em.json`` file fall back
+        to the final pi values in their diagnosis. ``None`` is returned if the analysis does not exist, belongs to
+        another sample or has no diagnosis yet.
+
+        """
+        path = self.params["warm_start_path"]
+        analysis_id = self.params["warm_start_analysis_id"]
+
+        if path is None and analysis_id:
+            path = utils.get_em_json_path(self.settings["data_path"], analysis_id, self.params["sample_id"])
+
+            if not os.path.isfile(path):
+                document = self.db.analyses.find_one({
+                    "_id": analysis_id,
+                    "sample.id": self.params["sample_id"]
+                }, ["diagnosis"])
+
+                if document is None or not document.get("diagnosis"):
+                    return None
+
+                diagnosis = document["diagnosis"]
+
+                if diagnosis == "file":
+                    json_path = utils.get_pathoscope_json_path(
+                        self.settings["data_path"],
+                        analysis_id,
+                        self.params["sample_id"]
+                    )
+
+                    if os.path.isfile(utils.get_results_index_path(json_path)):
+                        diagnosis = utils.read_results_summary(json_path)["diagnosis"]
+                    else:
+                        with open(json_path, "r") as f:
+                            diagnosis = json.load(f)["diagnosis"]
+
+                return {
+                    "pi": {hit["id"]: hit["final"]["pi"] for hit in diagnosis}
+                }
+
+        if path is None:
+            return None
+
+        with open(path, "r") as f:
+            return json.load(f)
+
     def import_results(self):
         """
         Commits the results to the database. Data includes the output of Pathoscope, final mapped read count,
         and viral genome coverage maps.
 
+        If the ``coverage_file`` or ``coverage_pyramids`` param is set, the per-base coverage lists are moved to
+        ``coverage.bin`` by :meth:`store_coverage`. If the results are too large to store in a single document, they
+        are streamed to an indexed ``pathoscope.json`` by :func:`~virtool.pathoscope.utils.write_results` and the
+        diagnosis in the analysis document is set to ``"file"``.
+
         Once the import is complete, :meth:`cleanup_index_files` is called to remove
         any otu indexes that may become unused when this analysis completes.
 
         """
-        analysis_id = self.params["analysis_id"]
+        results = self.results
+
+        if self.params["coverage_file"] or self.params["coverage_pyramids"]:
+            results = self.store_coverage()
 
         try:
-            self.db.analyses.update_one({"_id": analysis_id}, {
-                "$set": self.results
+            self.update_analysis({
+                "$set": results
             })
+
+            return
         except pymongo.errors.DocumentTooLarge:
-            with open(os.path.join(self.params["analysis_path"], "pathoscope.json"), "w") as f:
-                json_string = json.dumps(self.results)
-                f.write(json_string)
-
-            self.db.analyses.update_one({"_id": analysis_id}, {
-                "$set": {
-                    "diagnosis": "file",
-                    "ready": True
-                }
-            })
+            pass
 
-            self.dispatch("analyses", "update", [analysis_id])
+        utils.write_results(os.path.join(self.params["analysis_path"], "pathoscope.json"), results)
+
+        self.update_analysis({
+            "$set": {
+                "diagnosis": "file",
+                "ready": True
+            }
+        })
+
+        self.dispatch("analyses", "update", [self.params["analysis_id"]])
+
+    def update_analysis(self, update):
+        """
+        Apply ``update`` to the analysis document.
+
+        The write concern is taken from the ``results_write_concern`` setting (see
+        :func:`~virtool.pathoscope.db.get_write_concern`). If the ``db_shared_client`` and ``db_batch_writes``
+        settings are both true, the update is batched with those of the other jobs in the process by a shared
+        :class:`~virtool.pathoscope.db.BulkWriter`.
+
+        :param update: the update to apply
+        :type update: dict
+
+        """
+        collection = self.db.analyses.with_options(write_concern=db.get_write_concern(self.settings))
+
+        query = {"_id": self.params["analysis_id"]}
+
+        if self.settings.get("db_shared_client") and self.settings.get("db_batch_writes"):
+            db.get_bulk_writer(self.db_connection_string, collection).update_one(query, update)
+        else:
+            collection.update_one(query, update)
+
+    def store_coverage(self):
+        """
+        Write the per-base coverage lists of the diagnosed hits to ``coverage.bin`` using
+        :func:`~virtool.pathoscope.utils.write_coverage`.
+
+        Returns a copy of the results in which each hit's ``align`` field is replaced with ``"file"``. The results are
+        returned unchanged if there is no diagnosis list.
+
+        :return: the results without coverage lists
+        :rtype: dict
+
+        """
+        diagnosis = self.results.get("diagnosis")
+
+        if not isinstance(diagnosis, list):
+            return self.results
+
+        utils.write_coverage(
+            os.path.join(self.params["analysis_path"], "coverage.bin"),
+            ((hit["id"], hit["align"]) for hit in diagnosis)
+        )
+
+        return dict(self.results, diagnosis=[dict(hit, align="file") for hit in diagnosis])
 
     def cleanup(self):
         """
@@ -425,26 +1258,321 @@ class PathoscopeBowtie(Job):
         pass
 
 
-def run_patho(vta_path, reassigned_path):
-    u, nu, refs, reads = pathoscope.build_matrix(vta_path)
+class AlignmentCacheWriter:
+    """
+    Writes the alignments of the sequences that are missing from the alignment cache to new cache entries while
+    :meth:`PathoscopeBowtie.map_isolates` runs.
 
-    best_hit_initial_reads, best_hit_initial, level_1_initial, level_2_initial = pathoscope.compute_best_hit(
-        u,
-        nu,
-        refs,
-        reads
-    )
+    Each entry is named after the digest of its sequence (see :func:`~virtool.pathoscope.utils.get_sequence_digest`)
+    and has two files:
 
-    init_pi, pi, _, nu = pathoscope.em(u, nu, refs, 50, 1e-7, 0, 0)
+    - ``<digest>.vta``: the VTA lines for the sequence, using read names rather than interned ids
+    - ``<digest>.fastq.gz``: every read with an alignment to the sequence
 
-    best_hit_final_reads, best_hit_final, level_1_final, level_2_final = pathoscope.compute_best_hit(
-        u,
-        nu,
-        refs,
-        reads
-    )
+    Alignments are streamed to a temporary pair of files for each entry as they arrive, so one file handle is held open
+    for each file. The temporary files are renamed by :meth:`save`. The VTA file is renamed last, so an interrupted
+    save is never loaded.
+
+    :param entry_paths: the entry path for each sequence id, without an extension
+    :type entry_paths: dict
+
+    """
+
+    def __init__(self, entry_paths):
+        self.entry_paths = entry_paths
+
+        #: The names of all of the reads that aligned.
+        self.read_names = set()
+
+        self._vta_handles = dict()
+        self._fastq_handles = dict()
+
+        self._name = None
+        self._record = None
+        self._ref_ids = set()
+
+    def add_read(self, fields):
+        """
+        Add the read in the split SAM line ``fields`` to the entry for the sequence it aligned to.
+
+        :param fields: a line that has been split on "\t"
+        :type fields: list
+
+        """
+        name = fields[0]
+
+        if name != self._name:
+            self._name = name
+            self._record = None
+            self._ref_ids = set()
+
+            self.read_names.add(name)
+
+        if self._record is None and fields[9] != "*":
+            self._record = pathoscope.sam_to_fastq(fields, name)
+
+        ref_id = fields[2]
+
+        if self._record is not None and ref_id not in self._ref_ids:
+            self._ref_ids.add(ref_id)
+            self._get_handle(self._fastq_handles, ref_id, ".fastq.gz").write(self._record)
+
+    def add_line(self, ref_id, line):
+        self._get_handle(self._vta_handles, ref_id, ".vta").write(line)
+
+    def _get_handle(self, handles, sequence_id, extension):
+        handle = handles.get(sequence_id)
+
+        if handle is None:
+            entry_path = self.entry_paths[sequence_id]
+
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
 
-    pathoscope.rewrite_align(u, nu, vta_path, 0.01, reassigned_path)
+            opener = utils.open_fastq_writer if extension == ".fastq.gz" else open
+
+            handle = handles[sequence_id] = opener(entry_path + ".tmp" + extension, "w")
+
+        return handle
+
+    def close(self):
+        """
+        Close the temporary files without saving the entries.
+
+        """
+        for handles in (self._fastq_handles, self._vta_handles):
+            for handle in handles.values():
+                handle.close()
+
+            handles.clear()
+
+    def save(self):
+        """
+        Move the temporary files into place as cache entries. Sequences without any alignments get empty entries, so
+        they are not mapped again.
+
+        """
+        self.close()
+
+        for entry_path in self.entry_paths.values():
+            for extension in (".fastq.gz", ".vta"):
+                temp_path = entry_path + ".tmp" + extension
+
+                if not os.path.isfile(temp_path):
+                    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+                    # An empty gzip file still needs a header, so the FASTQ writer is used for both files.
+                    utils.open_fastq_writer(temp_path).close()
+
+                os.replace(temp_path, entry_path + extension)
+
+
+def get_decompress_command(path, threads=1):
+    """
+    Get a command that writes the decompressed contents of the read file at ``path`` to stdout, or ``None`` if
+    ``bowtie2`` can read the file directly.
+
+    Files compressed with zstd are decompressed with ``zstd``. Files compressed with gzip are decompressed with
+    ``pigz`` if it is installed, which is faster than the decompression built into ``bowtie2``.
+
+    """
+    if path.endswith(".zst"):
+        return ["zstd", "-dcq", path]
+
+    if path.endswith(".gz") and shutil.which("pigz"):
+        return ["pigz", "-dc", "-p", str(threads), path]
+
+    return None
+
+
+@contextlib.contextmanager
+def stream_reads(read_paths, directory, threads=1):
+    """
+    Stream compressed read files to ``bowtie2`` through named pipes created in ``directory``.
+
+    Each file that needs decompressing (see :func:`get_decompress_command`) is replaced with a named pipe fed by a
+    decompression process, so decompression runs in parallel with alignment and nothing is written to disk. Other paths
+    are passed through unchanged.
+
+    The decompression processes are checked when the block exits. A :class:`subprocess.CalledProcessError` is raised
+    if any of them failed, since ``bowtie2`` would have seen truncated input.
+
+    :param read_paths: the paths to the read files
+    :type read_paths: list
+
+    :param directory: the directory to create the named pipes in
+    :type directory: str
+
+    :param threads: the number of threads each decompression process can use
+    :type threads: int
+
+    """
+    paths = list()
+    pipes = list()
+    processes = list()
+
+    try:
+        for i, path in enumerate(read_paths):
+            command = get_decompress_command(path, threads)
+
+            if command is None:
+                paths.append(path)
+                continue
+
+            pipe_path = os.path.join(directory, "reads_{}.pipe".format(i + 1))
+
+            os.mkfifo(pipe_path)
+            pipes.append(pipe_path)
+
+            # The shell opens the pipe so that this process does not block until bowtie2 opens the other end.
+            processes.append(subprocess.Popen([
+                "sh",
+                "-c",
+                'exec "$@" > "$0"',
+                pipe_path
+            ] + command))
+
+            paths.append(pipe_path)
+
+        yield paths
+
+        for process in processes:
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+        for pipe_path in pipes:
+            os.remove(pipe_path)
+
+
+def run_patho(vta_path, reassigned_path, sharded=False, threads=1, memory_budget=None, start_pi=None,
+              start_theta=None, prune_threshold=None, paired=False, grouped=False, processes=1, profiler=None,
+              stopping=None):
+    """
+    Run Pathoscope reassignment on the VTA file at ``vta_path`` and write the reassigned alignments to
+    ``reassigned_path``.
+
+    If ``sharded`` is ``True``, EM is run by :func:`virtool.pathoscope.matrix.em` in ``threads`` threads instead of by
+    :func:`virtool.pathoscope.pathoscope.em`.
+
+    If ``memory_budget`` is given in bytes, reassignment is done out of core by :func:`run_patho_chunked` instead.
+
+    EM can be warm started by passing ``start_pi`` and ``start_theta`` as dicts keyed by reference id. They are mapped
+    onto the references in the VTA file by :func:`~virtool.pathoscope.pathoscope.map_start_values`.
+
+    Setting ``prune_threshold`` drops the non-unique read entries of negligible references during EM (see
+    :func:`virtool.pathoscope.matrix.em`). It is only supported by the sharded and out of core implementations, so it
+    switches EM to the sharded engine even if ``sharded`` is not set.
+
+    Set ``paired`` if the VTA file was written by
+    :meth:`~virtool.pathoscope.job.PathoscopeBowtie.map_isolates_paired` so that both mates of each fragment are kept
+    in the reassigned alignments.
+
+    Set ``grouped`` if the alignments of each read are contiguous in the VTA file so the read matrix can be built by
+    :func:`~virtool.pathoscope.pathoscope.build_matrix_grouped`. The file is then parsed in ``processes`` processes.
+    A file that turns out not to be grouped is detected and parsed without grouping instead.
+
+    If ``profiler`` is given, it is called with an event name and a dict of info to report:
+
+    - ``phase``: the duration and peak memory use of each phase (see :func:`~virtool.pathoscope.utils.profile_phase`)
+    - ``matrix``: the number of ``reads``, ``refs`` and non-zero entries (``nnz``) in the read matrix
+    - ``em_iteration``: the change in pi and duration of each EM iteration
+
+    EM stops when the summed change in pi is at most ``1e-7`` unless a list of
+    :mod:`~virtool.pathoscope.convergence` policies is passed as ``stopping``.
+
+    """
+    if memory_budget is not None:
+        return run_patho_chunked(
+            vta_path,
+            reassigned_path,
+            threads,
+            memory_budget,
+            start_pi,
+            start_theta,
+            prune_threshold,
+            paired,
+            profiler,
+            stopping
+        )
+
+    with utils.profile_phase(profiler, "build_matrix"):
+        u, nu, refs, reads, index = pathoscope.build_matrix(
+            vta_path,
+            return_index=True,
+            grouped=grouped,
+            processes=processes
+        )
+
+    if profiler is not None:
+        profiler("matrix", {
+            "reads": len(reads),
+            "refs": len(refs),
+            "nnz": len(u) + sum(len(nu[i][0]) for i in nu)
+        })
+
+    start_pi, start_theta = map_warm_start(refs, start_pi, start_theta)
+
+    with utils.profile_phase(profiler, "compute_best_hit_initial"):
+        best_hit_initial_reads, best_hit_initial, level_1_initial, level_2_initial = pathoscope.compute_best_hit(
+            u,
+            nu,
+            refs,
+            reads
+        )
+
+    with utils.profile_phase(profiler, "em"):
+        if sharded or prune_threshold is not None:
+            read_matrix = matrix.ReadMatrix.from_dicts(u, nu, len(refs))
+
+            init_pi, pi, theta, x_norms = matrix.em(
+                read_matrix,
+                50,
+                1e-7,
+                0,
+                0,
+                threads,
+                start_pi,
+                start_theta,
+                prune_threshold,
+                profiler,
+                stopping
+            )
+
+            read_matrix.update_nu(nu, x_norms)
+
+            init_pi = init_pi.tolist()
+            pi = pi.tolist()
+            theta = theta.tolist()
+        else:
+            init_pi, pi, theta, nu = pathoscope.em(
+                u,
+                nu,
+                refs,
+                50,
+                1e-7,
+                0,
+                0,
+                start_pi,
+                start_theta,
+                profiler,
+                stopping
+            )
+
+    with utils.profile_phase(profiler, "compute_best_hit_final"):
+        best_hit_final_reads, best_hit_final, level_1_final, level_2_final = pathoscope.compute_best_hit(
+            u,
+            nu,
+            refs,
+            reads
+        )
+
+    with utils.profile_phase(profiler, "rewrite_align"):
+        pathoscope.rewrite_align(u, nu, vta_path, 0.01, reassigned_path, index=index, paired=paired)
 
     return (
         best_hit_initial_reads,
@@ -457,6 +1585,95 @@ def run_patho(vta_path, reassigned_path):
         level_2_final,
         init_pi,
         pi,
+        theta,
         refs,
-        reads
+        len(reads)
     )
+
+
+def run_patho_chunked(vta_path, reassigned_path, threads, memory_budget, start_pi=None, start_theta=None,
+                      prune_threshold=None, paired=False, profiler=None, stopping=None):
+    """
+    Run Pathoscope reassignment with the read matrix stored in memory-mapped chunk files in a ``matrix`` directory next
+    to ``vta_path``. The chunks are streamed through each EM iteration so memory use stays within ``memory_budget``
+    bytes. The alignments for each read must be contiguous in the VTA file.
+
+    The same events as in :func:`run_patho` are reported to ``profiler`` and EM is stopped by ``stopping`` the same
+    way.
+
+    """
+    chunk_path = os.path.join(os.path.dirname(vta_path), "matrix")
+
+    with utils.profile_phase(profiler, "build_matrix"):
+        read_matrix, refs, read_count = matrix.build_chunked(vta_path, chunk_path, 0.01, memory_budget, threads)
+
+    if profiler is not None:
+        profiler("matrix", {
+            "reads": read_count,
+            "refs": len(refs),
+            "nnz": read_matrix.nnz
+        })
+
+    start_pi, start_theta = map_warm_start(refs, start_pi, start_theta)
+
+    with utils.profile_phase(profiler, "compute_best_hit_initial"):
+        best_hit_initial_reads, best_hit_initial, level_1_initial, level_2_initial = matrix.compute_best_hit(
+            read_matrix,
+            read_count
+        )
+
+    with utils.profile_phase(profiler, "em"):
+        init_pi, pi, theta, _ = matrix.em(
+            read_matrix,
+            50,
+            1e-7,
+            0,
+            0,
+            threads,
+            start_pi,
+            start_theta,
+            prune_threshold,
+            profiler,
+            stopping
+        )
+
+    with utils.profile_phase(profiler, "compute_best_hit_final"):
+        best_hit_final_reads, best_hit_final, level_1_final, level_2_final = matrix.compute_best_hit(
+            read_matrix,
+            read_count
+        )
+
+    with utils.profile_phase(profiler, "rewrite_align"):
+        matrix.rewrite_align(read_matrix, vta_path, 0.01, reassigned_path, paired)
+
+    shutil.rmtree(chunk_path)
+
+    return (
+        best_hit_initial_reads,
+        best_hit_initial,
+        level_1_initial,
+        level_2_initial,
+        best_hit_final_reads,
+        best_hit_final,
+        level_1_final,
+        level_2_final,
+        init_pi.tolist(),
+        pi.tolist(),
+        theta.tolist(),
+        refs,
+        read_count
+    )
+
+
+def map_warm_start(refs, start_pi, start_theta):
+    """
+    Map warm start values keyed by reference id onto ``refs``. Values that are not given are returned as ``None``.
+
+    """
+    if start_pi is not None:
+        start_pi = pathoscope.map_start_values(start_pi, refs)
+
+    if start_theta is not None:
+        start_theta = pathoscope.map_start_values(start_theta, refs)
+
+    return start_pi, start_theta
@@ -0,0 +1,273 @@
+"""
+A k-mer prefilter for discarding reads that share no sequence with a reference before they are aligned.
+
+"""
+import itertools
+import os
+
+import numpy as np
+
+import virtool.pathoscope.utils as utils
+
+#: The default k-mer size. Codes for k-mers up to 31 bases long fit in 64 bits.
+K = 21
+
+#: By default, keep the k-mers whose hash is divisible by this number. Larger values make smaller sketches but miss
+#: more reads with few matching k-mers.
+SAMPLE = 4
+
+#: The number of leading hash bits used to index the sketch's lookup table.
+TABLE_BITS = 24
+
+#: The number of reads parsed and filtered together.
+BATCH_SIZE = 65536
+
+#: Maps nucleotide bytes to 2-bit codes. Other bytes map to 4 and break k-mers.
+BASE_CODES = np.full(256, 4, dtype=np.uint64)
+BASE_CODES[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+
+def get_sketch_path(index_path, k=K, sample=SAMPLE):
+    """
+    Get the path of the sketch for the ``bowtie2`` index at ``index_path``. The sketch is stored next to the index.
+
+    """
+    return "{}.k{}.s{}.kmers.npz".format(index_path, k, sample)
+
+
+def hash_codes(codes):
+    """
+    Mix 64-bit k-mer codes so that sampling by divisibility picks k-mers evenly.
+
+    """
+    with np.errstate(over="ignore"):
+        hashes = codes * np.uint64(0x9E3779B97F4A7C15)
+
+    return hashes ^ (hashes >> np.uint64(29))
+
+
+def window_codes(bases, k):
+    """
+    Encode every window of ``k`` bases in ``bases`` with 2 bits per base. Codes for longer windows are built by joining
+    the codes of shorter ones, so only about ``2 * log2(k)`` array operations are needed.
+
+    :param bases: the 2-bit code of each base
+    :type bases: :class:`numpy.ndarray`
+
+    :param k: the window size
+    :type k: int
+
+    :return: the code of the window starting at each position
+    :rtype: :class:`numpy.ndarray`
+
+    """
+    codes = None
+    length = 0
+
+    power = bases
+    power_length = 1
+
+    while True:
+        if k & 1:
+            if codes is None:
+                codes = power
+            else:
+                count = len(codes) - power_length
+                codes = (codes[:count] << np.uint64(2 * power_length)) | power[length:length + count]
+
+            length += power_length
+
+        k >>= 1
+
+        if not k:
+            return codes
+
+        power = (power[:-power_length] << np.uint64(2 * power_length)) | power[power_length:]
+        power_length *= 2
+
+
+def sampled_kmers(sequence, k=K, sample=SAMPLE):
+    """
+    Find the sampled canonical k-mers in ``sequence``. Several sequences can be processed at once by joining them with
+    a byte that is not a nucleotide, such as ``N``.
+
+    Each k-mer is encoded with 2 bits per base and the smaller of the codes for the k-mer and its reverse complement is
+    used, so reads match regardless of strand. K-mers containing bases other than ``ACGT`` are skipped.
+
+    :param sequence: the sequence
+    :type sequence: bytes
+
+    :param k: the k-mer size
+    :type k: int
+
+    :param sample: keep k-mers whose hash is divisible by this number
+    :type sample: int
+
+    :return: the start positions and hashes of the sampled k-mers
+    :rtype: tuple
+
+    """
+    bases = BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+
+    count = len(bases) - k + 1
+
+    if count < 1:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+
+    invalid = np.concatenate(([0], np.cumsum(bases == 4)))
+
+    valid = invalid[k:] == invalid[:count]
+
+    bases[bases == 4] = 0
+
+    forward = window_codes(bases, k)
+
+    # The reverse complement of the window at i is the window at count - 1 - i of the reverse complemented sequence.
+    reverse = window_codes(np.uint64(3) - bases[::-1], k)[::-1]
+
+    hashes = hash_codes(np.minimum(forward, reverse))
+
+    keep = valid & (hashes % np.uint64(sample) == 0)
+
+    return np.flatnonzero(keep), hashes[keep]
+
+
+class KmerSketch:
+    """
+    A sorted set of sampled k-mer hashes from a set of reference sequences.
+
+    A table flagging the leading bits of the hashes in the sketch is used to reject most absent hashes before the
+    sorted hashes are searched.
+
+    """
+
+    def __init__(self, hashes, k=K, sample=SAMPLE):
+        self.hashes = hashes
+        self.k = k
+        self.sample = sample
+
+        self._table = np.zeros(2 ** TABLE_BITS, dtype=bool)
+        self._table[hashes >> np.uint64(64 - TABLE_BITS)] = True
+
+    @classmethod
+    def build(cls, sequences, k=K, sample=SAMPLE):
+        """
+        Build a sketch from an iterable of reference sequences.
+
+        :param sequences: the sequences as :class:`bytes`
+        :type sequences: iterable
+
+        :return: the sketch
+        :rtype: :class:`KmerSketch`
+
+        """
+        hashes = [np.zeros(0, dtype=np.uint64)]
+
+        for sequence in sequences:
+            hashes.append(np.unique(sampled_kmers(sequence, k, sample)[1]))
+
+        return cls(np.unique(np.concatenate(hashes)), k, sample)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["hashes"], int(data["k"]), int(data["sample"]))
+
+    def save(self, path):
+        """
+        Save the sketch to ``path``. The file is written under a temporary name and then moved into place so a partly
+        written sketch is never loaded.
+
+        """
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, hashes=self.hashes, k=self.k, sample=self.sample)
+
+        os.replace(path + ".tmp", path)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def contains(self, hashes):
+        """
+        Check which of ``hashes`` are in the sketch.
+
+        :param hashes: the hashes to check
+        :type hashes: :class:`numpy.ndarray`
+
+        :return: a boolean mask
+        :rtype: :class:`numpy.ndarray`
+
+        """
+        found = self._table[hashes >> np.uint64(64 - TABLE_BITS)]
+
+        candidates = np.flatnonzero(found)
+
+        positions = np.minimum(np.searchsorted(self.hashes, hashes[candidates]), len(self.hashes) - 1)
+
+        found[candidates] = self.hashes[positions] == hashes[candidates]
+
+        return found
+
+    def match_reads(self, sequences):
+        """
+        Find the sequences in a batch that share at least one sampled k-mer with the sketch.
+
+        :param sequences: the read sequences as :class:`bytes`
+        :type sequences: list
+
+        :return: a boolean mask over ``sequences``
+        :rtype: :class:`numpy.ndarray`
+
+        """
+        starts = np.cumsum([0] + [len(sequence) + 1 for sequence in sequences[:-1]])
+
+        positions, hashes = sampled_kmers(b"N".join(sequences), self.k, self.sample)
+
+        matched = np.zeros(len(sequences), dtype=bool)
+        matched[np.searchsorted(starts, positions[self.contains(hashes)], side="right") - 1] = True
+
+        return matched
+
+
+def filter_fastq(sketch, read_paths, output_path, batch_size=BATCH_SIZE):
+    """
+    Stream the FASTQ files at ``read_paths`` and write the reads that share at least one sampled k-mer with ``sketch``
+    to ``output_path``. Compressed read files are read with :func:`~virtool.pathoscope.utils.open_reads` and the output
+    is compressed if ``output_path`` ends in ``.gz``.
+
+    :param sketch: the reference sketch
+    :type sketch: :class:`KmerSketch`
+
+    :param read_paths: the paths to the FASTQ files
+    :type read_paths: list
+
+    :param output_path: the path to write the passing reads to
+    :type output_path: str
+
+    :return: the number of reads read and the number written
+    :rtype: tuple
+
+    """
+    read_count = 0
+    passed_count = 0
+
+    with utils.open_fastq_writer(output_path, "wb") as output:
+        for path in read_paths:
+            with utils.open_reads(path) as f:
+                records = zip(f, f, f, f)
+
+                while True:
+                    batch = list(itertools.islice(records, batch_size))
+
+                    if not batch:
+                        break
+
+                    matched = sketch.match_reads([record[1].rstrip() for record in batch])
+
+                    for record in itertools.compress(batch, matched):
+                        output.writelines(record)
+
+                    read_count += len(batch)
+                    passed_count += int(matched.sum())
+
+    return read_count, passed_count
@@ -0,0 +1,844 @@
+"""
+A sharded, sparse representation of the Pathoscope read matrix and an EM implementation that works on it.
+
+Non-unique reads are split into shards of consecutive reads stored in CSR form. Each EM iteration computes the E step
+for every shard independently, so shards can be processed in parallel by a thread pool. NumPy releases the GIL for the
+array operations that make up the bulk of the work. Partial sums are always reduced in shard order, which keeps results
+identical no matter how many threads are used.
+
+"""
+import array
+import collections
+import concurrent.futures
+import itertools
+import os
+import time
+
+import numpy as np
+
+import virtool.pathoscope.convergence as convergence
+
+#: The default number of non-unique reads in each shard.
+SHARD_SIZE = 65536
+
+#: A generous estimate of the memory needed per VTA line while a chunk is built or streamed through EM.
+ENTRY_BYTES = 96
+
+#: Line kinds recorded for each chunk of a :class:`ChunkedReadMatrix`. Filtered lines are never written by
+#: :func:`rewrite_align`. Only the first line of a unique read is written. Lines of non-unique reads are written if
+#: their normalized score meets the cutoff.
+LINE_FILTERED = 0
+LINE_UNIQUE_FIRST = 1
+LINE_UNIQUE_DUPLICATE = 2
+LINE_MULTI = 3
+
+#: A block of consecutive non-unique reads in CSR form. The entries for the read at ``rows[i]`` are found at
+#: ``indptr[i]:indptr[i + 1]`` in ``indices`` (reference indexes) and ``scores`` (rescaled scores). ``weights`` holds
+#: the highest score for each read.
+Shard = collections.namedtuple("Shard", ["rows", "indptr", "indices", "scores", "weights"])
+
+
+class ReadMatrix:
+    """
+    Holds the unique reads as flat arrays of reference indexes and scores and the non-unique reads as a list of
+    :class:`Shard` objects.
+
+    The normalized scores for each shard are kept in :attr:`x_norms`. They start out as the scores normalized per read
+    and are updated by :func:`em`.
+
+    """
+
+    def __init__(self, ref_count, unique_refs, unique_scores, shards):
+        self.ref_count = ref_count
+        self.unique_refs = unique_refs
+        self.unique_scores = unique_scores
+        self.shards = shards
+        self.x_norms = [normalize(shard) for shard in shards]
+
+        self._active = dict()
+
+    @classmethod
+    def from_dicts(cls, u, nu, ref_count, shard_size=SHARD_SIZE):
+        """
+        Create a :class:`ReadMatrix` from the ``u`` and ``nu`` dicts returned by
+        :func:`~virtool.pathoscope.pathoscope.build_matrix`. The iteration order of ``nu`` is preserved.
+
+        """
+        unique_refs = np.fromiter((u[i][0] for i in u), dtype=np.int64, count=len(u))
+        unique_scores = np.fromiter((u[i][1] for i in u), dtype=float, count=len(u))
+
+        shards = list()
+
+        read_indexes = list(nu)
+
+        for start in range(0, len(read_indexes), shard_size):
+            rows = read_indexes[start:start + shard_size]
+
+            lengths = np.fromiter((len(nu[j][0]) for j in rows), dtype=np.int64, count=len(rows))
+
+            indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+
+            shards.append(Shard(
+                np.array(rows, dtype=np.int64),
+                indptr,
+                np.fromiter(itertools.chain.from_iterable(nu[j][0] for j in rows), dtype=np.int64, count=indptr[-1]),
+                np.fromiter(itertools.chain.from_iterable(nu[j][1] for j in rows), dtype=float, count=indptr[-1]),
+                np.fromiter((nu[j][3] for j in rows), dtype=float, count=len(rows))
+            ))
+
+        return cls(ref_count, unique_refs, unique_scores, shards)
+
+    @property
+    def nu_count(self):
+        return sum(len(shard.rows) for shard in self.shards)
+
+    @property
+    def nnz(self):
+        return len(self.unique_refs) + sum(len(shard.indices) for shard in self.shards)
+
+    def iter_unique(self):
+        """
+        Yield the reference indexes and scores of the unique reads as pairs of arrays.
+
+        """
+        yield self.unique_refs, self.unique_scores
+
+    def active_shard(self, j):
+        """
+        Get shard ``j`` without any entries removed by :meth:`prune` and the positions of its remaining entries in the
+        full shard. The positions are ``None`` if nothing has been pruned from the shard.
+
+        """
+        return self._active.get(j, (self.shards[j], None))
+
+    def set_active_shard(self, j, shard, positions):
+        self._active[j] = (shard, positions)
+
+    def reset_active_shards(self):
+        self._active.clear()
+
+    def prune(self, pruned_refs):
+        """
+        Remove the entries for the references flagged in the boolean array ``pruned_refs`` from the active shards. Reads
+        whose references would all be removed are left alone. The references themselves stay in the matrix, so
+        ``ref_count`` and the column indexes do not change.
+
+        """
+        for j in range(len(self.shards)):
+            shard, positions = self.active_shard(j)
+
+            pruned = prune_shard(shard, positions, pruned_refs)
+
+            if pruned is not None:
+                self.set_active_shard(j, *pruned)
+
+    def set_x_norm(self, j, x_norm):
+        """
+        Store the normalized scores computed for active shard ``j``. Pruned entries are stored as zero.
+
+        """
+        _, positions = self.active_shard(j)
+
+        if positions is not None:
+            full = np.zeros(len(self.shards[j].scores))
+            full[positions] = x_norm
+            x_norm = full
+
+        self.x_norms[j] = x_norm
+
+    def unique_summary(self):
+        """
+        Get the per-reference score sums, the total score and the highest score of the unique reads.
+
+        """
+        return (
+            np.bincount(self.unique_refs, weights=self.unique_scores, minlength=self.ref_count),
+            self.unique_scores.sum(),
+            self.unique_scores.max() if len(self.unique_scores) else 0
+        )
+
+    def update_nu(self, nu, x_norms):
+        """
+        Write the per-shard normalized scores in ``x_norms`` back to the ``nu`` dict this matrix was created from.
+
+        """
+        for shard, x_norm in zip(self.shards, x_norms):
+            for i, read_index in enumerate(shard.rows.tolist()):
+                nu[read_index][2] = x_norm[shard.indptr[i]:shard.indptr[i + 1]].tolist()
+
+
+class ChunkedReadMatrix(ReadMatrix):
+    """
+    A :class:`ReadMatrix` stored as chunk directories under ``path``. Each chunk covers a contiguous range of lines in
+    the source VTA file and is memory-mapped from disk only when it is needed. Create instances with
+    :func:`build_chunked`.
+
+    """
+
+    def __init__(self, path, ref_count, chunk_count, unique_summary, nu_count):
+        self.path = path
+        self.ref_count = ref_count
+        self.chunk_count = chunk_count
+
+        self.shards = ChunkSequence(self, load_shard)
+        self.x_norms = ChunkSequence(self, "x_norm")
+
+        self._unique_summary = unique_summary
+        self._nu_count = nu_count
+
+    @property
+    def nu_count(self):
+        return self._nu_count
+
+    @property
+    def nnz(self):
+        return sum(len(self.load(j, "unique_refs")) + len(self.load(j, "indices")) for j in range(self.chunk_count))
+
+    def chunk_path(self, j):
+        return os.path.join(self.path, "chunk_{:06d}".format(j))
+
+    def load(self, j, name, mode="r"):
+        """
+        Memory-map the array called ``name`` from chunk ``j``.
+
+        """
+        return np.load(os.path.join(self.chunk_path(j), name + ".npy"), mmap_mode=mode)
+
+    def iter_unique(self):
+        for j in range(self.chunk_count):
+            yield self.load(j, "unique_refs"), self.load(j, "unique_scores")
+
+    def active_shard(self, j):
+        if not os.path.isfile(os.path.join(self.chunk_path(j), "positions.npy")):
+            return self.shards[j], None
+
+        return Shard(*[self.load(j, "active_" + name) for name in Shard._fields]), self.load(j, "positions")
+
+    def set_active_shard(self, j, shard, positions):
+        for name, values in zip(Shard._fields, shard):
+            np.save(os.path.join(self.chunk_path(j), "active_" + name + ".npy"), values)
+
+        np.save(os.path.join(self.chunk_path(j), "positions.npy"), positions)
+
+    def reset_active_shards(self):
+        for j in range(self.chunk_count):
+            try:
+                os.remove(os.path.join(self.chunk_path(j), "positions.npy"))
+            except FileNotFoundError:
+                pass
+
+    def unique_summary(self):
+        return self._unique_summary
+
+
+class ChunkSequence:
+    """
+    A sequence view of one array per chunk of a :class:`ChunkedReadMatrix`. Items are memory-mapped on access.
+    Assigning an item writes it back to its file in place.
+
+    """
+
+    def __init__(self, read_matrix, name):
+        self._read_matrix = read_matrix
+        self._name = name
+
+    def __len__(self):
+        return self._read_matrix.chunk_count
+
+    def __getitem__(self, j):
+        if j < 0 or j >= len(self):
+            raise IndexError("Chunk index out of range")
+
+        if callable(self._name):
+            return self._name(self._read_matrix, j)
+
+        return self._read_matrix.load(j, self._name)
+
+    def __setitem__(self, j, value):
+        target = self._read_matrix.load(j, self._name, mode="r+")
+        target[:] = value
+        target.flush()
+
+
+def prune_shard(shard, positions, pruned_refs):
+    """
+    Remove the entries for the references flagged in ``pruned_refs`` from ``shard``, whose entries are found at
+    ``positions`` in the full shard (all of them if ``None``). The mass of each read is redistributed over its
+    remaining references when its scores are next normalized. Reads that would lose all of their entries keep them.
+
+    :return: the compacted shard and its positions or ``None`` if nothing was removed
+    :rtype: tuple
+
+    """
+    if not len(shard.rows):
+        return None
+
+    lengths = np.diff(shard.indptr)
+
+    keep = ~pruned_refs[shard.indices]
+
+    row_kept = np.add.reduceat(keep.astype(np.int64), shard.indptr[:-1]) > 0
+
+    keep |= np.repeat(~row_kept, lengths)
+
+    if keep.all():
+        return None
+
+    if positions is None:
+        positions = np.arange(len(shard.indices))
+
+    indptr = np.zeros(len(shard.rows) + 1, dtype=np.int64)
+    np.cumsum(np.add.reduceat(keep.astype(np.int64), shard.indptr[:-1]), out=indptr[1:])
+
+    # Copy everything so the result does not share memory with files it may be saved over.
+    compacted = Shard(
+        np.array(shard.rows),
+        indptr,
+        shard.indices[keep],
+        shard.scores[keep],
+        np.array(shard.weights)
+    )
+
+    return compacted, positions[keep]
+
+
+def load_shard(read_matrix, j):
+    return Shard(*[read_matrix.load(j, name) for name in Shard._fields])
+
+
+def build_chunked(vta_path, path, p_score_cutoff=0.01, memory_budget=2 ** 30, threads=1):
+    """
+    Build a :class:`ChunkedReadMatrix` in the directory ``path`` from the VTA file at ``vta_path`` while holding at
+    most one chunk in memory.
+
+    Chunks are sized so that ``threads`` chunks being processed by :func:`em` fit within ``memory_budget`` bytes.
+
+    Unlike :func:`~virtool.pathoscope.pathoscope.build_matrix`, no table of read names is kept. All alignments for a
+    read must be contiguous in the VTA file, as they are in ``bowtie2`` output.
+
+    :return: the matrix, the reference ids in index order and the number of reads
+    :rtype: tuple
+
+    """
+    chunk_lines = max(1024, memory_budget // (ENTRY_BYTES * (threads + 1)))
+
+    os.makedirs(path, exist_ok=True)
+
+    h_ref_id = dict()
+    refs = list()
+
+    max_score = 0
+    min_score = 0
+
+    read_count = 0
+    chunk_count = 0
+
+    chunk = ChunkBuffer()
+    block = ReadBlock()
+
+    with open(vta_path, "r") as handle:
+        for line in handle:
+            read_id, ref_id, _, _, p_score = line.rstrip().split(",")
+
+            p_score = float(p_score)
+
+            if p_score < p_score_cutoff:
+                chunk.add_filtered_line()
+                continue
+
+            min_score = min(min_score, p_score)
+            max_score = max(max_score, p_score)
+
+            if read_id != block.read_id:
+                if block.read_id is not None:
+                    chunk.add_block(block, read_count)
+                    read_count += 1
+
+                if len(chunk.line_kinds) >= chunk_lines:
+                    chunk.save(os.path.join(path, "chunk_{:06d}".format(chunk_count)))
+                    chunk_count += 1
+                    chunk = ChunkBuffer()
+
+                block = ReadBlock(read_id)
+
+            ref_index = h_ref_id.get(ref_id, -1)
+
+            if ref_index == -1:
+                ref_index = len(refs)
+                h_ref_id[ref_id] = ref_index
+                refs.append(ref_id)
+
+            block.add(chunk.add_line(), ref_index, p_score)
+
+    if block.read_id is not None:
+        chunk.add_block(block, read_count)
+        read_count += 1
+
+    chunk.save(os.path.join(path, "chunk_{:06d}".format(chunk_count)))
+    chunk_count += 1
+
+    ref_count = len(refs)
+
+    if min_score < 0:
+        scaling_factor = 100.0 / max_score - min_score
+    else:
+        scaling_factor = 100.0 / max_score
+
+    pi_sum_0 = np.zeros(ref_count)
+    u_total = 0
+    max_u_weights = 0
+    nu_count = 0
+
+    # Only used to access the chunk files until the summaries needed by the returned matrix are known.
+    read_matrix = ChunkedReadMatrix(path, ref_count, chunk_count, None, None)
+
+    # Rescale the scores in place now that the score range is known and derive the per-read weights and normalized
+    # scores from them.
+    for j in range(chunk_count):
+        for name in ("scores", "unique_scores"):
+            scores = read_matrix.load(j, name, mode="r+")
+
+            if len(scores):
+                scores[:] = np.exp((scores - min(min_score, 0)) * scaling_factor)
+                scores.flush()
+
+        indptr = read_matrix.load(j, "indptr")
+        scores = read_matrix.load(j, "scores")
+
+        weights = np.maximum.reduceat(scores, indptr[:-1]) if len(indptr) > 1 else np.zeros(0)
+
+        np.save(os.path.join(read_matrix.chunk_path(j), "weights.npy"), weights)
+
+        shard = read_matrix.shards[j]
+
+        np.save(os.path.join(read_matrix.chunk_path(j), "x_norm.npy"), normalize(shard))
+
+        unique_refs = read_matrix.load(j, "unique_refs")
+        unique_scores = read_matrix.load(j, "unique_scores")
+
+        if len(unique_scores):
+            pi_sum_0 += np.bincount(unique_refs, weights=unique_scores, minlength=ref_count)
+            u_total += unique_scores.sum()
+            max_u_weights = max(max_u_weights, unique_scores.max())
+
+        nu_count += len(shard.rows)
+
+    read_matrix = ChunkedReadMatrix(path, ref_count, chunk_count, (pi_sum_0, u_total, max_u_weights), nu_count)
+
+    return read_matrix, refs, read_count
+
+
+class ReadBlock:
+    """
+    Collects the alignments of a single read while a :class:`ChunkedReadMatrix` is built. Repeated alignments to the
+    same reference keep the first score.
+
+    """
+
+    def __init__(self, read_id=None):
+        self.read_id = read_id
+        self.refs = list()
+        self.scores = list()
+        self.slots = dict()
+        self.lines = list()
+
+    def add(self, line_index, ref_index, p_score):
+        slot = self.slots.get(ref_index)
+
+        if slot is None:
+            slot = len(self.refs)
+            self.slots[ref_index] = slot
+            self.refs.append(ref_index)
+            self.scores.append(p_score)
+
+        self.lines.append((line_index, slot))
+
+
+class ChunkBuffer:
+    """
+    Accumulates the arrays for one chunk of a :class:`ChunkedReadMatrix` before they are saved.
+
+    """
+
+    def __init__(self):
+        self.rows = array.array("q")
+        self.indptr = array.array("q", [0])
+        self.indices = array.array("q")
+        self.scores = array.array("d")
+
+        self.unique_refs = array.array("q")
+        self.unique_scores = array.array("d")
+
+        self.line_kinds = array.array("b")
+        self.line_offsets = array.array("q")
+
+    def add_filtered_line(self):
+        self.line_kinds.append(LINE_FILTERED)
+        self.line_offsets.append(-1)
+
+    def add_line(self):
+        """
+        Reserve an entry for a line whose kind is known once its read is complete. Returns the line's index in the
+        chunk.
+
+        """
+        self.add_filtered_line()
+        return len(self.line_kinds) - 1
+
+    def add_block(self, block, read_index):
+        if len(block.refs) == 1:
+            self.unique_refs.append(block.refs[0])
+            self.unique_scores.append(block.scores[0])
+
+            for i, (line_index, _) in enumerate(block.lines):
+                self.line_kinds[line_index] = LINE_UNIQUE_FIRST if i == 0 else LINE_UNIQUE_DUPLICATE
+
+            return
+
+        offset = len(self.indices)
+
+        self.rows.append(read_index)
+        self.indices.extend(block.refs)
+        self.scores.extend(block.scores)
+        self.indptr.append(len(self.indices))
+
+        for line_index, slot in block.lines:
+            self.line_kinds[line_index] = LINE_MULTI
+            self.line_offsets[line_index] = offset + slot
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+
+        arrays = {
+            "rows": np.frombuffer(self.rows, dtype=np.int64),
+            "indptr": np.frombuffer(self.indptr, dtype=np.int64),
+            "indices": np.frombuffer(self.indices, dtype=np.int64),
+            "scores": np.frombuffer(self.scores, dtype=float),
+            "unique_refs": np.frombuffer(self.unique_refs, dtype=np.int64),
+            "unique_scores": np.frombuffer(self.unique_scores, dtype=float),
+            "line_kinds": np.frombuffer(self.line_kinds, dtype=np.int8),
+            "line_offsets": np.frombuffer(self.line_offsets, dtype=np.int64)
+        }
+
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), values)
+
+
+def compute_best_hit(read_matrix, read_count):
+    """
+    Compute best hit read counts and proportions from the current normalized scores of ``read_matrix``. Gives the same
+    result as :func:`~virtool.pathoscope.pathoscope.compute_best_hit`, one shard at a time.
+
+    """
+    ref_count = read_matrix.ref_count
+
+    best_hit_reads = np.zeros(ref_count)
+    level_1_reads = np.zeros(ref_count)
+    level_2_reads = np.zeros(ref_count)
+
+    for unique_refs, _ in read_matrix.iter_unique():
+        counts = np.bincount(unique_refs, minlength=ref_count)
+        best_hit_reads += counts
+        level_1_reads += counts
+
+    for j in range(len(read_matrix.shards)):
+        shard = read_matrix.shards[j]
+
+        if not len(shard.rows):
+            continue
+
+        x_norm = np.asarray(read_matrix.x_norms[j])
+
+        lengths = np.diff(shard.indptr)
+
+        best = x_norm == np.repeat(np.maximum.reduceat(x_norm, shard.indptr[:-1]), lengths)
+
+        best_count = np.repeat(np.add.reduceat(best.astype(np.int64), shard.indptr[:-1]), lengths)
+
+        best_hit_reads += np.bincount(shard.indices[best], weights=1.0 / best_count[best], minlength=ref_count)
+
+        level_1_reads += np.bincount(shard.indices[best & (x_norm >= 0.5)], minlength=ref_count)
+        level_2_reads += np.bincount(shard.indices[best & (x_norm < 0.5) & (x_norm >= 0.01)], minlength=ref_count)
+
+    return (
+        best_hit_reads.tolist(),
+        (best_hit_reads / read_count).tolist(),
+        (level_1_reads / read_count).tolist(),
+        (level_2_reads / read_count).tolist()
+    )
+
+
+def rewrite_align(read_matrix, vta_path, p_score_cutoff, path, paired=False):
+    """
+    Write the lines of the VTA file at ``vta_path`` that survive reassignment to a new file at ``path``, streaming one
+    chunk of ``read_matrix`` at a time. Equivalent to :func:`~virtool.pathoscope.pathoscope.rewrite_align`.
+
+    """
+    with open(vta_path, "r") as vta_handle:
+        with open(path, "w") as out_handle:
+            for j in range(read_matrix.chunk_count):
+                line_kinds = read_matrix.load(j, "line_kinds")
+                line_offsets = read_matrix.load(j, "line_offsets")
+
+                keep = line_kinds == LINE_UNIQUE_FIRST
+
+                if paired:
+                    keep |= line_kinds == LINE_UNIQUE_DUPLICATE
+
+                multi = line_kinds == LINE_MULTI
+
+                keep[multi] = read_matrix.x_norms[j][line_offsets[multi]] >= p_score_cutoff
+
+                out_handle.writelines(itertools.compress(itertools.islice(vta_handle, len(line_kinds)), keep))
+
+
+def normalize(shard):
+    """
+    Get the scores of each read in ``shard`` divided by their sum.
+
+    """
+    return e_step(shard, None, 0)[0]
+
+
+def e_step(shard, pi_theta, ref_count, log_likelihood=False):
+    """
+    Compute the normalized scores for the reads in ``shard`` and their weighted contribution to theta.
+
+    If ``log_likelihood`` is ``True``, the sum of each read's weight times the log of its total score under ``pi_theta``
+    is returned as a third item.
+
+    :param shard: the shard to process
+    :type shard: :class:`Shard`
+
+    :param pi_theta: the elementwise product of the current pi and theta or ``None`` to only normalize the scores
+    :type pi_theta: :class:`numpy.ndarray`
+
+    :param ref_count: the number of references in the matrix
+    :type ref_count: int
+
+    :param log_likelihood: also return the shard's contribution to the log-likelihood
+    :type log_likelihood: bool
+
+    :return: the normalized scores and the partial theta sums for the shard
+    :rtype: tuple
+
+    """
+    if not len(shard.rows):
+        if log_likelihood:
+            return np.zeros(0), np.zeros(ref_count), 0.0
+
+        return np.zeros(0), np.zeros(ref_count)
+
+    lengths = np.diff(shard.indptr)
+
+    if pi_theta is None:
+        x = np.array(shard.scores)
+    else:
+        x = pi_theta[shard.indices] * shard.scores
+
+    read_sums = np.add.reduceat(x, shard.indptr[:-1])
+
+    x_sum = np.repeat(read_sums, lengths)
+
+    # Avoid dividing by 0 at all times.
+    x_norm = np.zeros_like(x)
+    np.divide(x, x_sum, out=x_norm, where=x_sum != 0)
+
+    if pi_theta is None:
+        return x_norm, None
+
+    theta_sum = np.bincount(shard.indices, weights=x_norm * np.repeat(shard.weights, lengths), minlength=ref_count)
+
+    if log_likelihood:
+        with np.errstate(divide="ignore"):
+            return x_norm, theta_sum, float((shard.weights * np.log(read_sums)).sum())
+
+    return x_norm, theta_sum
+
+
+def em(matrix, max_iter, epsilon, pi_prior, theta_prior, threads=1, start_pi=None, start_theta=None,
+       prune_threshold=None, profiler=None, stopping=None, return_log_likelihood=False):
+    """
+    Run the Pathoscope EM algorithm on a :class:`ReadMatrix`. Produces the same estimates as
+    :func:`virtool.pathoscope.pathoscope.em`, give or take floating point rounding. Pi and theta can be warm started
+    the same way.
+
+    If ``prune_threshold`` is given, references whose pi falls below it after an iteration are pruned from the
+    non-unique reads with :meth:`ReadMatrix.prune`, so later E steps touch fewer entries. Pruned entries end up with
+    a normalized score of zero. Pruning only removes entries. Pi, theta and the per-reference sums still cover every
+    reference, so the per-iteration cost that scales with the number of references does not go down.
+
+    Stopping policies are passed as ``stopping`` and the log-likelihood is tracked the same way as in
+    :func:`virtool.pathoscope.pathoscope.em`. Pruned entries no longer contribute to the log-likelihood, so it can fall
+    after references are pruned.
+
+    If ``profiler`` is given, it is called after each iteration the same way as by
+    :func:`virtool.pathoscope.pathoscope.em`.
+
+    The E step is run for each shard in a pool of ``threads`` threads. At most ``threads`` shards are in flight at
+    once, so shards backed by files are streamed through memory rather than loaded all at the same time.
+
+    :return: the pi after the first iteration, the final pi and theta and the matrix's normalized scores
+    :rtype: tuple
+
+    """
+    ref_count = matrix.ref_count
+
+    policies = stopping
+
+    if policies is None:
+        policies = [convergence.L1Change(epsilon)]
+
+    track_likelihood = return_log_likelihood or convergence.uses_likelihood(policies)
+
+    log_likelihoods = list()
+
+    pi = np.full(ref_count, 1. / ref_count)
+    theta = pi.copy()
+
+    if start_pi is not None:
+        pi = np.array(start_pi, dtype=float)
+
+    if start_theta is not None:
+        theta = np.array(start_theta, dtype=float)
+
+    init_pi = pi
+
+    pi_sum_0, u_total, max_u_weights = matrix.unique_summary()
+
+    nu_total = 0
+    max_nu_weights = 0
+
+    for shard in matrix.shards:
+        if len(shard.weights):
+            nu_total += shard.weights.sum()
+            max_nu_weights = max(max_nu_weights, shard.weights.max())
+
+    prior_weight = max(max_u_weights, max_nu_weights)
+
+    nu_length = matrix.nu_count or 1
+
+    shard_count = len(matrix.shards)
+
+    matrix.reset_active_shards()
+
+    pruned_refs = np.zeros(ref_count, dtype=bool)
+
+    if track_likelihood:
+        unique_log_score = 0.0
+
+        for _, unique_scores in matrix.iter_unique():
+            unique_log_score += float((unique_scores * np.log(unique_scores)).sum())
+
+    em_start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for i in range(max_iter):
+            iteration_start = time.perf_counter()
+
+            pi_old = pi
+            theta_old = theta
+
+            pi_theta = pi * theta
+
+            theta_sum = np.zeros(ref_count)
+
+            nu_log_likelihood = 0.0
+
+            for start in range(0, shard_count, threads):
+                window = range(start, min(start + threads, shard_count))
+
+                results = executor.map(
+                    lambda j: e_step(matrix.active_shard(j)[0], pi_theta, ref_count, track_likelihood),
+                    window
+                )
+
+                # Partial sums are added in shard order, so the reduction order does not depend on the thread count.
+                for j, result in zip(window, results):
+                    matrix.set_x_norm(j, result[0])
+                    theta_sum += result[1]
+
+                    if track_likelihood:
+                        nu_log_likelihood += result[2]
+
+            # M step
+            pi_sum = theta_sum + pi_sum_0
+            pip = pi_prior * prior_weight
+
+            pi = (pi_sum + pip) / (u_total + nu_total + pip * ref_count)
+
+            if i == 0:
+                init_pi = pi
+
+            theta_p = theta_prior * prior_weight
+
+            nu_total_div = nu_total or 1
+
+            theta = (theta_sum + theta_p) / (nu_total_div + theta_p * ref_count)
+
+            changes = np.abs(pi_old - pi)
+
+            cutoff = changes.sum()
+
+            log_likelihood = None
+            previous_log_likelihood = None
+
+            if track_likelihood:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    log_pi = np.log(pi_old)
+
+                    log_likelihood = unique_log_score + nu_log_likelihood + float(
+                        np.where(pi_sum_0 > 0, pi_sum_0 * log_pi, 0).sum()
+                    )
+
+                    if pip:
+                        log_likelihood += pip * float(log_pi.sum())
+
+                    if theta_p:
+                        log_likelihood += theta_p * float(np.log(theta_old).sum())
+
+                if log_likelihoods:
+                    previous_log_likelihood = log_likelihoods[-1]
+
+                log_likelihoods.append(log_likelihood)
+
+            if profiler is not None:
+                info = {
+                    "iteration": i,
+                    "delta": float(cutoff),
+                    "duration": time.perf_counter() - iteration_start
+                }
+
+                if track_likelihood:
+                    info["log_likelihood"] = log_likelihood
+
+                profiler("em_iteration", info)
+
+            iteration = convergence.Iteration(
+                i,
+                float(cutoff),
+                float(changes.max()) if ref_count else 0.0,
+                log_likelihood,
+                previous_log_likelihood,
+                time.perf_counter() - em_start
+            )
+
+            # Further iterations cannot change pi without non-unique reads. By default, EM also stops with just one.
+            if (nu_length == 1 if stopping is None else not matrix.nu_count):
+                break
+
+            if any(policy(iteration) for policy in policies):
+                break
+
+            if prune_threshold is not None:
+                newly_pruned = (pi < prune_threshold) & ~pruned_refs
+
+                if newly_pruned.any():
+                    pruned_refs |= newly_pruned
+                    matrix.prune(pruned_refs)
+
+    if return_log_likelihood:
+        return init_pi, pi, theta, matrix.x_norms, log_likelihoods
+
+    return init_pi, pi, theta, matrix.x_norms
@@ -1,10 +1,43 @@
+import array
 import copy
 import csv
+import itertools
 import math
 import os
+import re
 import shutil
+import time
+import warnings
 
 import collections
+import numpy as np
+
+import virtool.pathoscope.convergence as convergence
+import virtool.pathoscope.vta as vta
+
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+#: Matches the CIGAR operations that consume bases of the read sequence.
+CIGAR_READ_OPERATIONS = re.compile(r"(\d+)[MIS=X]")
+
+#: Records, for every line of a VTA file, the matrix row of the read (``-1`` if the line was filtered out), the position
+#: of the line's reference in that row and whether the line is the first one seen for its read.
+AlignmentIndex = collections.namedtuple("AlignmentIndex", ["rows", "slots", "first"])
+
+#: The names and headers of the columns of the Pathoscope report, in the order they are written.
+REPORT_COLUMNS = (
+    ("genome", "Genome"),
+    ("final_pi", "Final Guess"),
+    ("final_best", "Final Best Hit"),
+    ("final_reads", "Final Best Hit Read Numbers"),
+    ("final_high", "Final High Confidence Hits"),
+    ("final_low", "Final Low Confidence Hits"),
+    ("initial_pi", "Initial Guess"),
+    ("initial_best", "Initial Best Hit"),
+    ("initial_reads", "Initial Best Hit Read Numbers"),
+    ("initial_high", "Initial High Confidence Hits"),
+    ("initial_low", "Initial Low Confidence Hits")
+)
 
 
 def rescale_samscore(u, nu, max_score, min_score):
@@ -35,31 +68,235 @@ def rescale_samscore(u, nu, max_score, min_score):
     return u, nu
 
 
-def find_sam_align_score(fields):
+def find_sam_align_score(fields, read_length=None):
     """
     Find the Bowtie2 alignment score for the given split line (``fields``).
 
     Searches the SAM fields for the ``AS:i`` substring and extracts the Bowtie2-specific alignment score. This will not
     work for other aligners.
 
+    The length of the read sequence is added to the score. Pass ``read_length`` if it is already known, for example
+    from a :class:`SamReadContext`.
+
     :param fields: a line that has been split on "\t"
     :type fields: list
 
+    :param read_length: the length of the read
+    :type read_length: int
+
     :return: the alignment score
     :rtype: float
 
     """
-    read_length = float(len(fields[9]))
+    if read_length is None:
+        read_length = len(fields[9])
 
-    for field in fields:
+    # Optional fields such as ``AS:i`` follow the 11 mandatory fields.
+    for field in fields[11:]:
         if field.startswith("AS:i:"):
             a_score = int(field[5:])
-            return a_score + read_length
+            return a_score + float(read_length)
 
     raise ValueError("Could not find alignment score")
 
 
-def build_matrix(vta_path, p_score_cutoff=0.01):
+class SamReadContext:
+    """
+    Tracks the read whose alignments are being parsed from SAM output in which the alignments of each read are
+    contiguous, such as ``bowtie2`` output with ``-k``.
+
+    The read length is found once for each read and reused for its repeated alignments. Secondary alignments may have
+    ``*`` in place of the read sequence. The length is then taken from the read's other records, or from the CIGAR
+    string if none of them carry the sequence.
+
+    After each call to :meth:`update`, :attr:`new_sequence` is ``True`` if the record is the first one for the current
+    read that carries the sequence.
+
+    """
+
+    def __init__(self):
+        self.read_id = None
+        self.read_length = 0
+        self.has_sequence = False
+        self.new_sequence = False
+
+    def update(self, fields):
+        """
+        Update the context with the split SAM line ``fields`` and return the length of its read.
+
+        :param fields: a line that has been split on "\t"
+        :type fields: list
+
+        :return: the read length
+        :rtype: int
+
+        """
+        self.new_sequence = False
+
+        if fields[0] != self.read_id:
+            self.read_id = fields[0]
+            self.has_sequence = False
+
+        if not self.has_sequence:
+            sequence = fields[9]
+
+            if sequence == "*":
+                self.read_length = sum(int(count) for count in CIGAR_READ_OPERATIONS.findall(fields[5]))
+            else:
+                self.read_length = len(sequence)
+                self.has_sequence = True
+                self.new_sequence = True
+
+        return self.read_length
+
+
+class SamPairContext:
+    """
+    Joins the two records that ``bowtie2`` writes for each alignment of a read pair mapped with ``-1`` and ``-2``. The
+    record for the first mate (flag ``0x40``) is immediately followed by the record for the second (flag ``0x80``).
+    Either mate may be unmapped.
+
+    A :class:`SamReadContext` is kept for each mate to track read lengths.
+
+    """
+
+    def __init__(self):
+        self.mates = (SamReadContext(), SamReadContext())
+        self._pending = None
+
+    def update(self, fields):
+        """
+        Update the context with the split SAM line ``fields``.
+
+        Returns ``None`` if the line is the first record of an alignment. Otherwise, returns a list containing a
+        ``(mate, fields, read_length, new_sequence)`` tuple for each record of the alignment, where ``mate`` is ``0``
+        for the first mate and ``1`` for the second and ``new_sequence`` is ``True`` if the record is the first one for
+        its mate that carries the sequence.
+
+        :param fields: a line that has been split on "\t"
+        :type fields: list
+
+        :return: the records of the alignment
+        :rtype: list
+
+        """
+        # Bitwise FLAG - 0x80 : the last segment in the template
+        mate = 1 if int(fields[1]) & 0x80 else 0
+
+        context = self.mates[mate]
+        record = (mate, fields, context.update(fields), context.new_sequence)
+
+        if mate == 0:
+            pending = self._pending
+            self._pending = record
+
+            if pending is not None:
+                return [pending]
+
+            return None
+
+        pending = self._pending
+        self._pending = None
+
+        if pending is not None and pending[1][0] == fields[0]:
+            return [pending, record]
+
+        if pending is not None:
+            return [pending]
+
+        return [record]
+
+    def flush(self):
+        """
+        Return a record that is waiting for its mate at the end of the output, or ``None``.
+
+        """
+        pending = self._pending
+        self._pending = None
+
+        if pending is None:
+            return None
+
+        return [pending]
+
+
+def score_pair(records):
+    """
+    Score the mapped records of a paired alignment returned by :meth:`SamPairContext.update`.
+
+    Both mates of a pair that aligned to the same reference are given the sum of their alignment scores so that the
+    fragment is scored as a whole. Mates that aligned on their own keep their own scores.
+
+    :param records: the records of the alignment
+    :type records: list
+
+    :return: a ``(fields, read_length, p_score)`` tuple for each mapped record
+    :rtype: list
+
+    """
+    mapped = list()
+
+    for _, fields, read_length, _ in records:
+        # Bitwise FLAG - 0x4 : segment unmapped
+        if int(fields[1]) & 0x4 or fields[2] == "*":
+            continue
+
+        mapped.append((fields, read_length, find_sam_align_score(fields, read_length)))
+
+    if len(mapped) == 2 and mapped[0][0][2] == mapped[1][0][2]:
+        p_score = mapped[0][2] + mapped[1][2]
+        return [(fields, read_length, p_score) for fields, read_length, _ in mapped]
+
+    return mapped
+
+
+def sam_to_fastq(fields, read_id):
+    """
+    Format the read in the split SAM line (``fields``) as a FASTQ record named ``read_id``.
+
+    Reads aligned to the reverse strand are stored reverse-complemented in SAM, so they are flipped back to their
+    original orientation.
+
+    :param fields: a line that has been split on "\t"
+    :type fields: list
+
+    :param read_id: the name to give the FASTQ record
+    :type read_id: str
+
+    :return: the FASTQ record
+    :rtype: str
+
+    """
+    sequence = fields[9]
+    quality = fields[10]
+
+    # Bitwise FLAG - 0x10 : SEQ being reverse complemented
+    if int(fields[1]) & 0x10:
+        sequence = sequence.translate(COMPLEMENT)[::-1]
+        quality = quality[::-1]
+
+    return "@{}\n{}\n+\n{}\n".format(read_id, sequence, quality)
+
+
+def build_matrix(vta_path, p_score_cutoff=0.01, return_index=False, grouped=False, processes=1):
+    """
+    Build the unique (``u``) and non-unique (``nu``) read matrices from the VTA file at ``vta_path``.
+
+    If ``return_index`` is ``True``, an :class:`AlignmentIndex` describing where each VTA line ended up in the matrix is
+    returned as a fifth element. It can be passed to :func:`rewrite_align` to avoid parsing the VTA file again.
+
+    If ``grouped`` is ``True``, the matrices are built by :func:`build_matrix_grouped` instead. The alignments of each
+    read must then be contiguous in the VTA file. The file is parsed in ``processes`` processes if more than one is
+    given. If the file turns out not to be grouped, a :class:`RuntimeWarning` is issued and the matrices are built
+    without grouping, so ``reads`` then holds read ids.
+
+    """
+    if grouped:
+        try:
+            return build_matrix_grouped(vta_path, p_score_cutoff, return_index, processes)
+        except vta.NotGroupedError as err:
+            warnings.warn("{}. Building the read matrix without grouping.".format(err), RuntimeWarning)
+
     u = dict()
     nu = dict()
 
@@ -75,6 +312,10 @@ def build_matrix(vta_path, p_score_cutoff=0.01):
     max_score = 0
     min_score = 0
 
+    rows = array.array("q")
+    slots = array.array("h")
+    first = array.array("b")
+
     with open(vta_path, "r") as handle:
         for line in handle:
             read_id, ref_id, _, _, p_score = line.rstrip().split(",")
@@ -82,6 +323,9 @@ def build_matrix(vta_path, p_score_cutoff=0.01):
             p_score = float(p_score)
 
             if p_score < p_score_cutoff:
+                rows.append(-1)
+                slots.append(-1)
+                first.append(0)
                 continue
 
             min_score = min(min_score, p_score)
@@ -97,6 +341,9 @@ def build_matrix(vta_path, p_score_cutoff=0.01):
 
             read_index = h_read_id.get(read_id, -1)
 
+            rows.append(read_index if read_index != -1 else read_count)
+            first.append(read_index == -1)
+
             if read_index == -1:
                 # hold on this new read. first, wrap previous read profile and see if any previous read has a same
                 # profile with that!
@@ -105,17 +352,24 @@ def build_matrix(vta_path, p_score_cutoff=0.01):
                 reads.append(read_id)
                 read_count += 1
                 u[read_index] = [[ref_index], [p_score], [float(p_score)], p_score]
+                slots.append(0)
             else:
                 if read_index in u:
                     if ref_index in u[read_index][0]:
+                        slots.append(0)
                         continue
                     nu[read_index] = u[read_index]
                     del u[read_index]
 
-                if ref_index in nu[read_index][0]:
+                ref_indexes = nu[read_index][0]
+
+                if ref_index in ref_indexes:
+                    slots.append(ref_indexes.index(ref_index))
                     continue
 
-                nu[read_index][0].append(ref_index)
+                slots.append(len(ref_indexes))
+
+                ref_indexes.append(ref_index)
                 nu[read_index][1].append(p_score)
 
                 if p_score > nu[read_index][3]:
@@ -132,16 +386,306 @@ def build_matrix(vta_path, p_score_cutoff=0.01):
         # Normalize p_score.
         nu[read_index][2] = [k / p_score_sum for k in nu[read_index][1]]
 
+    if return_index:
+        index = AlignmentIndex(
+            np.frombuffer(rows, dtype=np.int64),
+            np.frombuffer(slots, dtype=np.int16),
+            np.frombuffer(first, dtype=np.int8).astype(bool)
+        )
+
+        return u, nu, refs, reads, index
+
+    return u, nu, refs, reads
+
+
+def build_matrix_grouped(vta_path, p_score_cutoff=0.01, return_index=False, processes=1):
+    """
+    Build the same matrices and index as :func:`build_matrix` from a VTA file in which the alignments of each read are
+    contiguous, as they are in ``bowtie2`` output for unpaired reads.
+
+    Each read's alignments are collected as one block and added to ``u`` or ``nu`` when the next read starts, so no
+    table of read names is kept and every read is hashed only once. Because read names are not kept, ``reads`` is
+    returned as a :class:`range` of matrix rows.
+
+    If ``processes`` is greater than one, the file is parsed in parallel by :func:`virtool.pathoscope.vta.parse` and
+    the matrices are built from the parsed columns by :func:`build_matrix_columns`.
+
+    Whether the file is grouped is taken on trust from the caller, but the hashes of finished read ids are kept so that
+    a read whose alignments are split raises :class:`~virtool.pathoscope.vta.NotGroupedError` rather than silently
+    becoming two rows. A hash collision raises the error too, which only costs a fallback to :func:`build_matrix`.
+
+    """
+    if processes > 1:
+        return build_matrix_columns(vta.parse(vta_path, processes, grouped=True), p_score_cutoff, return_index)
+
+    u = dict()
+    nu = dict()
+
+    h_ref_id = {}
+
+    refs = []
+
+    read_count = 0
+
+    max_score = 0
+    min_score = 0
+
+    rows = array.array("q")
+    slots = array.array("h")
+    first = array.array("b")
+
+    block_read_id = None
+    block_refs = None
+    block_scores = None
+
+    finished_reads = set()
+
+    def add_block():
+        if len(block_refs) == 1:
+            u[read_count - 1] = [block_refs, block_scores, [block_scores[0]], block_scores[0]]
+        else:
+            nu[read_count - 1] = [block_refs, block_scores, [block_scores[0]], max(block_scores)]
+
+    with open(vta_path, "r") as handle:
+        for line in handle:
+            read_id, ref_id, _, _, p_score = line.rstrip().split(",")
+
+            p_score = float(p_score)
+
+            if p_score < p_score_cutoff:
+                rows.append(-1)
+                slots.append(-1)
+                first.append(0)
+                continue
+
+            min_score = min(min_score, p_score)
+            max_score = max(max_score, p_score)
+
+            ref_index = h_ref_id.get(ref_id, -1)
+
+            if ref_index == -1:
+                ref_index = len(refs)
+                h_ref_id[ref_id] = ref_index
+                refs.append(ref_id)
+
+            if read_id != block_read_id:
+                if block_read_id is not None:
+                    add_block()
+                    finished_reads.add(hash(block_read_id))
+
+                if hash(read_id) in finished_reads:
+                    raise vta.NotGroupedError("The alignments of read {} are not contiguous in {}".format(
+                        read_id,
+                        vta_path
+                    ))
+
+                block_read_id = read_id
+                block_refs = [ref_index]
+                block_scores = [p_score]
+
+                rows.append(read_count)
+                slots.append(0)
+                first.append(1)
+
+                read_count += 1
+
+                continue
+
+            rows.append(read_count - 1)
+            first.append(0)
+
+            # Reads rarely align to more than a few references, so a list search is faster than a set.
+            if ref_index in block_refs:
+                slots.append(block_refs.index(ref_index))
+                continue
+
+            slots.append(len(block_refs))
+
+            block_refs.append(ref_index)
+            block_scores.append(p_score)
+
+    if block_read_id is not None:
+        add_block()
+
+    u, nu = rescale_samscore(u, nu, max_score, min_score)
+
+    for read_index in u:
+        # keep ref_index and score only
+        u[read_index] = [u[read_index][0][0], u[read_index][1][0]]
+
+    for read_index in nu:
+        p_score_sum = sum(nu[read_index][1])
+        # Normalize p_score.
+        nu[read_index][2] = [k / p_score_sum for k in nu[read_index][1]]
+
+    reads = range(read_count)
+
+    if return_index:
+        index = AlignmentIndex(
+            np.frombuffer(rows, dtype=np.int64),
+            np.frombuffer(slots, dtype=np.int16),
+            np.frombuffer(first, dtype=np.int8).astype(bool)
+        )
+
+        return u, nu, refs, reads, index
+
     return u, nu, refs, reads
 
 
-def em(u, nu, genomes, max_iter, epsilon, pi_prior, theta_prior):
+def build_matrix_columns(columns, p_score_cutoff=0.01, return_index=False):
+    """
+    Build the same matrices and index as :func:`build_matrix_grouped` from :class:`~virtool.pathoscope.vta.VtaColumns`
+    parsed from a grouped VTA file.
+
+    Filtering, reference numbering and duplicate removal are done with array operations. Scores are rescaled with
+    :func:`math.exp` and summed in the same order as :func:`rescale_samscore` so the matrices are identical.
+
+    """
+    line_count = len(columns.scores)
+
+    accepted = ~(columns.scores < p_score_cutoff)
+
+    groups = columns.groups[accepted]
+    ref_indexes = columns.ref_indexes[accepted]
+    scores = columns.scores[accepted]
+
+    entry_count = len(scores)
+
+    # Number the references in the order they first appear on an accepted line.
+    seen_refs, first_seen = np.unique(ref_indexes, return_index=True)
+    seen_refs = seen_refs[np.argsort(first_seen)]
+
+    ref_map = np.zeros(len(columns.refs), dtype=np.int64)
+    ref_map[seen_refs] = np.arange(len(seen_refs))
+
+    refs = [columns.refs[i] for i in seen_refs]
+    ref_indexes = ref_map[ref_indexes]
+
+    # A new matrix row starts on the first accepted line of each read.
+    first = np.ones(entry_count, dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+
+    rows = np.cumsum(first) - 1
+
+    read_count = int(rows[-1]) + 1 if entry_count else 0
+
+    # Repeated alignments of a read to the same reference keep the first score. Each line's slot is the position of its
+    # reference among the distinct references of its read.
+    keys = rows * max(len(refs), 1) + ref_indexes
+
+    _, key_first, key_inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    distinct = np.zeros(entry_count, dtype=bool)
+    distinct[key_first] = True
+
+    distinct_lines = np.flatnonzero(distinct)
+    distinct_rows = rows[distinct_lines]
+
+    distinct_slots = np.arange(len(distinct_lines)) - np.searchsorted(distinct_rows, distinct_rows)
+
+    key_slots = np.zeros(len(key_first), dtype=np.int64)
+    key_slots[key_inverse[distinct_lines]] = distinct_slots
+
+    slots = key_slots[key_inverse]
+
+    min_score = min(0, float(scores.min())) if entry_count else 0
+    max_score = max(0, float(scores.max())) if entry_count else 0
+
+    if min_score < 0:
+        scaling_factor = 100.0 / max_score - min_score
+    else:
+        scaling_factor = 100.0 / max_score
+
+    distinct_scores = scores[distinct_lines]
+
+    if min_score < 0:
+        distinct_scores = distinct_scores - min_score
+
+    distinct_scores = list(map(math.exp, (distinct_scores * scaling_factor).tolist()))
+    distinct_refs = ref_indexes[distinct_lines].tolist()
+
+    counts = np.bincount(distinct_rows, minlength=read_count)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    single = counts == 1
+
+    u = {
+        row: [distinct_refs[start], distinct_scores[start]]
+        for row, start in zip(np.flatnonzero(single).tolist(), starts[single].tolist())
+    }
+
+    nu = dict()
+
+    for row, start, end in zip(np.flatnonzero(~single).tolist(), starts[~single].tolist(), ends[~single].tolist()):
+        row_scores = distinct_scores[start:end]
+        p_score_sum = sum(row_scores)
+
+        nu[row] = [distinct_refs[start:end], row_scores, [k / p_score_sum for k in row_scores], max(row_scores)]
+
+    reads = range(read_count)
+
+    if return_index:
+        index_rows = np.full(line_count, -1, dtype=np.int64)
+        index_rows[accepted] = rows
+
+        index_slots = np.full(line_count, -1, dtype=np.int16)
+        index_slots[accepted] = slots
+
+        index_first = np.zeros(line_count, dtype=bool)
+        index_first[accepted] = first
+
+        return u, nu, refs, reads, AlignmentIndex(index_rows, index_slots, index_first)
+
+    return u, nu, refs, reads
+
+
+def em(u, nu, genomes, max_iter, epsilon, pi_prior, theta_prior, start_pi=None, start_theta=None, profiler=None,
+       stopping=None, return_log_likelihood=False):
+    """
+    Run the Pathoscope EM algorithm. Pi and theta start out uniform unless ``start_pi`` or ``start_theta`` are given as
+    lists in the same order as ``genomes`` (see :func:`map_start_values`).
+
+    By default, EM stops when the summed change in pi is at most ``epsilon`` or when there is no more than one
+    non-unique read. A list of :mod:`~virtool.pathoscope.convergence` policies can be passed as ``stopping`` instead.
+    EM then stops when any of the policies is met or when there are no non-unique reads, and ``epsilon`` is ignored.
+    EM never runs more than ``max_iter`` iterations.
+
+    The log-likelihood of the estimates each iteration starts from is calculated if a policy needs it or if
+    ``return_log_likelihood`` is ``True``. It is the weighted objective that the updates maximize, so it never decreases
+    from one iteration to the next. Each read contributes its weight times the log of its total score: pi times its
+    score for a unique read and the sum of pi times theta times its score over its references for a non-unique read.
+    The priors add ``pi_prior`` and ``theta_prior`` times the largest read weight times the summed logs of pi and
+    theta. Scores are not normalized, so values are only comparable within a run. If ``return_log_likelihood`` is
+    ``True``, the per-iteration values are returned as a fifth item.
+
+    If ``profiler`` is given, it is called with ``"em_iteration"`` and a dict of the ``iteration`` number, the
+    summed change in pi (``delta``) and the ``duration`` in seconds after each iteration. The ``log_likelihood`` is
+    included if it is calculated.
+
+    """
+    policies = stopping
+
+    if policies is None:
+        policies = [convergence.L1Change(epsilon)]
+
+    track_likelihood = return_log_likelihood or convergence.uses_likelihood(policies)
+
+    log_likelihoods = list()
+
     genome_count = len(genomes)
 
     pi = [1. / genome_count] * genome_count
-    init_pi = copy.copy(pi)
     theta = copy.copy(pi)
 
+    if start_pi is not None:
+        pi = list(start_pi)
+
+    if start_theta is not None:
+        theta = list(start_theta)
+
+    init_pi = copy.copy(pi)
+
     pi_sum_0 = [0] * genome_count
 
     u_weights = [u[i][1] for i in u]
@@ -171,11 +715,24 @@ def em(u, nu, genomes, max_iter, epsilon, pi_prior, theta_prior):
     if nu_length == 0:
         nu_length = 1
 
+    if track_likelihood:
+        unique_log_score = 0.0
+
+        for read_index in u:
+            unique_log_score += u[read_index][1] * math.log(u[read_index][1])
+
+    em_start = time.perf_counter()
+
     # EM iterations
     for i in range(max_iter):
+        iteration_start = time.perf_counter()
+
         pi_old = pi
+        theta_old = theta
         theta_sum = [0 for _ in genomes]
 
+        nu_log_likelihood = 0.0
+
         # E Step
         for j in nu:
             z = nu[j]
@@ -194,6 +751,9 @@ def em(u, nu, genomes, max_iter, epsilon, pi_prior, theta_prior):
 
             x_sum = sum(x_tmp)
 
+            if track_likelihood:
+                nu_log_likelihood += z[3] * convergence.safe_log(x_sum)
+
             # Avoid dividing by 0 at all times.
             if x_sum == 0:
                 x_norm = [0.0 for _ in x_tmp]
@@ -228,30 +788,93 @@ def em(u, nu, genomes, max_iter, epsilon, pi_prior, theta_prior):
         theta = [(1. * k + theta_p) / (nu_total_div + theta_p * len(theta_sum)) for k in theta_sum]
 
         cutoff = 0.0
+        max_change = 0.0
 
         for k, _ in enumerate(pi):
-            cutoff += abs(pi_old[k] - pi[k])
+            change = abs(pi_old[k] - pi[k])
+            cutoff += change
+            max_change = max(max_change, change)
+
+        log_likelihood = None
+        previous_log_likelihood = None
 
-        if cutoff <= epsilon or nu_length == 1:
+        if track_likelihood:
+            log_likelihood = unique_log_score + nu_log_likelihood + sum(
+                weight * convergence.safe_log(pi_old[k]) for k, weight in enumerate(pi_sum_0) if weight
+            )
+
+            if pip:
+                log_likelihood += pip * sum(convergence.safe_log(value) for value in pi_old)
+
+            if theta_p:
+                log_likelihood += theta_p * sum(convergence.safe_log(value) for value in theta_old)
+
+            if log_likelihoods:
+                previous_log_likelihood = log_likelihoods[-1]
+
+            log_likelihoods.append(log_likelihood)
+
+        if profiler is not None:
+            info = {
+                "iteration": i,
+                "delta": cutoff,
+                "duration": time.perf_counter() - iteration_start
+            }
+
+            if track_likelihood:
+                info["log_likelihood"] = log_likelihood
+
+            profiler("em_iteration", info)
+
+        iteration = convergence.Iteration(
+            i,
+            cutoff,
+            max_change,
+            log_likelihood,
+            previous_log_likelihood,
+            time.perf_counter() - em_start
+        )
+
+        # Further iterations cannot change pi without non-unique reads. By default, EM also stops with just one.
+        if (nu_length == 1 if stopping is None else not nu):
+            break
+
+        if any(policy(iteration) for policy in policies):
             break
 
+    if return_log_likelihood:
+        return init_pi, pi, theta, nu, log_likelihoods
+
     return init_pi, pi, theta, nu
 
 
-def find_updated_score(nu, read_index, ref_index):
-    try:
-        index = nu[read_index][0].index(ref_index)
-    except ValueError:
-        return 0.0, 0.0
+def map_start_values(values, refs):
+    """
+    Map ``values`` keyed by reference id, such as the pi values from a previous analysis, onto the reference order in
+    ``refs`` so they can be used to warm start :func:`em`.
+
+    References that are missing from ``values`` or have a value of zero start at the smaller of a uniform share and the
+    smallest known value, so they can still gain weight during EM. The result is normalized to sum to one.
+
+    :param values: starting values keyed by reference id
+    :type values: dict
 
-    p_score_sum = 0.0
+    :param refs: the reference ids in matrix order
+    :type refs: list
 
-    for p_score in nu[read_index][1]:
-        p_score_sum += p_score
+    :return: the starting values in matrix order
+    :rtype: list
 
-    updated_pscore = nu[read_index][2][index]
+    """
+    known = [values[ref_id] for ref_id in refs if values.get(ref_id)]
 
-    return updated_pscore
+    floor = min([1. / len(refs)] + known)
+
+    mapped = [values.get(ref_id) or floor for ref_id in refs]
+
+    total = sum(mapped)
+
+    return [value / total for value in mapped]
 
 
 def compute_best_hit(u, nu, refs, reads):
@@ -297,10 +920,98 @@ def compute_best_hit(u, nu, refs, reads):
     return best_hit_reads, best_hit, level_1, level_2
 
 
+def build_report_columns(pi, refs, init_pi, best_hit_initial, best_hit_initial_reads, best_hit_final,
+                         best_hit_final_reads, level_1_initial, level_2_initial, level_1_final, level_2_final):
+    """
+    Sort the per-reference results of a Pathoscope run into report order and drop the references below the report
+    cutoff.
+
+    References are sorted by descending final pi. Ties are broken by descending reference id. The report ends at the
+    first reference with a final pi below 0.01 and no high or low confidence hits.
+
+    The order and cutoff are found with array operations, but the values in the returned columns are the objects that
+    were passed in.
+
+    :return: lists of values in report order keyed by the names in :data:`REPORT_COLUMNS`
+    :rtype: :class:`collections.OrderedDict`
+
+    """
+    pi_array = np.asarray(pi, dtype=float)
+
+    # Reference ids are unique, so reversing an ascending sort gives a strictly descending order.
+    order = np.lexsort((np.asarray(refs, dtype=str), pi_array))[::-1]
+
+    below_cutoff = (
+        (pi_array < 0.01) &
+        (np.asarray(level_1_final, dtype=float) <= 0) &
+        (np.asarray(level_2_final, dtype=float) <= 0)
+    )[order]
+
+    if below_cutoff.any():
+        order = order[:int(np.argmax(below_cutoff))]
+
+    order = order.tolist()
+
+    values = (
+        refs,
+        pi,
+        best_hit_final,
+        best_hit_final_reads,
+        level_1_final,
+        level_2_final,
+        init_pi,
+        best_hit_initial,
+        best_hit_initial_reads,
+        level_1_initial,
+        level_2_initial
+    )
+
+    return collections.OrderedDict(
+        (name, [column[i] for i in order]) for (name, _), column in zip(REPORT_COLUMNS, values)
+    )
+
+
+def get_report_results(columns):
+    """
+    Describe each reference in report ``columns`` as a dict of its initial and final values, keyed by reference id.
+
+    """
+    results = dict()
+
+    rows = zip(*(columns[name] for name, _ in REPORT_COLUMNS))
+
+    for ref_id, f_pi, f_best, f_reads, f_high, f_low, i_pi, i_best, i_reads, i_high, i_low in rows:
+        results[ref_id] = {
+            "final": {
+                "pi": f_pi,
+                "best": f_best,
+                "high": f_high,
+                "low": f_low,
+                "reads": int(f_reads)
+            },
+            "initial": {
+                "pi": i_pi,
+                "best": i_best,
+                "high": i_high,
+                "low": i_low,
+                "reads": int(i_reads)
+            }
+        }
+
+    return results
+
+
 def write_report(path, pi, refs, read_count, init_pi, best_hit_initial, best_hit_initial_reads, best_hit_final,
-                 best_hit_final_reads, level_1_initial, level_2_initial, level_1_final, level_2_final):
+                 best_hit_final_reads, level_1_initial, level_2_initial, level_1_final, level_2_final,
+                 binary_path=None):
+    """
+    Write the Pathoscope report to a TSV file at ``path`` and return the reported references as a dict keyed by
+    reference id. The report columns are built by :func:`build_report_columns`.
+
+    If ``binary_path`` is given, the columns are also written there by :func:`write_binary_report`.
 
-    tmp = zip(
+    """
+    columns = build_report_columns(
         pi,
         refs,
         init_pi,
@@ -314,130 +1025,141 @@ def write_report(path, pi, refs, read_count, init_pi, best_hit_initial, best_hit
         level_2_final
     )
 
-    tmp = sorted(tmp, reverse=True)
+    with open(path, "w") as handle:
+        csv_writer = csv.writer(handle, delimiter="\t")
 
-    x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11 = zip(*tmp)
+        csv_writer.writerow([
+            "Total Number of Aligned Reads:",
+            read_count,
+            "Total Number of Mapped Genomes:",
+            len(refs)
+        ])
+        csv_writer.writerow([header for _, header in REPORT_COLUMNS])
+        csv_writer.writerows(zip(*columns.values()))
 
-    no_cutoff = False
+    if binary_path is not None:
+        write_binary_report(binary_path, columns, read_count, len(refs))
 
-    for i, _ in enumerate(x10):
-        if not no_cutoff and x1[i] < 0.01 and x10[i] <= 0 and x11[i] <= 0:
-            break
+    return get_report_results(columns)
 
-        if i == (len(x10) - 1):
-            i += 1
-
-    # Changing the column order here
-    tmp = zip(
-        x2[:i],
-        x1[:i],
-        x6[:i],
-        x7[:i],
-        x10[:i],
-        x11[:i],
-        x3[:i],
-        x4[:i],
-        x5[:i],
-        x8[:i],
-        x9[:i]
-    )
 
-    with open(path, "w") as handle:
-        csv_writer = csv.writer(handle, delimiter='\t')
-
-        header = [
-            "Genome",
-            "Final Guess",
-            "Final Best Hit",
-            "Final Best Hit Read Numbers",
-            "Final High Confidence Hits",
-            "Final Low Confidence Hits",
-            "Initial Guess",
-            "Initial Best Hit",
-            "Initial Best Hit Read Numbers",
-            "Initial High Confidence Hits",
-            "Initial Low Confidence Hits"
-        ]
-
-        header1 = ["Total Number of Aligned Reads:", read_count, "Total Number of Mapped Genomes:", len(refs)]
-
-        csv_writer.writerow(header1)
-        csv_writer.writerow(header)
-        csv_writer.writerows(tmp)
+def write_binary_report(path, columns, read_count, genome_count):
+    """
+    Write report ``columns`` to a compressed NumPy archive at ``path``. Each column is stored as a typed array, which
+    is much smaller and faster to load than the TSV report for large reference sets.
 
-    results = dict()
+    :param path: the path to write the archive to
+    :type path: str
 
-    for i, ref_id in enumerate(x2[:i]):
-        if x1[i] < 0.01 and x10[i] <= 0 and x11[i] <= 0:
-            pass
-        else:
-            results[ref_id] = {
-                "final": {
-                    "pi": x1[i],
-                    "best": x6[i],
-                    "high": x10[i],
-                    "low": x11[i],
-                    "reads": int(x7[i])
-                },
-                "initial": {
-                    "pi": x3[i],
-                    "best": x4[i],
-                    "high": x8[i],
-                    "low": x9[i],
-                    "reads": int(x5[i])
-                }
-            }
+    :param columns: the columns returned by :func:`build_report_columns`
+    :type columns: :class:`collections.OrderedDict`
 
-    return results
+    :param read_count: the number of aligned reads
+    :type read_count: int
 
+    :param genome_count: the number of mapped references
+    :type genome_count: int
 
-def rewrite_align(u, nu, vta_path, p_score_cutoff, path):
-    with open(path, 'w') as of:
-        with open(vta_path, 'r') as in1:
-            read_id_dict = {}
-            ref_id_dict = {}
-            genomes = []
-            read = []
-            ref_count = 0
-            read_count = 0
+    """
+    arrays = {name: np.asarray(values, dtype=str if name == "genome" else float) for name, values in columns.items()}
 
-            for line in in1:
-                read_id, ref_id, _, _, p_score = line.split(",")
+    with open(path, "wb") as f:
+        np.savez_compressed(f, read_count=read_count, genome_count=genome_count, **arrays)
 
-                p_score = float(p_score)
 
-                if p_score < p_score_cutoff:
-                    continue
+def read_binary_report(path):
+    """
+    Read a report written by :func:`write_binary_report`.
 
-                ref_index = ref_id_dict.get(ref_id, -1)
-
-                if ref_index == -1:
-                    ref_index = ref_count
-                    ref_id_dict[ref_id] = ref_index
-                    genomes.append(ref_id)
-                    ref_count += 1
-
-                read_index = read_id_dict.get(read_id, -1)
-
-                if read_index == -1:
-                    # hold on this new read
-                    # first, wrap previous read profile and see if any previous read has a same profile with that!
-                    read_index = read_count
-                    read_id_dict[read_id] = read_index
-                    read.append(read_id)
-                    read_count += 1
-                    if read_index in u:
-                        of.write(line)
-                        continue
+    :param path: the path to the archive
+    :type path: str
 
-                if read_index in nu:
-                    if find_updated_score(nu, read_index, ref_index) < p_score_cutoff:
-                        continue
+    :return: the read count, the number of mapped references and the report results as returned by
+             :func:`write_report`
+    :rtype: tuple
+
+    """
+    with np.load(path) as archive:
+        columns = {name: archive[name].tolist() for name, _ in REPORT_COLUMNS}
+
+        return int(archive["read_count"]), int(archive["genome_count"]), get_report_results(columns)
+
+
+def rewrite_align(u, nu, vta_path, p_score_cutoff, path, index=None, paired=False):
+    """
+    Write the lines of the VTA file at ``vta_path`` that survive reassignment to a new file at ``path``.
+
+    Unique reads keep their first alignment. Non-unique reads keep the alignments whose updated score is at least
+    ``p_score_cutoff``. Callers that built ``u`` and ``nu`` with :func:`build_matrix` should pass the
+    :class:`AlignmentIndex` it returned as ``index``. The index is only rebuilt from the VTA file when none is given,
+    such as when ``u`` and ``nu`` were loaded from elsewhere.
+
+    If ``paired`` is ``True``, each read is a fragment whose mates are written as separate lines, and unique reads
+    keep all of their alignments so that both mates are kept.
+
+    """
+    if index is None:
+        index = build_matrix(vta_path, p_score_cutoff, return_index=True)[4]
+
+    keep = alignment_mask(u, nu, index, p_score_cutoff, paired)
+
+    with open(vta_path, "r") as vta_handle:
+        with open(path, "w") as out_handle:
+            out_handle.writelines(itertools.compress(vta_handle, keep))
+
+
+def alignment_mask(u, nu, index, p_score_cutoff, paired=False):
+    """
+    Get a boolean array flagging the lines described by ``index`` that should be written by :func:`rewrite_align`.
 
-                    of.write(line)
+    """
+    rows = index.rows
+    valid = rows >= 0
+
+    read_count = int(rows.max()) + 1 if len(rows) else 0
+
+    # Use row zero as a placeholder for filtered lines so every line can be looked up. They are masked out by ``valid``.
+    rows = np.where(valid, rows, 0)
+
+    unique = np.zeros(read_count, dtype=bool)
+    unique[np.fromiter(u, dtype=np.int64, count=len(u))] = True
+
+    nu_rows = np.fromiter(nu, dtype=np.int64, count=len(nu))
+    nu_lengths = np.fromiter((len(nu[j][2]) for j in nu), dtype=np.int64, count=len(nu))
+
+    # All updated scores laid out end to end, with the offset of each read's first score in ``starts``.
+    x_norm = np.fromiter(itertools.chain.from_iterable(nu[j][2] for j in nu), dtype=float, count=int(nu_lengths.sum()))
+
+    starts = np.zeros(read_count, dtype=np.int64)
+    starts[nu_rows] = np.cumsum(nu_lengths) - nu_lengths
+
+    multi = np.zeros(read_count, dtype=bool)
+    multi[nu_rows] = True
+
+    keep = valid & unique[rows]
+
+    if not paired:
+        keep &= index.first
+
+    multi_lines = valid & multi[rows]
 
+    keep[multi_lines] = x_norm[starts[rows[multi_lines]] + index.slots[multi_lines]] >= p_score_cutoff
+
+    return keep
+
+
+def calculate_coverage(vta_path, ref_lengths, processes=1):
+    """
+    Calculate the per-base coverage of each reference that appears in the VTA file at ``vta_path``. Alignments that
+    extend past the end of a reference are truncated.
+
+    If ``processes`` is greater than one, the file is parsed in parallel by :func:`virtool.pathoscope.vta.parse` and
+    coverage is calculated with array operations.
+
+    """
+    if processes > 1:
+        return calculate_coverage_columns(vta.parse(vta_path, processes), ref_lengths)
 
-def calculate_coverage(vta_path, ref_lengths):
     coverage_dict = dict()
     pos_length_list = list()
 
@@ -463,17 +1185,74 @@ def calculate_coverage(vta_path, ref_lengths):
     return coverage_dict
 
 
-def subtract(analysis_path, host_scores):
+def calculate_coverage_columns(columns, ref_lengths):
+    """
+    Calculate the same coverage as :func:`calculate_coverage` from :class:`~virtool.pathoscope.vta.VtaColumns`.
+
+    """
+    coverage_dict = dict()
+
+    order = np.argsort(columns.ref_indexes, kind="mergesort")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(columns.ref_indexes, minlength=len(columns.refs)))))
+
+    for ref_index, ref_id in enumerate(columns.refs):
+        length = ref_lengths[ref_id]
+
+        lines = order[bounds[ref_index]:bounds[ref_index + 1]]
+
+        starts = columns.positions[lines] - 1
+        ends = np.minimum(starts + columns.lengths[lines], length)
+
+        in_range = starts < length
+
+        # Count alignment starts and ends at each position and accumulate them into depths.
+        changes = np.bincount(starts[in_range], minlength=length + 1)
+        changes -= np.bincount(ends[in_range], minlength=length + 1)
+
+        coverage_dict[ref_id] = np.cumsum(changes[:length]).tolist()
+
+    return coverage_dict
+
+
+def subtract(analysis_path, host_scores, read_count=None, processes=1):
+    """
+    Remove alignments from ``to_isolates.vta`` for reads that have an equal or better score against the subtraction
+    host than against any isolate.
+
+    If the read ids in the VTA file have been interned as consecutive integers, pass the number of interned reads as
+    ``read_count``. Scores are then tracked in flat arrays indexed by read id and ``host_scores`` must be keyed by
+    integer id.
+
+    If ``processes`` is greater than one, the VTA file is split at read boundaries and subtracted in parallel by
+    :func:`virtool.pathoscope.vta.subtract`. The alignments of each read must be contiguous in the file.
+
+    """
     subtracted_count = 0
 
     vta_path = os.path.join(analysis_path, "to_isolates.vta")
 
-    isolates_high_scores = collections.defaultdict(int)
+    if processes > 1:
+        out_path = os.path.join(analysis_path, "subtracted.vta")
+
+        subtracted_count = vta.subtract(vta_path, out_path, host_scores, processes, read_count is not None)
+
+        os.remove(vta_path)
+
+        shutil.move(out_path, vta_path)
+
+        return subtracted_count
+
+    if read_count is None:
+        isolates_high_scores = collections.defaultdict(int)
+        parse_read_id = str
+    else:
+        isolates_high_scores = array.array("d", bytes(8 * read_count))
+        parse_read_id = int
 
     with open(vta_path, "r") as handle:
         for line in handle:
             fields = line.rstrip().split(",")
-            read_id = fields[0]
+            read_id = parse_read_id(fields[0])
             isolates_high_scores[read_id] = max(isolates_high_scores[read_id], float(fields[4]))
 
     out_path = os.path.join(analysis_path, "subtracted.vta")
@@ -485,7 +1264,7 @@ def subtract(analysis_path, host_scores):
             for line in vta_handle:
                 total_count += 1
                 fields = line.rstrip().split(",")
-                read_id = fields[0]
+                read_id = parse_read_id(fields[0])
                 if isolates_high_scores[read_id] > host_scores.get(read_id, 0):
                     out_handle.write(line)
                 else:
@@ -1,26 +1,480 @@
+import array
+import contextlib
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import numpy as np
 import os
-import visvalingamwyatt as vw
+import resource
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+#: The extensions that read files may have, in order of preference.
+READ_FILE_EXTENSIONS = (".fastq", ".fq", ".fastq.gz", ".fq.gz", ".fastq.zst", ".fq.zst")
+
+#: The struct format of the footer that ends a coverage file. It holds the offset of the JSON index.
+COVERAGE_FOOTER = struct.Struct("<Q")
+
+
+class ReadNames:
+    """
+    Interns read names as consecutive integer ids.
+
+    The names are stored end to end in a single packed buffer instead of as individual Python strings. A lookup table
+    from names to ids is kept until :meth:`freeze` is called. Repeated alignments of the same read are usually
+    contiguous in ``bowtie2`` output, so the last interned name is checked before the table.
+
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offsets = array.array("q", [0])
+        self._ids = dict()
+
+        self._last_name = None
+        self._last_id = -1
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, read_id):
+        if read_id < 0 or read_id >= len(self):
+            raise IndexError("Read id out of range")
+
+        return self._buffer[self._offsets[read_id]:self._offsets[read_id + 1]].decode()
+
+    def intern(self, name):
+        """
+        Get the integer id for the read ``name``, assigning the next available id if the name has not been seen.
+
+        :param name: the read name
+        :type name: str
+
+        :return: the read id
+        :rtype: int
+
+        """
+        if name == self._last_name:
+            return self._last_id
+
+        if self._ids is None:
+            raise ValueError("Cannot intern names after freezing")
+
+        read_id = self._ids.get(name)
+
+        if read_id is None:
+            read_id = len(self)
+
+            self._ids[name] = read_id
+            self._buffer += name.encode()
+            self._offsets.append(len(self._buffer))
+
+        self._last_name = name
+        self._last_id = read_id
+
+        return read_id
+
+    def freeze(self):
+        """
+        Drop the name lookup table. Ids can still be resolved to names, but no new names can be interned.
+
+        """
+        self._ids = None
+
+
+def get_max_rss():
+    """
+    Get the peak resident set size of the current process in bytes.
+
+    :return: the peak resident set size
+    :rtype: int
+
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # The size is given in kilobytes everywhere except macOS.
+    if sys.platform == "darwin":
+        return max_rss
+
+    return max_rss * 1024
+
+
+@contextlib.contextmanager
+def profile_phase(profiler, name):
+    """
+    Time the code run in the context and report it to ``profiler`` as a ``phase`` event when the context exits without
+    an error. The event info contains the ``name`` of the phase, its ``duration`` in seconds and the peak resident set
+    size of the process (``max_rss``) in bytes when it finished. Nothing is measured if ``profiler`` is ``None``.
+
+    :param profiler: a callable that is called with an event name and a dict of info
+    :type profiler: callable
+
+    :param name: the name of the phase
+    :type name: str
+
+    """
+    if profiler is None:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    yield
+
+    profiler("phase", {
+        "name": name,
+        "duration": time.perf_counter() - start,
+        "max_rss": get_max_rss()
+    })
+
+
+def write_profile(path, events):
+    """
+    Write the events reported to a profiler by :func:`~virtool.pathoscope.job.run_patho` to a JSON file at ``path``.
+
+    Values that are not finite, such as the ``-inf`` log likelihood of an iteration in which a read has no support, are
+    written as ``null`` so that the file is valid JSON.
+
+    :param path: the path to write the file to
+    :type path: str
+
+    :param events: the event dicts
+    :type events: list
+
+    """
+    def sanitize(value):
+        if isinstance(value, float) and not math.isfinite(value):
+            return None
+
+        if isinstance(value, dict):
+            return {key: sanitize(item) for key, item in value.items()}
+
+        if isinstance(value, (list, tuple)):
+            return [sanitize(item) for item in value]
+
+        return value
+
+    with open(path, "w") as f:
+        json.dump(sanitize(events), f, allow_nan=False)
+
+
+def find_read_path(sample_path, number):
+    """
+    Find the read file ``reads_<number>`` in ``sample_path``, which may be uncompressed or compressed with gzip or
+    zstd. The extensions in :data:`READ_FILE_EXTENSIONS` are tried in order. The uncompressed ``.fastq`` path is
+    returned if no file exists.
+
+    :param sample_path: the path to the sample directory
+    :type sample_path: str
+
+    :param number: the read file number (1 or 2)
+    :type number: int
+
+    :return: the path to the read file
+    :rtype: str
+
+    """
+    for extension in READ_FILE_EXTENSIONS:
+        path = os.path.join(sample_path, "reads_{}{}".format(number, extension))
+
+        if os.path.isfile(path):
+            return path
+
+    return os.path.join(sample_path, "reads_{}.fastq".format(number))
+
+
+@contextlib.contextmanager
+def open_reads(path):
+    """
+    Open the read file at ``path`` for reading bytes. Files ending in ``.gz`` are decompressed with :mod:`gzip` and
+    files ending in ``.zst`` are streamed through ``zstd`` in a separate process.
+
+    :param path: the path to the read file
+    :type path: str
+
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            yield f
+
+    elif path.endswith(".zst"):
+        process = subprocess.Popen(["zstd", "-dcq", path], stdout=subprocess.PIPE)
+
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    else:
+        with open(path, "rb") as f:
+            yield f
+
+
+def open_fastq_writer(path, mode="w"):
+    """
+    Open a FASTQ file at ``path`` for writing. Paths ending in ``.gz`` are compressed with :mod:`gzip` at the fastest
+    compression level.
+
+    :param path: the path to the file
+    :type path: str
+
+    :param mode: ``"w"`` or ``"a"`` for text or ``"wb"`` or ``"ab"`` for bytes
+    :type mode: str
+
+    :return: the open file
+    :rtype: file object
+
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode if "b" in mode else mode + "t", compresslevel=1)
+
+    return open(path, mode)
 
 
 def coverage_to_coordinates(coverage_list):
-    previous_depth = coverage_list[0]
-    coordinates = {(0, previous_depth)}
+    """
+    Convert a per-base coverage list to the coordinates of a line through the points where the depth changes. The
+    first and last positions are always included.
+
+    Lines with more than 100 points are simplified to 40% of their points using :func:`simplify_coordinates`.
+
+    :param coverage_list: the depth at each position
+    :type coverage_list: list
+
+    :return: the coordinates as ``(position, depth)`` pairs
+    :rtype: list
+
+    """
+    depths = np.asarray(coverage_list)
+
+    last = len(depths) - 1
+
+    changes = np.flatnonzero(depths[1:] != depths[:-1]) + 1
+
+    positions = np.unique(np.concatenate(([0, last - 1, last], changes - 1, changes)))
+
+    if len(positions) > 100:
+        points = np.column_stack((positions, depths[positions]))
+        return points[simplify_coordinates(points, 0.4)].tolist()
+
+    return list(zip(positions.tolist(), depths[positions].tolist()))
+
+
+def simplify_coordinates(points, ratio):
+    """
+    Simplify a line using the Visvalingam-Whyatt algorithm and return the indexes of the points to keep.
+
+    Points are eliminated in order of the area of the triangle they form with their neighbours, which is updated as
+    neighbours are eliminated. The remaining points are tracked in a linked list and the candidates in a heap, giving
+    O(n log n) time. Ties and the areas of points that would otherwise become less significant than an eliminated
+    neighbour are handled the same way as in the ``visvalingamwyatt`` package. Like its ``by_number`` method in version
+    0.1.2, every point whose area is at least that of the last point to keep is returned, so ties can keep more than
+    ``ratio`` of the points and both endpoints are always kept.
+
+    :param points: an (n, 2) array of x, y coordinates
+    :type points: :class:`numpy.ndarray`
+
+    :param ratio: the fraction of points to keep
+    :type ratio: float
+
+    :return: the sorted indexes of the kept points
+    :rtype: :class:`numpy.ndarray`
+
+    """
+    count = len(points)
+
+    xs = points[:, 0].astype(float).tolist()
+    ys = points[:, 1].astype(float).tolist()
+
+    def triangle_area(a, b, c):
+        return abs(xs[a] * (ys[b] - ys[c]) + xs[b] * (ys[c] - ys[a]) + xs[c] * (ys[a] - ys[b])) / 2.0
+
+    areas = [float("inf")] + [triangle_area(k - 1, k, k + 1) for k in range(1, count - 1)] + [float("inf")]
+
+    previous = list(range(-1, count - 1))
+    following = list(range(1, count + 1))
+    removed = [False] * count
+
+    heap = [(areas[k], k) for k in range(1, count - 1)]
+    heapq.heapify(heap)
+
+    forced = None
+
+    while True:
+        if forced is None:
+            while heap:
+                area, k = heapq.heappop(heap)
+
+                if not removed[k] and area == areas[k]:
+                    break
+            else:
+                break
+        else:
+            k = forced
+
+        this_area = areas[k]
+        removed[k] = True
+
+        left = previous[k]
+        right = following[k]
+
+        following[left] = right
+        previous[right] = left
+
+        forced = None
+
+        if right != count - 1:
+            right_area = triangle_area(left, right, following[right])
+
+            if right_area <= this_area:
+                right_area = this_area
+                forced = right
+
+            areas[right] = right_area
+            heapq.heappush(heap, (right_area, right))
+
+        if left != 0:
+            left_area = triangle_area(previous[left], left, right)
+
+            if left_area <= this_area:
+                left_area = this_area
+                forced = left
+
+            areas[left] = left_area
+            heapq.heappush(heap, (left_area, left))
+
+    thresholds = np.array(areas)
+
+    keep_count = int(ratio * count)
+
+    if keep_count >= count:
+        return np.arange(count)
+
+    threshold = np.sort(thresholds)[::-1][keep_count]
+
+    return np.flatnonzero(thresholds >= threshold)
+
+
+def coverage_pyramid(coverage_list, bin_size=16, factor=4, max_bins=100):
+    """
+    Bin a per-base coverage list at several resolutions so that clients can display coverage without fetching every
+    depth.
+
+    The finest level uses bins of ``bin_size`` positions. Each subsequent level uses bins ``factor`` times larger until
+    a level has no more than ``max_bins`` bins. The last bin of a level may be shorter than the others.
+
+    Each level is a dict containing its ``bin_size`` and the ``max`` and ``mean`` depth of each bin. Means are rounded
+    to one decimal place.
+
+    :param coverage_list: the depth at each position
+    :type coverage_list: list
+
+    :param bin_size: the number of positions in each bin of the finest level
+    :type bin_size: int
+
+    :param factor: the increase in bin size between levels
+    :type factor: int
+
+    :param max_bins: the maximum number of bins in the coarsest level
+    :type max_bins: int
+
+    :return: the levels from finest to coarsest
+    :rtype: list
+
+    """
+    depths = np.asarray(coverage_list, dtype=np.int64)
+
+    levels = list()
+
+    while True:
+        starts = np.arange(0, len(depths), bin_size)
+        sizes = np.diff(np.append(starts, len(depths)))
+
+        levels.append({
+            "bin_size": bin_size,
+            "max": np.maximum.reduceat(depths, starts).tolist(),
+            "mean": np.round(np.add.reduceat(depths, starts) / sizes, 1).tolist()
+        })
+
+        if len(starts) <= max_bins:
+            return levels
+
+        bin_size *= factor
+
 
-    last = len(coverage_list) - 1
+def aggregate_otus(diagnosis, sequence_otu_map, coverage_stats):
+    """
+    Aggregate the per-sequence hits in ``diagnosis`` into one summary for each OTU.
 
-    for i, depth in enumerate(coverage_list):
-        if depth != previous_depth or i == last:
-            coordinates.add((i - 1, previous_depth))
-            coordinates.add((i, depth))
+    Each summary contains the OTU's ``id``, its ``otu`` info, the ids of its hit ``sequences``, the summed final
+    ``pi`` and best hit ``reads`` of those sequences, and their combined ``length``. ``coverage`` and ``depth`` are
+    calculated over the combined length, so an OTU with several segments or isolates is described by a single value
+    for each. Summaries are ordered by the first hit of each OTU in ``diagnosis``.
 
-            previous_depth = depth
+    :param diagnosis: the hits
+    :type diagnosis: list
 
-    coordinates = sorted(list(coordinates), key=lambda x: x[0])
+    :param sequence_otu_map: the ids of the OTUs that each sequence belongs to
+    :type sequence_otu_map: dict
 
-    if len(coordinates) > 100:
-        return vw.simplify(coordinates, ratio=0.4)
+    :param coverage_stats: the length, number of covered positions and summed depth of each hit sequence
+    :type coverage_stats: dict
 
-    return coordinates
+    :return: the OTU summaries
+    :rtype: list
+
+    """
+    otus = list()
+    otu_indexes = dict()
+
+    covered = list()
+    depth_sums = list()
+
+    for hit in diagnosis:
+        otu_id = sequence_otu_map[hit["id"]]
+
+        index = otu_indexes.get(otu_id)
+
+        if index is None:
+            index = otu_indexes[otu_id] = len(otus)
+
+            otus.append({
+                "id": otu_id,
+                "otu": hit["otu"],
+                "sequences": list(),
+                "pi": 0,
+                "reads": 0,
+                "length": 0
+            })
+
+            covered.append(0)
+            depth_sums.append(0)
+
+        otu = otus[index]
+
+        length, hit_covered, depth_sum = coverage_stats[hit["id"]]
+
+        otu["sequences"].append(hit["id"])
+        otu["pi"] += hit["final"]["pi"]
+        otu["reads"] += hit["final"]["reads"]
+        otu["length"] += length
+
+        covered[index] += hit_covered
+        depth_sums[index] += depth_sum
+
+    for otu, otu_covered, depth_sum in zip(otus, covered, depth_sums):
+        otu["coverage"] = round(otu_covered / otu["length"], 3)
+        otu["depth"] = round(depth_sum / otu["length"])
+
+    return otus
 
 
 def get_pathoscope_json_path(data_path, analysis_id, sample_id):
@@ -32,3 +486,273 @@ def get_pathoscope_json_path(data_path, analysis_id, sample_id):
         analysis_id,
         "pathoscope.json"
     )
+
+
+def get_pathoscope_index_path(data_path, analysis_id, sample_id):
+    return get_results_index_path(get_pathoscope_json_path(data_path, analysis_id, sample_id))
+
+
+def get_results_index_path(path):
+    """
+    Get the path of the index written alongside the results file at ``path`` by :func:`write_results`.
+
+    """
+    return os.path.splitext(path)[0] + ".index.json"
+
+
+def get_otu_cache_path(data_path, sample_id, index_id, checksum):
+    return os.path.join(
+        data_path,
+        "samples",
+        sample_id,
+        "otu_cache",
+        "{}_{}".format(index_id, checksum)
+    )
+
+
+def get_alignment_cache_path(data_path, sample_id, checksum):
+    return os.path.join(
+        data_path,
+        "samples",
+        sample_id,
+        "alignment_cache",
+        checksum
+    )
+
+
+def get_sequence_digest(sequence_id, sequence):
+    """
+    Calculate a SHA-1 digest of a reference sequence and its id. The digest changes whenever the sequence is edited, so
+    it identifies a version of the sequence in the alignment cache.
+
+    :param sequence_id: the sequence id
+    :type sequence_id: str
+
+    :param sequence: the sequence
+    :type sequence: str
+
+    :return: the hex digest
+    :rtype: str
+
+    """
+    return hashlib.sha1("{}\n{}".format(sequence_id, sequence).encode()).hexdigest()
+
+
+def checksum_files(paths, chunk_size=2 ** 20):
+    """
+    Calculate a SHA-1 checksum of the contents of the files at ``paths`` taken together.
+
+    :param paths: the file paths
+    :type paths: list
+
+    :return: the hex digest
+    :rtype: str
+
+    """
+    digest = hashlib.sha1()
+
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_em_json_path(data_path, analysis_id, sample_id):
+    return os.path.join(
+        data_path,
+        "samples",
+        sample_id,
+        "analysis",
+        analysis_id,
+        "em.json"
+    )
+
+
+def get_coverage_path(data_path, analysis_id, sample_id):
+    return os.path.join(
+        data_path,
+        "samples",
+        sample_id,
+        "analysis",
+        analysis_id,
+        "coverage.bin"
+    )
+
+
+def write_coverage(path, coverage):
+    """
+    Write per-base coverage lists to a compact binary file at ``path``.
+
+    Each coverage list is stored as a separately zlib-compressed block of little-endian unsigned 32-bit depths, so a
+    single sequence can be read without decompressing the others. The blocks are followed by a JSON index mapping each
+    sequence id to the offset, compressed size, and length of its block, and a fixed size footer holding the offset of
+    the index.
+
+    :param path: the path to write the coverage file to
+    :type path: str
+
+    :param coverage: an iterable of sequence id and coverage list pairs
+    :type coverage: iterable
+
+    """
+    index = dict()
+
+    with open(path, "wb") as f:
+        for ref_id, depths in coverage:
+            block = zlib.compress(np.asarray(depths, dtype="<u4").tobytes())
+
+            index[ref_id] = [f.tell(), len(block), len(depths)]
+
+            f.write(block)
+
+        index_offset = f.tell()
+
+        f.write(json.dumps(index).encode())
+        f.write(COVERAGE_FOOTER.pack(index_offset))
+
+
+def read_coverage(path, ref_ids=None):
+    """
+    Read coverage lists from a file written with :func:`write_coverage`.
+
+    :param path: the path to the coverage file
+    :type path: str
+
+    :param ref_ids: the sequence ids to read coverage for, or ``None`` to read all of them
+    :type ref_ids: iterable
+
+    :return: coverage lists keyed by sequence id
+    :rtype: dict
+
+    """
+    coverage = dict()
+
+    with open(path, "rb") as f:
+        f.seek(-COVERAGE_FOOTER.size, os.SEEK_END)
+
+        footer_offset = f.tell()
+
+        index_offset = COVERAGE_FOOTER.unpack(f.read(COVERAGE_FOOTER.size))[0]
+
+        f.seek(index_offset)
+
+        index = json.loads(f.read(footer_offset - index_offset).decode())
+
+        if ref_ids is None:
+            ref_ids = index
+
+        for ref_id in ref_ids:
+            offset, size, _ = index[ref_id]
+
+            f.seek(offset)
+
+            coverage[ref_id] = np.frombuffer(zlib.decompress(f.read(size)), dtype="<u4").tolist()
+
+    return coverage
+
+
+def write_results(path, results):
+    """
+    Stream analysis ``results`` to a JSON file at ``path`` and write an index for it at the path given by
+    :func:`get_results_index_path`.
+
+    The results file is ordinary JSON in the same format as before it was indexed. Each hit keeps its coverage list in
+    ``align`` unless the job was asked to move coverage to ``coverage.bin``. Each hit in the diagnosis is serialized
+    separately, so only one hit is held as a string at a time, and its byte offset and size are recorded in the index.
+    The index also holds the results with every hit's ``align`` field removed, which is enough to list the hits without
+    reading the results file.
+
+    :param path: the path to write the results to
+    :type path: str
+
+    :param results: the analysis results
+    :type results: dict
+
+    """
+    summary = {key: value for key, value in results.items() if key != "diagnosis"}
+
+    diagnosis = results.get("diagnosis", list())
+
+    offsets = dict()
+
+    with open(path, "wb") as f:
+        f.write(json.dumps(summary)[:-1].encode())
+
+        if summary:
+            f.write(b", ")
+
+        f.write(b'"diagnosis": [')
+
+        for i, hit in enumerate(diagnosis):
+            if i:
+                f.write(b", ")
+
+            encoded = json.dumps(hit).encode()
+
+            offsets[hit["id"]] = [f.tell(), len(encoded)]
+
+            f.write(encoded)
+
+        f.write(b"]}")
+
+    summary["diagnosis"] = [{key: value for key, value in hit.items() if key != "align"} for hit in diagnosis]
+
+    with open(get_results_index_path(path), "w") as f:
+        json.dump({
+            "offsets": offsets,
+            "summary": summary
+        }, f)
+
+
+def read_results_summary(path):
+    """
+    Read the results written to ``path`` by :func:`write_results` without any coverage lists. Only the index is read.
+
+    :param path: the path to the results file
+    :type path: str
+
+    :return: the results with the ``align`` field removed from each hit
+    :rtype: dict
+
+    """
+    with open(get_results_index_path(path), "r") as f:
+        return json.load(f)["summary"]
+
+
+def read_hit(path, ref_id, coverage=True):
+    """
+    Read a single hit from the results written to ``path`` by :func:`write_results`. The hit is read by seeking to its
+    offset in the results file.
+
+    If the hit's coverage was moved to ``coverage.bin`` by the job, it is read from there. Set ``coverage`` to
+    ``False`` to leave the ``align`` field out.
+
+    :param path: the path to the results file
+    :type path: str
+
+    :param ref_id: the sequence id of the hit
+    :type ref_id: str
+
+    :param coverage: include the coverage list of the hit
+    :type coverage: bool
+
+    :return: the hit
+    :rtype: dict
+
+    """
+    with open(get_results_index_path(path), "r") as f:
+        offset, size = json.load(f)["offsets"][ref_id]
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        hit = json.loads(f.read(size).decode())
+
+    if not coverage:
+        hit.pop("align", None)
+    elif hit.get("align") == "file":
+        coverage_path = os.path.join(os.path.dirname(path), "coverage.bin")
+        hit["align"] = read_coverage(coverage_path, [ref_id])[ref_id]
+
+    return hit
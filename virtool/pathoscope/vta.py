@@ -0,0 +1,348 @@
+"""
+Parallel parsing of VTA files.
+
+A VTA file is split into byte ranges that each contain whole lines. If the file is grouped by read, ranges also start
+and end at read boundaries, so every read's alignments are found in a single range. Ranges are parsed in a pool of
+processes. Parsed columns are written by the workers to ``.npy`` files in a scratch directory and memory mapped by the
+parent, so they are never pickled.
+
+"""
+import collections
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+#: Columns parsed from a VTA file. ``groups`` numbers the runs of consecutive lines with the same read id.
+VtaColumns = collections.namedtuple("VtaColumns", ["groups", "refs", "ref_indexes", "positions", "lengths", "scores"])
+
+#: Host scores made available to the workers of :func:`subtract` when they are started.
+_host_scores = None
+
+
+class NotGroupedError(ValueError):
+    """
+    Raised when the alignments of a read are not contiguous in a VTA file that was expected to be grouped by read.
+
+    """
+
+
+def find_chunks(path, chunk_count, grouped=False):
+    """
+    Split the file at ``path`` into at most ``chunk_count`` byte ranges of roughly equal size that each contain whole
+    lines. If ``grouped`` is ``True``, each range boundary is moved forward to the next line whose read id differs from
+    the one before it.
+
+    :param path: the path to the VTA file
+    :type path: str
+
+    :param chunk_count: the number of ranges to aim for
+    :type chunk_count: int
+
+    :param grouped: keep the lines of each read in one range
+    :type grouped: bool
+
+    :return: a list of ``(start, end)`` byte offsets
+    :rtype: list
+
+    """
+    size = os.path.getsize(path)
+
+    boundaries = [0]
+
+    with open(path, "rb") as f:
+        for i in range(1, chunk_count):
+            offset = max(size * i // chunk_count, boundaries[-1])
+
+            if offset >= size:
+                break
+
+            f.seek(offset)
+
+            # Skip to the start of the next line unless the offset is already at one.
+            if offset > 0:
+                f.seek(offset - 1)
+                f.readline()
+
+            if grouped:
+                read_id = None
+
+                while True:
+                    position = f.tell()
+                    line = f.readline()
+
+                    if not line or (read_id is not None and line.split(b",", 1)[0] != read_id):
+                        break
+
+                    read_id = line.split(b",", 1)[0]
+            else:
+                position = f.tell()
+
+            if position > boundaries[-1]:
+                boundaries.append(position)
+
+    if boundaries[-1] < size:
+        boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_lines(path, start, end):
+    """
+    Read the lines in a byte range of a file without their line endings.
+
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode().split("\n")
+
+    if lines and lines[-1] == "":
+        lines.pop()
+
+    return lines
+
+
+def parse_chunk(args):
+    """
+    Parse the lines in a byte range of a VTA file and save the columns as ``.npy`` files in ``output_path``. Reference
+    ids are numbered in the order they first appear in the range.
+
+    If the file is expected to be grouped, the first eight bytes of the MD5 digest of each group's read id are also
+    saved, so :func:`parse` can check that no read id starts more than one group.
+
+    :param args: the path to the VTA file, the byte range, the output path and whether the file is grouped
+    :type args: tuple
+
+    :return: the reference ids of the range and the number of groups
+    :rtype: tuple
+
+    """
+    path, start, end, output_path, grouped = args
+
+    lines = read_lines(path, start, end)
+
+    line_count = len(lines)
+
+    groups = np.empty(line_count, dtype=np.int64)
+    ref_indexes = np.empty(line_count, dtype=np.int64)
+    positions = np.empty(line_count, dtype=np.int64)
+    lengths = np.empty(line_count, dtype=np.int64)
+    scores = np.empty(line_count, dtype=float)
+
+    h_ref_id = dict()
+    refs = list()
+
+    group = -1
+    last_read_id = None
+
+    read_hashes = bytearray()
+
+    for i, line in enumerate(lines):
+        read_id, ref_id, pos, length, p_score = line.split(",")
+
+        if read_id != last_read_id:
+            group += 1
+            last_read_id = read_id
+
+            if grouped:
+                read_hashes += hashlib.md5(read_id.encode()).digest()[:8]
+
+        ref_index = h_ref_id.get(ref_id)
+
+        if ref_index is None:
+            ref_index = h_ref_id[ref_id] = len(refs)
+            refs.append(ref_id)
+
+        groups[i] = group
+        ref_indexes[i] = ref_index
+        positions[i] = int(pos)
+        lengths[i] = int(length)
+        scores[i] = float(p_score)
+
+    os.makedirs(output_path)
+
+    for name, values in (
+        ("groups", groups),
+        ("ref_indexes", ref_indexes),
+        ("positions", positions),
+        ("lengths", lengths),
+        ("scores", scores)
+    ):
+        np.save(os.path.join(output_path, name + ".npy"), values)
+
+    if grouped:
+        np.save(os.path.join(output_path, "read_hashes.npy"), np.frombuffer(bytes(read_hashes), dtype=np.int64))
+
+    return refs, group + 1
+
+
+def parse(path, processes, grouped=False):
+    """
+    Parse the VTA file at ``path`` into :class:`VtaColumns` using a pool of ``processes`` processes.
+
+    Reference indexes refer to the order in which references first appear in the file. If ``grouped`` is ``True``,
+    the file is split at read boundaries and each read's alignments get a single group number. Otherwise, a read that
+    spans two ranges may be given two group numbers.
+
+    A :class:`NotGroupedError` is raised if ``grouped`` is ``True`` but a read id starts more than one group. Read ids
+    are compared by hash, so a collision can also raise the error.
+
+    :param path: the path to the VTA file
+    :type path: str
+
+    :param processes: the number of processes to parse with
+    :type processes: int
+
+    :param grouped: whether the alignments of each read are contiguous in the file
+    :type grouped: bool
+
+    :return: the parsed columns
+    :rtype: :class:`VtaColumns`
+
+    """
+    chunks = find_chunks(path, processes, grouped)
+
+    scratch_path = tempfile.mkdtemp(prefix="vta_", dir=os.path.dirname(os.path.abspath(path)))
+
+    try:
+        chunk_args = [
+            (path, start, end, os.path.join(scratch_path, str(i)), grouped) for i, (start, end) in enumerate(chunks)
+        ]
+
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(parse_chunk, chunk_args)
+
+        if grouped:
+            read_hashes = np.concatenate([
+                np.load(os.path.join(output_path, "read_hashes.npy")) for _, _, _, output_path, _ in chunk_args
+            ] or [np.zeros(0, dtype=np.int64)])
+
+            if len(np.unique(read_hashes)) < len(read_hashes):
+                raise NotGroupedError("The alignments of a read are not contiguous in {}".format(path))
+
+        h_ref_id = dict()
+        refs = list()
+
+        columns = collections.defaultdict(list)
+
+        group_offset = 0
+
+        for (_, _, _, output_path, _), (chunk_refs, group_count) in zip(chunk_args, results):
+            # Map the chunk's reference numbering onto the order in which references first appear in the file.
+            ref_map = np.empty(len(chunk_refs), dtype=np.int64)
+
+            for i, ref_id in enumerate(chunk_refs):
+                ref_index = h_ref_id.get(ref_id)
+
+                if ref_index is None:
+                    ref_index = h_ref_id[ref_id] = len(refs)
+                    refs.append(ref_id)
+
+                ref_map[i] = ref_index
+
+            def load(name):
+                return np.load(os.path.join(output_path, name + ".npy"), mmap_mode="r")
+
+            columns["groups"].append(load("groups") + group_offset)
+            columns["ref_indexes"].append(ref_map[load("ref_indexes")])
+
+            for name in ("positions", "lengths", "scores"):
+                columns[name].append(load(name))
+
+            group_offset += group_count
+
+        def concatenate(name, dtype):
+            if columns[name]:
+                return np.concatenate(columns[name])
+
+            return np.zeros(0, dtype=dtype)
+
+        return VtaColumns(
+            concatenate("groups", np.int64),
+            refs,
+            concatenate("ref_indexes", np.int64),
+            concatenate("positions", np.int64),
+            concatenate("lengths", np.int64),
+            concatenate("scores", float)
+        )
+    finally:
+        shutil.rmtree(scratch_path)
+
+
+def set_host_scores(host_scores):
+    global _host_scores
+    _host_scores = host_scores
+
+
+def subtract_chunk(args):
+    """
+    Write the lines in a byte range of a VTA file that survive subtraction to ``output_path``. The range must contain
+    all of the alignments of its reads. Host scores are taken from the pool initializer.
+
+    :param args: the path to the VTA file, the byte range, the output path and whether read ids are integers
+    :type args: tuple
+
+    :return: the number of lines read and the number subtracted
+    :rtype: tuple
+
+    """
+    path, start, end, output_path, interned = args
+
+    parse_read_id = int if interned else str
+
+    lines = read_lines(path, start, end)
+
+    high_scores = dict()
+
+    for line in lines:
+        read_id, _, _, _, p_score = line.split(",")
+        read_id = parse_read_id(read_id)
+        high_scores[read_id] = max(high_scores.get(read_id, 0), float(p_score))
+
+    subtracted_count = 0
+
+    with open(output_path, "w") as f:
+        for line in lines:
+            read_id = parse_read_id(line.split(",", 1)[0])
+
+            if high_scores[read_id] > _host_scores.get(read_id, 0):
+                f.write(line + "\n")
+            else:
+                subtracted_count += 1
+
+    return len(lines), subtracted_count
+
+
+def subtract(vta_path, output_path, host_scores, processes, interned=False):
+    """
+    Write the lines of the grouped VTA file at ``vta_path`` that survive subtraction to ``output_path``, using a pool
+    of ``processes`` processes. Gives the same output as :func:`virtool.pathoscope.pathoscope.subtract`.
+
+    :return: the number of subtracted lines
+    :rtype: int
+
+    """
+    chunks = find_chunks(vta_path, processes, grouped=True)
+
+    scratch_path = tempfile.mkdtemp(prefix="vta_", dir=os.path.dirname(os.path.abspath(output_path)))
+
+    try:
+        chunk_args = [
+            (vta_path, start, end, os.path.join(scratch_path, str(i)), interned)
+            for i, (start, end) in enumerate(chunks)
+        ]
+
+        with multiprocessing.Pool(processes, initializer=set_host_scores, initargs=(host_scores,)) as pool:
+            results = pool.map(subtract_chunk, chunk_args)
+
+        with open(output_path, "wb") as out_handle:
+            for chunk in chunk_args:
+                with open(chunk[3], "rb") as f:
+                    shutil.copyfileobj(f, out_handle)
+
+        return sum(subtracted_count for _, subtracted_count in results)
+    finally:
+        shutil.rmtree(scratch_path)